@@ -0,0 +1,178 @@
+"""
+FludChunker.py (c) 2003-2006 Alen Peacock.  This program is distributed under
+the terms of the GNU General Public License (the GPL), version 3.
+
+Content-defined chunking.  Files are cut at boundaries chosen by a rolling
+(gear) hash of their contents rather than at fixed offsets, so an insertion
+or deletion only changes the chunks around it and the rest of the file still
+splits into the same chunks as before.
+
+The hash is computed a block at a time using big integer arithmetic rather
+than a byte at a time, so that the work happens in C: each byte's gear value
+is placed in a 64-bit lane of one large int, and the shifted sums that make
+up the hash are added lane-wise by shifting the whole int.
+"""
+
+import hashlib
+
+READSIZE = 1048576
+
+# the gear table maps each byte value to a pseudo-random 32-bit value.  It is
+# derived from sha256 so that every node cuts identical data at identical
+# boundaries.
+GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], 'big')
+        for i in range(256)]
+
+# a 32-bit gear hash only depends on the last 32 bytes seen
+WINDOW = 32
+
+# byte k of each gear value, as translate() tables
+GEARBYTES = [bytes((g >> 8*k) & 0xFF for g in GEAR) for k in range(4)]
+
+# number of hashes computed at once when looking for a boundary
+SCANSIZE = 65536
+
+_masktables = {}
+
+def _masks(avgsize):
+    # boundaries are taken where the top bits of the hash are all zero.  A
+    # mask one bit stricter than avgsize is used before the chunk reaches
+    # avgsize, and one a bit looser after, which keeps chunk sizes closer to
+    # avgsize (as in FastCDC).
+    bits = avgsize.bit_length()-1
+    maskS = ((1 << (bits+1))-1) << (32-bits-1)
+    maskL = ((1 << (bits-1))-1) << (32-bits+1)
+    return maskS, maskL
+
+def _tables(mask):
+    # for each byte of the hash that mask covers, a translate() table mapping
+    # that byte to 0 if it has none of mask's bits set, 1 otherwise
+    tables = _masktables.get(mask)
+    if tables is None:
+        tables = []
+        for k in range(4):
+            m = (mask >> 8*k) & 0xFF
+            if m:
+                tables.append((k, bytes(1 if x & m else 0
+                    for x in range(256))))
+        _masktables[mask] = tables
+    return tables
+
+def _hits(data, tables):
+    """
+    Returns a string with one byte per byte of data, zero where the gear hash
+    of data up to and including that byte has none of the masked bits set.
+    """
+    n = len(data)
+    lanes = bytearray(8*n)
+    for k in range(4):
+        lanes[k::8] = data.translate(GEARBYTES[k])
+    h = int.from_bytes(lanes, 'little')
+    # after this, lane i holds the sum of gear[data[i-j]] << j for j < WINDOW.
+    # That is under 2**64, so nothing carries between lanes, and its low 32
+    # bits are the hash.
+    span = 1
+    while span < WINDOW:
+        h += h << 65*span
+        span *= 2
+    raw = h.to_bytes(8*(n+WINDOW), 'little')
+    hits = None
+    for k, table in tables:
+        flags = raw[k:8*n:8].translate(table)
+        if hits is None:
+            hits = flags
+        else:
+            hits = (int.from_bytes(hits, 'big')
+                    | int.from_bytes(flags, 'big')).to_bytes(n, 'big')
+    return hits
+
+def _scan(buf, begin, end, mask, first):
+    """
+    Returns the first i in [begin, end) at which the gear hash of buf[first:]
+    has none of mask's bits set, or -1 if there is none.
+    """
+    tables = _tables(mask)
+    for b in range(begin, end, SCANSIZE):
+        if not tables:
+            return b
+        e = min(b+SCANSIZE, end)
+        # the hash at b depends on the WINDOW-1 bytes before it
+        h0 = max(first, b-WINDOW+1)
+        i = _hits(buf[h0:e], tables).find(0, b-h0)
+        if i >= 0:
+            return h0+i
+    return -1
+
+def findBoundary(buf, minsize, avgsize, maxsize):
+    """
+    Returns the length of the first chunk in buf.  buf must hold at least
+    maxsize bytes unless it is the tail end of the data.
+    """
+    n = len(buf)
+    if n <= minsize:
+        return n
+    if n > maxsize:
+        n = maxsize
+    normal = min(avgsize, n)
+    maskS, maskL = _masks(avgsize)
+    first = max(0, minsize-WINDOW)
+    i = _scan(buf, minsize, normal, maskS, first)
+    if i < 0:
+        i = _scan(buf, normal, n, maskL, first)
+    if i < 0:
+        return n
+    return i+1
+
+def chunkfile(filename, minsize, avgsize, maxsize, previous=None):
+    """
+    Splits filename into content-defined chunks of between minsize and
+    maxsize bytes (averaging around avgsize, which should be a power of 2).
+    Returns a list of (offset, length, sha256 hexdigest) tuples, one per
+    chunk, in file order.
+
+    previous, if given, is the list returned for an earlier version of the
+    file with the same sizes.  Where the file starts, or a chunk ends, just
+    as in that version, the next chunk is likely unchanged too, and if its
+    sha256 matches, it is taken as is: identical data up to a boundary is cut
+    at the same boundary.  Only the chunks around edits need the rolling
+    hash, so rechunking an edited file costs little more than hashing it.
+    """
+    if not 0 < minsize <= avgsize <= maxsize:
+        raise ValueError("chunk sizes must satisfy 0 < min <= avg <= max")
+    # the last chunk may have been cut short by the end of the file, so it
+    # is never taken as is
+    previous = list(previous or [])[:-1]
+    following = {}
+    for chunk, after in zip(previous, previous[1:]):
+        following[chunk[2]] = after
+    expected = previous[0] if previous else None
+    chunks = []
+    offset = 0
+    buf = bytearray()
+    eof = False
+    with open(filename, 'rb') as f:
+        while True:
+            while not eof and len(buf) < maxsize:
+                data = f.read(max(READSIZE, maxsize-len(buf)))
+                if not data:
+                    eof = True
+                else:
+                    buf += data
+            if not buf:
+                break
+            cut = None
+            if expected and expected[1] <= len(buf):
+                with memoryview(buf) as view:
+                    digest = hashlib.sha256(
+                            view[:expected[1]]).hexdigest()
+                if digest == expected[2]:
+                    cut = expected[1]
+            if cut is None:
+                cut = findBoundary(buf, minsize, avgsize, maxsize)
+                with memoryview(buf) as view:
+                    digest = hashlib.sha256(view[:cut]).hexdigest()
+            chunks.append((offset, cut, digest))
+            expected = following.get(digest)
+            offset += cut
+            del buf[:cut]
+    return chunks
@@ -6,11 +6,13 @@ manages configuration file for flud backup.
 """
 
 import os, sys, socket, re, logging, time, threading
-import configparser
+import configparser, ast
 
 import flud.FludCrypto as FludCrypto
 from flud.FludCrypto import FludRSA
 from flud.FludkRouting import kRouting
+from flud.FludHashCache import HashCache
+from flud.FludReputations import ReputationIndex
 from flud.fencode import fencode, fdecode
 
 logger = logging.getLogger('flud')
@@ -32,6 +34,10 @@ def _parse_loglevel(value):
 
 CLIENTPORTOFFSET = 500
 
+""" default erasure coding tiers: (maxsize, k, n), maxsize 0 meaning no limit """
+CODINGTIERS = [(65536, 4, 4), (4194304, 10, 10), (1073741824, 20, 20),
+        (0, 40, 20)]
+
 """ default mapping of trust deltas """
 class TrustDeltas:
     INITIAL_SCORE = 1
@@ -125,9 +131,9 @@ class FludConfig:
         self.groupIDr = 0
         self.groupIDu = 0
         self.port = -1
-        self.reputations = {}
+        self.reputations = ReputationIndex()
         self.nodes = {}
-        self.throttled = {}  # XXX: should persist this to config file
+        self.throttled = self.reputations.throttled
         self.manifest_lock = threading.RLock()
 
         try:
@@ -189,7 +195,7 @@ class FludConfig:
         logger.debug('groupIDr = %s' % self.groupIDr)
         logger.debug('groupIDu = %s' % self.groupIDu)
         
-        self.port, self.clientport = self._getServerConf()
+        self.port, self.clientport, self.packindexes = self._getServerConf()
         if serverport != None:
             self.port = serverport
             self.clientport = serverport + CLIENTPORTOFFSET
@@ -227,8 +233,48 @@ class FludConfig:
             os.chmod(self.metadir, 0o700)
         logger.debug('metadir = %s' % self.metadir)
 
-        self.reputations = self._getReputations()
-        logger.debug("reputations = %s" % str(self.reputations))
+        self.chunking, self.chunksizes = self._getChunkConf()
+        logger.debug('chunking = %s, chunksizes = %s'
+                % (self.chunking, self.chunksizes))
+
+        self.codingtiers = self._getCodingConf()
+        logger.debug('codingtiers = %s' % self.codingtiers)
+
+        self.hedging = self._getHedgeConf()
+        logger.debug('hedging = %s' % str(self.hedging))
+
+        self.packing, self.packsizes = self._getPackConf()
+        logger.debug('packing = %s, packsizes = %s'
+                % (self.packing, self.packsizes))
+
+        self.connections = self._getConnectionConf()
+        logger.debug('connections = %s' % str(self.connections))
+
+        self.resolve = self._getResolveConf()
+        logger.debug('resolve = %s' % str(self.resolve))
+
+        self.hashcache = HashCache(os.path.join(self.fludhome, "hashcache"))
+        logger.debug('hashcache = %s (%d entries)'
+                % (self.hashcache.path, len(self.hashcache.entries)))
+
+        self.workers, self.queuelimit, self.stagelimits \
+                = self._getWorkerConf()
+        logger.debug('workers = %s, queuelimit = %s, stagelimits = %s'
+                % (self.workers, self.queuelimit, self.stagelimits))
+
+        self.trustcapacity, self.trusthalflife = self._getTrustConf()
+        logger.debug('trustcapacity = %s, trusthalflife = %s'
+                % (self.trustcapacity, self.trusthalflife))
+
+        self.reputations = ReputationIndex(
+                path=os.path.join(self.fludhome, "reputations"),
+                capacity=self.trustcapacity,
+                halflife=self.trusthalflife*86400,
+                baseline=TrustDeltas.INITIAL_SCORE)
+        self._importReputations()
+        self.throttled = self.reputations.throttled
+        logger.debug("reputations = %s (%d entries)"
+                % (self.reputations.path, len(self.reputations)))
         
         self.nodes = self._getKnownNodes()
         logger.debug("known nodes = %s" % str(self.nodes))
@@ -242,6 +288,7 @@ class FludConfig:
         """
         saves configuration
         """
+        self.reputations.flush()
         conffile = open(self.fludconfig, "w")
         self.configParser.write(conffile) 
         conffile.close()
@@ -338,7 +385,9 @@ class FludConfig:
 
     def _getServerConf(self):
         """
-        Returns server configuration: port number
+        Returns server configuration: (port, clientport, packindexes), the
+        ports served on and the number of requesters whose pack indexes are
+        kept in memory.
         """
         if not self.configParser.has_section("server"):
             self.configParser.add_section("server")
@@ -356,10 +405,18 @@ class FludConfig:
             logger.debug("no clientport specified, using default")
             clientport = port+CLIENTPORTOFFSET 
         
+        try:
+            packindexes = max(1, int(self.configParser.get("server",
+                "packindexes")))
+        except:
+            logger.debug("no packindexes specified, using default")
+            packindexes = 256
+
         self._setconf("server", "port", port)
         self._setconf("server", "clientport", clientport)
+        self._setconf("server", "packindexes", packindexes)
 
-        return port, clientport
+        return port, clientport, packindexes
 
     def _getDirConf(self, configParser, section, default):
         """
@@ -443,12 +500,277 @@ class FludConfig:
         
         return (metadir, manifest)
 
-    def _getReputations(self):
+    def _getChunkConf(self):
         """
-        Returns dict of reputations known to this node
+        Returns content-defined chunking configuration: whether large files
+        are stored as separately stored chunks, and the (min, avg, max) chunk
+        sizes.  avgsize is rounded down to a power of 2.
         """
-        # XXX: should probably just throw these in with 'nodes' (for efficiency)
-        return self._getDict(self.configParser, "reputations")
+        if not self.configParser.has_section("chunking"):
+            self.configParser.add_section("chunking")
+        try:
+            enabled = bool(int(self.configParser.get("chunking", "enabled")))
+        except:
+            logger.debug("chunking not specified, defaulting to off")
+            enabled = False
+        sizes = []
+        for option, default in (("minsize", 2097152), ("avgsize", 8388608),
+                ("maxsize", 33554432)):
+            try:
+                sizes.append(int(self.configParser.get("chunking", option)))
+            except:
+                logger.debug("no chunking %s specified, using default"
+                        % option)
+                sizes.append(default)
+        minsize, avgsize, maxsize = sizes
+        avgsize = 1 << (max(avgsize, 2).bit_length()-1)
+        if not 0 < minsize <= avgsize <= maxsize:
+            logger.warn("bad chunk sizes %s, using defaults" % str(sizes))
+            minsize, avgsize, maxsize = 2097152, 8388608, 33554432
+        self._setconf("chunking", "enabled", int(enabled))
+        self._setconf("chunking", "minsize", minsize)
+        self._setconf("chunking", "avgsize", avgsize)
+        self._setconf("chunking", "maxsize", maxsize)
+        return enabled, (minsize, avgsize, maxsize)
+
+    def _getCodingConf(self):
+        """
+        Returns the erasure coding tiers, a list of (maxsize, k, n) tuples
+        ordered by maxsize (0, meaning no limit, last).  Files are coded
+        into k data and n parity blocks according to the first tier they
+        fit in.  In the config file, tiers are written as
+        'tiers = maxsize:k:n, ...'.
+        """
+        if not self.configParser.has_section("coding"):
+            self.configParser.add_section("coding")
+        try:
+            tiers = []
+            for tier in self.configParser.get("coding", "tiers").split(","):
+                maxsize, k, n = [int(x) for x in tier.split(":")]
+                if maxsize < 0 or k < 1 or n < 0 or k+n > 256:
+                    raise ValueError("bad coding tier %s" % tier)
+                tiers.append((maxsize, k, n))
+            tiers.sort(key=lambda t: (t[0] == 0, t[0]))
+            if not tiers or tiers[-1][0] != 0:
+                raise ValueError("no tier for files of unlimited size")
+        except configparser.Error:
+            logger.debug("no coding tiers specified, using defaults")
+            tiers = CODINGTIERS
+        except ValueError as err:
+            logger.warn("bad coding tiers (%s), using defaults" % err)
+            tiers = CODINGTIERS
+        self._setconf("coding", "tiers", ", ".join(["%d:%d:%d" % t
+            for t in tiers]))
+        return tiers
+
+    def getCoding(self, size):
+        """
+        Returns (k, n), the number of data and parity blocks that an object
+        of size bytes should be erasure coded into.  If this node knows of
+        fewer than k+n other nodes, k and n are scaled down (keeping their
+        ratio) so that blocks are still spread one per node.
+        """
+        for maxsize, k, n in self.codingtiers:
+            if maxsize == 0 or size <= maxsize:
+                break
+        nodes = self.routing.nodeCount()
+        if 0 < nodes < k+n:
+            m = max(nodes, 2)
+            newk = max(1, k*m // (k+n))
+            k, n = newk, max(1, m-newk)
+        return k, n
+
+    def _getHedgeConf(self):
+        """
+        Returns block retrieval hedging configuration: (extra, percentile),
+        the number of blocks fetched beyond the k needed to decode, and the
+        percentile of recent block fetch times after which another fetch is
+        started alongside a slow one (0 to never do so).
+        """
+        if not self.configParser.has_section("hedging"):
+            self.configParser.add_section("hedging")
+        try:
+            extra = int(self.configParser.get("hedging", "extra"))
+        except:
+            logger.debug("no extra block fetches specified, using default")
+            extra = 2
+        try:
+            percentile = int(self.configParser.get("hedging", "percentile"))
+        except:
+            logger.debug("no hedging percentile specified, using default")
+            percentile = 95
+        extra = max(0, extra)
+        percentile = min(max(0, percentile), 100)
+        self._setconf("hedging", "extra", extra)
+        self._setconf("hedging", "percentile", percentile)
+        return extra, percentile
+
+    def _getPackConf(self):
+        """
+        Returns small-file packing configuration: whether small files are
+        stored together in packs, and (maxfilesize, packsize), the size at or
+        below which a file is packed and the size a pack is filled to before
+        it is stored.
+        """
+        if not self.configParser.has_section("packing"):
+            self.configParser.add_section("packing")
+        try:
+            enabled = bool(int(self.configParser.get("packing", "enabled")))
+        except:
+            logger.debug("packing not specified, defaulting to off")
+            enabled = False
+        sizes = []
+        for option, default in (("maxfilesize", 65536),
+                ("packsize", 4194304)):
+            try:
+                sizes.append(int(self.configParser.get("packing", option)))
+            except:
+                logger.debug("no packing %s specified, using default"
+                        % option)
+                sizes.append(default)
+        maxfilesize, packsize = sizes
+        if not 0 < maxfilesize <= packsize:
+            logger.warn("bad pack sizes %s, using defaults" % str(sizes))
+            maxfilesize, packsize = 65536, 4194304
+        self._setconf("packing", "enabled", int(enabled))
+        self._setconf("packing", "maxfilesize", maxfilesize)
+        self._setconf("packing", "packsize", packsize)
+        return enabled, (maxfilesize, packsize)
+
+    def _getConnectionConf(self):
+        """
+        Returns outgoing HTTP connection pool configuration: (keepalive,
+        limit, limitperhost), the number of seconds an idle connection to a
+        peer is kept open for reuse (0 to close connections after each
+        request), and the maximum number of connections open in total and to
+        any one peer.
+        """
+        if not self.configParser.has_section("connections"):
+            self.configParser.add_section("connections")
+        values = []
+        for option, default in (("keepalive", 15), ("limit", 80),
+                ("limitperhost", 20)):
+            try:
+                values.append(int(self.configParser.get("connections",
+                    option)))
+            except:
+                logger.debug("no connections %s specified, using default"
+                        % option)
+                values.append(default)
+        keepalive, limit, limitperhost = values
+        keepalive = max(0, keepalive)
+        limit = max(1, limit)
+        limitperhost = min(max(1, limitperhost), limit)
+        self._setconf("connections", "keepalive", keepalive)
+        self._setconf("connections", "limit", limit)
+        self._setconf("connections", "limitperhost", limitperhost)
+        return keepalive, limit, limitperhost
+
+    def _getResolveConf(self):
+        """
+        Returns peer address resolution configuration: (reverselookups, ttl,
+        negativettl), whether peer addresses are reverse-resolved to host
+        names at all, and how many seconds resolved names and failed lookups
+        are cached for.
+        """
+        if not self.configParser.has_section("resolve"):
+            self.configParser.add_section("resolve")
+        try:
+            reverse = bool(int(self.configParser.get("resolve",
+                "reverselookups")))
+        except:
+            logger.debug("reverselookups not specified, defaulting to on")
+            reverse = True
+        ttls = []
+        for option, default in (("ttl", 3600), ("negativettl", 300)):
+            try:
+                ttls.append(max(0, int(self.configParser.get("resolve",
+                    option))))
+            except:
+                logger.debug("no resolve %s specified, using default"
+                        % option)
+                ttls.append(default)
+        ttl, negativettl = ttls
+        self._setconf("resolve", "reverselookups", int(reverse))
+        self._setconf("resolve", "ttl", ttl)
+        self._setconf("resolve", "negativettl", negativettl)
+        return reverse, ttl, negativettl
+
+    def _getWorkerConf(self):
+        """
+        Returns worker pool configuration: the number of threads used for
+        CPU-bound file operation stages, the default limit on jobs queued
+        per stage, and a dict of per-stage overrides of that limit (any
+        other option in the 'workers' section, e.g. 'encode = 2').  Decodes
+        hold k share files open each, so the 'decode' stage defaults to one
+        job per worker.
+        """
+        if not self.configParser.has_section("workers"):
+            self.configParser.add_section("workers")
+        try:
+            workers = int(self.configParser.get("workers", "workers"))
+        except:
+            logger.debug("no worker count specified, using default")
+            workers = os.cpu_count() or 1
+        try:
+            queuelimit = int(self.configParser.get("workers", "queuelimit"))
+        except:
+            logger.debug("no stage queue limit specified, using default")
+            queuelimit = 2*workers
+        stagelimits = {}
+        for stage, limit in self.configParser.items("workers"):
+            if stage in ("workers", "queuelimit"):
+                continue
+            try:
+                stagelimits[stage] = int(limit)
+            except ValueError:
+                logger.warn("ignoring bad queue limit '%s' for stage '%s'"
+                        % (limit, stage))
+        stagelimits.setdefault("decode", workers)
+        self._setconf("workers", "workers", workers)
+        self._setconf("workers", "queuelimit", queuelimit)
+        self._setconf("workers", "decode", stagelimits["decode"])
+        return workers, queuelimit, stagelimits
+
+    def _getTrustConf(self):
+        """
+        Returns reputation table configuration: (capacity, halflife), the
+        number of nodes whose reputations are kept, and the number of days
+        over which a reputation loses half of its distance from
+        TrustDeltas.INITIAL_SCORE (0 turns decay off).
+        """
+        if not self.configParser.has_section("trust"):
+            self.configParser.add_section("trust")
+        try:
+            capacity = max(1, int(self.configParser.get("trust", "capacity")))
+        except:
+            logger.debug("no reputation capacity specified, using default")
+            capacity = 10000
+        try:
+            halflife = max(0, int(self.configParser.get("trust",
+                "halflife")))
+        except:
+            logger.debug("no reputation halflife specified, using default")
+            halflife = 30
+        self._setconf("trust", "capacity", capacity)
+        self._setconf("trust", "halflife", halflife)
+        return capacity, halflife
+
+    def _importReputations(self):
+        """
+        Moves reputations kept in the config file's 'reputations' section (by
+        older versions) into the reputation table.
+        """
+        if not self.configParser.has_section("reputations"):
+            return
+        for nodeID, score in self.configParser.items("reputations"):
+            try:
+                self.reputations[int(nodeID, 16)] = ast.literal_eval(score)
+            except (ValueError, SyntaxError, TypeError):
+                logger.warning("item '%s' in section 'reputations' of the"
+                        " config file has an unreadable format" % nodeID)
+        self.configParser.remove_section("reputations")
+        self.reputations.flush()
 
     def _getKnownNodes(self):
         """
@@ -506,19 +828,14 @@ class FludConfig:
             # XXX: disabled nodes saving
             #for k in self.nodes:
             #   self._setconf('nodes', k, self.nodes[k])
-            n = self.routing.insertNode((host, int(port), int(nodeID, 16), 
-                Ku.exportPublicKey()['n']))
-            if n != None:
-                logger.warn("need to ping %s for LRU in routing table!" 
-                        % str(n))
-                # XXX: instead of pinging, put it in a replacement cache table
-                #      and when one of the nodes needs replaced (future query)
-                #      replace it with one of these. Sec 4.1
-                self.routing.replacementCache.insertNode(
-                        (host, int(port), int(nodeID, 16),
-                            Ku.exportPublicKey()['n']))
-            self.reputations[int(nodeID,16)] = TrustDeltas.INITIAL_SCORE
-            # XXX: no management of reputations size: need to manage as a cache
+            # if the node's kbucket is full, the routing table keeps it as a
+            # replacement, promoted once one of the bucket's nodes fails to
+            # respond (sec 4.1)
+            self.routing.insertNode((host, int(port), int(nodeID, 16), Ku.n))
+            # scores loaded from the reputation journal outlive self.nodes,
+            # which starts out empty on every run
+            if int(nodeID,16) not in self.reputations:
+                self.reputations[int(nodeID,16)] = TrustDeltas.INITIAL_SCORE
     
     def modifyReputation(self, nodeID, reason):
         """
@@ -527,17 +844,14 @@ class FludConfig:
         logger.info("modify %s %s" % (nodeID, reason.value))
         if isinstance(nodeID, str):
             nodeID = int(nodeID,16)
-        if nodeID not in self.reputations:
-            self.reputations[nodeID] = TrustDeltas.INITIAL_SCORE
-            # XXX: no management of reputations size: need to manage as a cache
-        self.reputations[nodeID] += reason.value
-        logger.debug("reputation for %d now %d", nodeID, 
-                self.reputations[nodeID])
+        score = self.reputations.adjust(nodeID, reason.value,
+                TrustDeltas.INITIAL_SCORE)
+        logger.debug("reputation for %d now %.2f", nodeID, score)
         curtime = int(time.time())
         if reason.value < 0:
             self.throttleNode(nodeID, reason, curtime)
-        elif nodeID in self.throttled and self.throttled[nodeID] < curtime:
-            self.throttled.pop(nodeID)
+        else:
+            self.reputations.expire(curtime)
 
     def throttleNode(self, nodeID, reason, curtime=None):
         """
@@ -547,7 +861,7 @@ class FludConfig:
             curtime = int(time.time())
         pause = curtime \
                 + (reason.value * 24 * 60 * 60) / TrustDeltas.MAX_DEC_PERDAY
-        self.throttled[nodeID] = pause 
+        self.reputations.throttle(nodeID, pause)
 
     def getPreferredNodes(self, num=None, exclude=None, throttle=False):
         """
@@ -557,53 +871,13 @@ class FludConfig:
         exhausted, i.e., there aren't num nodes available).  If throttle
         (default), do not return any nodes which are currently throttled.
         """
-        # XXX: O(n) each time this is called.  Better performance if we
-        # maintain sorted list when modified (modifyReputation, addNode), at a
-        # bit higher mem expense.
-        items = list(self.reputations.items())
-        numitems = len(items)
-        logger.debug("%d items in reps" % numitems)
         if throttle:
-
-            now = int(time.time())
-            for t in self.throttled:
-                if self.throttled[t] < now:
-                    self.throttled.pop(t)
-
-            if exclude:
-                items = [(v,k) for (k,v) in items if k not in self.throttled and 
-                        k not in exclude]
-                if num and len(items) < num and numitems >= num:
-                    exitems = [(v,k) for (k,v) in self.reputations.items()
-                            if k not in self.throttled and k in exclude]
-                    items += exitems[:num-len(items)]
-                logger.debug("%d items now in reps" % len(items))
-            else:
-                items = [(v,k) for (k,v) in items if k not in self.throttled]
-        
-        else:
-            # XXX: refactor; 'if exclude else' is same as above, but without
-            # the 'if k not in throttle' bits
-            if exclude:
-                items = [(v,k) for (k,v) in items if k not in exclude]
-                if num and len(items) < num and numitems >= num:
-                    exitems = [(v,k) for (k,v) in self.reputations.items()
-                            if k in exclude]
-                    items += exitems[:num-len(items)]
-                logger.debug("%d items now in reps" % len(items))
-            else:
-                items = [(v,k) for (k,v) in items]
-
-        items.sort()
-        items.reverse()
-        items = [(k,v) for (v,k) in items]
+            self.reputations.expire(int(time.time()))
+        nodeIDs = self.reputations.best(num, exclude, throttle)
         # need to call routing.getNode() to get node triple and return those
-        if num:
-            logger.debug("returning %d of the %d items" % (num, len(items)))
-            return [self.routing.getNode(f) for (f,v) in items[:num]]
-        else:
-            logger.debug("returning all %d of the items" % len(items))
-            return [self.routing.getNode(f) for (f,v) in items]
+        logger.debug("returning %d of the %d nodes", len(nodeIDs),
+                len(self.reputations))
+        return [self.routing.getNode(f) for f in nodeIDs]
 
     # XXX: note that this manifest all-in-mem scheme doesn't really work
     # long term; these methods should eventually go to a local db or db-like
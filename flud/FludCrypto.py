@@ -10,13 +10,21 @@ etc.
 import binascii
 import operator
 import struct
+import threading
 import time
+from collections import OrderedDict
 from Cryptodome.Cipher import PKCS1_v1_5
 from Cryptodome.Hash import SHA256
 from Cryptodome.PublicKey import RSA
 from Cryptodome.Random import atfork, get_random_bytes
 from Cryptodome.Util.number import inverse
 
+# number of imported public keys kept by importPublicKey()
+PUBKEYCACHESIZE = 4096
+
+_pubkeys = OrderedDict()
+_pubkeysLock = threading.Lock()
+
 class FludRSA(object):
     """
     Lightweight wrapper around Cryptodome.PublicKey.RSA.RsaKey that keeps the
@@ -29,6 +37,7 @@ class FludRSA(object):
         if not isinstance(rsa, RSA.RsaKey):
             raise TypeError("FludRSA requires an RSA.RsaKey, got %s" % type(rsa))
         self._key = rsa
+        self._id = None
 
     def __getattr__(self, name):
         # Delegate to the underlying RsaKey for attributes like n, e, d, etc.
@@ -93,29 +102,46 @@ class FludRSA(object):
         """
         returns the hashstring of the public key
         """
-        return hashstring(str(self.exportPublicKey()['n']))
+        if self._id is None:
+            self._id = hashstring(str(self._key.n))
+        return self._id
 
     def importPublicKey(key):
         """
         Can take, as key, a dict describing the public key ('e' and 'n'), a
         string describing n, or a long describing n (in the latter two cases, e
-        is assumed to be 65537L).
+        is assumed to be 65537L).  The dict's values may also be decimal
+        strings, as received in request parameters.
+
+        Imported keys are cached (the most recently used PUBKEYCACHESIZE of
+        them), so the same FludRSA may be returned to several callers; callers
+        must treat it as read-only.
         """
         if isinstance(key, str):
-            key = int(key, 16)
-            key = {'e': 65537, 'n': key}
+            cachekey = (65537, int(key, 16))
         elif isinstance(key, int):
-            key = {'e': 65537, 'n': key}
-
-        if isinstance(key, dict):
-            n = key['n']
-            e = key.get('e', 65537)
-            pkey = RSA.construct((n, e))
-            return FludRSA(pkey)
+            cachekey = (65537, key)
+        elif isinstance(key, dict):
+            # ints and decimal strings of the same key share an entry
+            cachekey = (int(key.get('e', 65537)), int(key['n']))
         else:
             raise TypeError("type %s not supported by importPublicKey():"\
                     " try dict with keys of 'e' and 'n', string representing"\
                     " 'n', or long representing 'n'." % type(key))
+
+        with _pubkeysLock:
+            result = _pubkeys.get(cachekey)
+            if result is not None:
+                _pubkeys.move_to_end(cachekey)
+                return result
+        e, n = cachekey
+        result = FludRSA(RSA.construct((n, e)))
+        result.id()
+        with _pubkeysLock:
+            _pubkeys[cachekey] = result
+            if len(_pubkeys) > PUBKEYCACHESIZE:
+                _pubkeys.popitem(last=False)
+        return result
     importPublicKey = staticmethod(importPublicKey)
 
     def importPrivateKey(key):
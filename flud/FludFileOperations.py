@@ -6,7 +6,8 @@ Implements file storage and retrieval operations using flud primitives.
 """
 
 import asyncio
-import os, stat, sys, logging, binascii, random, time, shutil, threading
+import collections
+import os, stat, sys, logging, binascii, random, time, shutil, tempfile
 from zlib import crc32
 from io import StringIO, BytesIO
 from Cryptodome.Cipher import AES
@@ -17,18 +18,36 @@ from flud.protocol.FludCommUtil import *
 from flud.fencode import fencode, fdecode
 from flud.FludConfig import TrustDeltas
 from . import fludfilefec
+from . import FludChunker
 
 logger = logging.getLogger('flud.fileops')
-_decode_lock = threading.Lock()
 
-# erasure coding constants
+# erasure coding constants.  These are only defaults: the coding used for
+# each stored object is chosen by FludConfig.getCoding() and recorded in its
+# metadata
 code_k = 20             # data blocks
 code_n = 20             # parity blocks
 code_m = code_k+code_n  # total blocks
 
 # temp filenaming defaults
 appendEncrypt = ".crypt"
-appendFsMeta = ".nmeta"
+appendChunks = ".chunks"
+appendPack = ".pack"
+
+# a chunked file's chunk list is kept in its metadir under this suffix, so
+# that the chunks unchanged since it was last stored needn't be rehashed
+appendChunkHints = ".chunkhints"
+
+# max number of chunks of a chunked file stored or retrieved concurrently
+MAXCHUNKOPS = 4
+
+# seconds to wait for more small files before storing a partly filled pack
+PACKFILE_TO = 2
+
+# block fetch times remembered for deciding when to hedge slow fetches, and
+# how many are needed before doing so
+LATENCYSAMPLES = 200
+MINLATENCYSAMPLES = 20
 
 
 def _diag_enabled():
@@ -102,6 +121,126 @@ async def update_manifest(node):
     operation = UpdateManifest(node)
     return await operation.run()
 
+# plaintext is read (and encrypted) this many bytes at a time
+READSIZE = 1048576
+
+def encrypt_and_encode(filename, eKey, iv, encodedir, prefix, k, m,
+        offset=0, length=None):
+    """
+    Encrypts filename with the (CBC) cipher eKey and erasure codes the result
+    into m share files in encodedir, all in one pass over the plaintext.  The
+    encrypted stream is iv followed by eKey(pad + file), where pad brings the
+    length up to a multiple of 16 and its first byte records the pad length.
+    If offset and length are given, only that range of filename is used.
+    Returns a list of (sharefilename, sha256 hexdigest) tuples in share order.
+    """
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        if length is None:
+            fsize = os.fstat(fd)[stat.ST_SIZE]-offset
+        else:
+            fsize = length
+        os.lseek(fd, offset, os.SEEK_SET)
+        # create a pad at front of file to make it an even multiple of 16
+        fpad = int(16 - fsize%16)
+        paddata = bytes([fpad]) + b'\x00'*(fpad-1)
+        fns, fs = fludfilefec.open_share_files(encodedir, prefix, m)
+        try:
+            encoder = fludfilefec.StreamingEncoder(len(iv)+fpad+fsize, k, m, fs)
+            encoder.write(iv)
+            leftover = paddata
+            remaining = fsize
+            while remaining > 0:
+                buf = os.read(fd, min(READSIZE, remaining))
+                if buf == b"":
+                    break
+                remaining -= len(buf)
+                buf = leftover + buf
+                cut = len(buf) - len(buf)%16
+                leftover = buf[cut:]
+                encoder.write(eKey.encrypt(buf[:cut]))
+            if leftover:
+                encoder.write(eKey.encrypt(leftover))
+            hashes = encoder.close()
+        except:
+            for f, fn in zip(fs, fns):
+                f.close()
+                os.remove(fn)
+            raise
+        for f in fs:
+            f.close()
+    finally:
+        os.close(fd)
+    return list(zip(fns, hashes))
+
+def _padlen(block, strict):
+    # the first byte of the pad records its length.  If strict, the rest of
+    # the pad must also be zeros, as encrypt_and_encode writes it.
+    fpad = block[0]
+    if not 1 <= fpad <= 16 or (strict and any(block[1:fpad])):
+        return None
+    return fpad
+
+class DecryptingWriter:
+    """
+    File-like object that decrypts the stream written to it, as produced by
+    encrypt_and_encode (iv followed by eK(pad + data)), and writes the
+    plaintext, without the pad, to outf.  Data is decrypted as it arrives,
+    in as large pieces as possible.  Data encrypted by older versions (in
+    ECB mode, without an iv) is recognized by its pad, from the first 32
+    bytes of the stream.
+    """
+
+    def __init__(self, eK, outf):
+        self.key = binascii.unhexlify(eK)
+        self.outf = outf
+        self.cipher = None
+        self.buf = bytearray()
+
+    def write(self, data):
+        self.buf += data
+        if self.cipher is None:
+            if len(self.buf) < 32:
+                return
+            self._start()
+        cut = len(self.buf) - len(self.buf)%16
+        if cut:
+            self.outf.write(self.cipher.decrypt(bytes(self.buf[:cut])))
+            del self.buf[:cut]
+
+    def _start(self):
+        # decide between CBC (with the iv up front) and legacy ECB, by which
+        # one yields a valid pad.  A pad of the exact form we write is
+        # preferred over one that only has a plausible length byte.
+        cbc = AES.new(self.key, AES.MODE_CBC, bytes(self.buf[:16]))
+        cbcblock = cbc.decrypt(bytes(self.buf[16:32])) \
+                if len(self.buf) >= 32 else b''
+        ecb = AES.new(self.key, AES.MODE_ECB)
+        ecbblock = ecb.decrypt(bytes(self.buf[:16]))
+        for strict in (True, False):
+            if cbcblock and _padlen(cbcblock, strict):
+                self.cipher = cbc
+                fpad = _padlen(cbcblock, strict)
+                del self.buf[:32]
+                self.outf.write(cbcblock[fpad:])
+                return
+            if _padlen(ecbblock, strict):
+                logger.info("decrypting legacy (ECB) data")
+                self.cipher = ecb
+                fpad = _padlen(ecbblock, strict)
+                del self.buf[:16]
+                self.outf.write(ecbblock[fpad:])
+                return
+        raise RuntimeError("unable to decrypt data: invalid padding length")
+
+    def close(self):
+        if self.cipher is None and len(self.buf) >= 16:
+            # short enough to have been legacy data without an iv
+            self._start()
+            self.write(b'')
+        if self.cipher is None or self.buf:
+            raise RuntimeError("unable to decrypt data: truncated")
+
 def pathsplit(fname):
     par, chld = os.path.split(fname)
     if chld == "":
@@ -120,6 +259,25 @@ def filemetadata(fname):
         'atim' : fstat[stat.ST_ATIME], 'mtim' : fstat[stat.ST_MTIME], 
         'ctim' : fstat[stat.ST_CTIME]} 
 
+def _addToManifest(config, entries):
+    """
+    Records each (filename, entry) pair in the local manifest, along with
+    entries for any of the files' parent dirs that aren't in it yet.
+    """
+    with config.manifest_lock:
+        for filename, entry in entries:
+            config.updateManifest(filename, entry)
+
+            # update entry for parent dirs
+            paths = pathsplit(filename)
+            for i in paths:
+                if not config.getFromManifest(i):
+                    config.updateManifest(i, filemetadata(i))
+
+        # XXX: not too efficient to write this out for every file.  consider
+        # local caching and periodic syncing instead
+        config.syncManifest()
+
 class StoreFile:
     """
     Implements the meta operations of storing, retrieving, and verifying files.
@@ -179,6 +337,8 @@ class StoreFile:
 
     # XXX: should follow this currentOps model for the other FludFileOps
     currentOps = {}
+    # FilePacker for each node, collecting small files to be stored together
+    packers = {}
 
     def __init__(self, node, filename):
         self.node = node
@@ -190,9 +350,6 @@ class StoreFile:
         self.routing = self.config.routing
         self.metadir = self.config.metadir
         self.parentcodedir = self.config.clientdir # XXX: clientdir?
-        # ask for code_m + X nodes (we prefer a pool slightly larger than
-        # code_m).  XXX: X=10 is magic
-        self.nodeChoices = self.config.getPreferredNodes(code_m+10)
         self.usedNodes = {}
 
         if _diag_enabled():
@@ -204,9 +361,33 @@ class StoreFile:
 
         # 1: create encryption key (eK) and storage key (sK).  Query DHT using
         #    sK
-        self.eK = hashfile(self.filename)
+        self.efilename = None
+        cached = await self._makeKeys()
         logger.debug(self.ctx("_storefile %s (%s)", self.filename, self.eK))
-        self.sK = int(hashstring(self.eK), 16)
+
+        # if the file hasn't changed since we last stored it, all that's left
+        # to do is make sure its metadata is still in the DHT
+        stored = self._storedEntry() if cached else None
+        if stored is not None:
+            meta = await self._findStoredMetadata(stored[0])
+            if meta is not None:
+                logger.info(self.ctx("%s unchanged and already stored",
+                        self.filename))
+                self._updateManifest((stored[0], int(time.time()))
+                        + tuple(stored[2:]))
+                return (fencode(stored[0]), meta)
+
+        # small files are stored together with others, in a pack
+        if self._packable():
+            return await self._packer().add(self.filename)
+
+        # pick erasure coding parameters for an object of this size, and ask
+        # for m + X nodes (we prefer a pool slightly larger than m).  XXX:
+        # X=10 is magic
+        self.k, self.n = self.config.getCoding(self._size())
+        self.m = self.k+self.n
+        self.nodeChoices = self.config.getPreferredNodes(self.m+10)
+
         self.eeK = self.Ku.encrypt(binascii.unhexlify(self.eK))
         self.eKeyIV = generateRandom(16)
         self.eKey = AES.new(binascii.unhexlify(self.eK), AES.MODE_CBC, self.eKeyIV)
@@ -214,7 +395,7 @@ class StoreFile:
         #       % (self.filename, self.eK, self.sK)))
 
         # 2: create filesystem metadata locally.
-        sbody = filemetadata(self.filename)
+        sbody = self._fsMetadata()
         sbody = fencode(sbody)
         if isinstance(sbody, str):
             sbody = sbody.encode("utf-8")
@@ -228,25 +409,17 @@ class StoreFile:
         fsMetadata = fencode({'eeK' : fencode(self.eeK[0]),
                 'meta' : fencode(self.eNodeFileMetadata)})
         if isinstance(fsMetadata, str):
-            fsMetadata_bytes = fsMetadata.encode("utf-8")
-        else:
-            fsMetadata_bytes = fsMetadata
+            fsMetadata = fsMetadata.encode("utf-8")
+        self.fsMetadata = fsMetadata
 
         # erasure code the metadata
-
-        # XXX: bad blocking stuff, move into thread
         self.flatname = fencode(generateRandom(16))
-        self.mfilename = os.path.join(self.metadir, self.flatname+appendFsMeta)
         self.encodedir = os.path.join(self.parentcodedir, self.flatname)
         try:
             os.mkdir(self.encodedir)
         except:
             raise RuntimeError("%s already requested" % self.filename)
-        # XXX: mfiles should be held in mem, as StringIOs (when coder supports
-        # this)
-        self.mfiles = fludfilefec.encode_to_files(BytesIO(fsMetadata_bytes),
-                len(fsMetadata_bytes), self.encodedir, self.mfilename,
-                code_k, code_m)
+        self.mfiles = await self._encodeFsMetadata(self.k, self.m)
 
         # XXX: piggybacking doesn't work with new metadata scheme, must fix it
         # to append metadata, or if already in progress, redo via verify ops
@@ -264,43 +437,39 @@ class StoreFile:
             result = await task
             return await self._piggybackStoreMetadata(result)
 
-        # 3: encrypt and encode the file locally.
-        self.efilename = os.path.join(self.metadir,self.flatname+appendEncrypt)
-        e = open(self.efilename, "wb+")
-        e.write(self.eKeyIV)
-        fd = os.open(self.filename, os.O_RDONLY)
-        fstat = os.fstat(fd)
-        fsize = fstat[stat.ST_SIZE]
-        # XXX: bad blocking stuff, move into thread
-        # create a pad at front of file to make it an even multiple of 16
-        fpad = int(16 - fsize%16);
-        #logger.debug(self.ctx("fsize=%d, padding with %d bytes" 
-        #       % (fsize, fpad)))
-        paddata = bytes([fpad]) + b'\x00'*(fpad-1)
-        buf = paddata + os.read(fd,16-len(paddata))
-        e.write(self.eKey.encrypt(buf));
-        # now write the rest of the file
-        while 1:
-            # XXX: can we do this in larger than 16-byte chunks?
-            buf = os.read(fd,16)
-            if buf == b"":
-                break
-            e.write(self.eKey.encrypt(buf));
-        #e.close()
-        elen = e.tell()
-        e.seek(0,0)
-        os.close(fd)
+        # 3: encrypt and encode the file locally, in a single streaming pass
+        #    (no intermediate encrypted copy of the file is written).  For
+        #    chunked files, the chunks are stored first and what gets encoded
+        #    is the list of chunks.
+        source = await self._source()
+        shares = await self.node.executor.run('encode', encrypt_and_encode,
+                source[0], self.eKey, self.eKeyIV, self.encodedir, 'c',
+                self.k, self.m, source[1], source[2])
+        #logger.debug(self.ctx("coded to: %s" % str(shares)))
+        await self.node.executor.run('encode', self._renameShares, shares)
+
+        # 4a: query DHT for metadata.
+        if _diag_enabled():
+            logger.warning(self.ctx("StoreFile dispatch kFindValue %s", fencode(self.sK)))
+        task = asyncio.create_task(self.node.client.k_find_value(self.sK))
+        self.currentOps[self.eK] = (task, 1)
+        try:
+            storedMetadata = await task
+        except Exception as exc:
+            self._storeFileErr(exc, "DHT query for metadata failed")
+        return await self._checkForExistingFileMetadata(storedMetadata)
 
-        # erasure code the file
-        # XXX: bad blocking stuff, move into thread
-        self.sfiles = fludfilefec.encode_to_files(e, elen, self.encodedir, 'c',
-                code_k, code_m)
-        #logger.debug(self.ctx("coded to: %s" % str(self.sfiles)))
-        # take hashes and rename coded blocks
+    async def _encodeFsMetadata(self, k, m):
+        # the metadata is small, so its shares (mfiles) are kept in memory
+        return await self.node.executor.run('encode',
+                fludfilefec.encode_to_buffers, self.fsMetadata, k, m)
+
+    def _renameShares(self, shares):
+        # rename coded blocks by their hashes
+        self.sfiles = []
         self.segHashesLocal = []
-        for i in range(len(self.sfiles)):
-            sfile = self.sfiles[i]
-            h = int(hashfile(sfile),16)
+        for i, (sfile, sharehash) in enumerate(shares):
+            h = int(sharehash, 16)
             logger.debug(self.ctx("file block %s hashes to %s", i, fencode(h)))
             destfile = os.path.join(self.encodedir,fencode(h))
             if os.path.exists(destfile):
@@ -308,22 +477,142 @@ class StoreFile:
             self.segHashesLocal.append(h)
             #logger.debug(self.ctx("moved %s to %s" % (sfile, destfile)))
             os.rename(sfile, destfile)
-            self.sfiles[i] = destfile
+            self.sfiles.append(destfile)
 
-            mfile = self.mfiles[i]
-            os.rename(mfile, destfile+".m")
-            self.mfiles[i] = destfile+".m"
+    async def _makeKeys(self):
+        """
+        Sets eK, sK, and whether the file is to be stored in chunks.  Returns
+        True if eK came from the hash cache (the file is unchanged since it
+        was last hashed).
+        """
+        self.eK = self.config.hashcache.lookup(self.filename)
+        cached = self.eK is not None
+        if not cached:
+            self.eK = await self.node.executor.run('hash',
+                    self.config.hashcache.hashfile, self.filename)
+        self.chunked = self.config.chunking and \
+                os.stat(self.filename).st_size > self.config.chunksizes[2]
+        if self.chunked:
+            # chunked files store a different object than unchunked ones with
+            # the same contents, so they mustn't share a storage key
+            self.sK = int(hashstring(self.eK+appendChunks), 16)
+        else:
+            self.sK = int(hashstring(self.eK), 16)
+        return cached
 
-        # 4a: query DHT for metadata.
-        if _diag_enabled():
-            logger.warning(self.ctx("StoreFile dispatch kFindValue %s", fencode(self.sK)))
-        task = asyncio.create_task(self.node.client.k_find_value(self.sK))
-        self.currentOps[self.eK] = (task, 1)
+    def _size(self):
+        return os.stat(self.filename).st_size
+
+    def _fsMetadata(self):
+        sbody = filemetadata(self.filename)
+        if self.chunked:
+            sbody['chunked'] = True
+        return sbody
+
+    async def _source(self):
+        """
+        Returns (filename, offset, length) of the data to be encrypted and
+        encoded (length None meaning to the end of the file).
+        """
+        if self.chunked:
+            return await self._storeChunks()
+        return (self.filename, 0, None)
+
+    async def _storeChunks(self):
+        """
+        Stores each distinct content-defined chunk of the file as its own
+        convergent object (reusing chunks that were already stored), and
+        writes the list of chunks to a temp file, which is what gets stored
+        in place of the file's contents.
+        """
+        minsize, avgsize, maxsize = self.config.chunksizes
+        # flatname differs on every run, so the hints are kept under a name
+        # derived from the file's path instead
+        hintfile = os.path.join(self.metadir, hashstring(
+            os.path.abspath(self.filename))+appendChunkHints)
+        previous = self._chunkHints(hintfile)
+        chunks = await self.node.executor.run_in_process('hash',
+                FludChunker.chunkfile, self.filename, minsize, avgsize,
+                maxsize, previous)
+        logger.info(self.ctx("%s split into %d chunks", self.filename,
+                len(chunks)))
+        with open(hintfile, 'w') as f:
+            f.write(fencode((list(self.config.chunksizes), chunks)))
+        unique = {}
+        for offset, length, eK in chunks:
+            unique.setdefault(eK, (offset, length))
+        sem = asyncio.Semaphore(MAXCHUNKOPS)
+        async def storeChunk(eK, offset, length):
+            async with sem:
+                return await StoreChunk(self.node, self.filename, offset,
+                        length, eK).run()
+        results = await asyncio.gather(*[storeChunk(eK, o, l)
+            for eK, (o, l) in unique.items()], return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(self.ctx("couldn't store chunk of %s: %s",
+                        self.filename, _failure_message(result)))
+                raise result
+        recipe = fencode([(int(hashstring(eK), 16), eK, length)
+            for offset, length, eK in chunks])
+        self.efilename = os.path.join(self.metadir, self.flatname+appendChunks)
+        with open(self.efilename, 'w') as f:
+            f.write(recipe)
+        return (self.efilename, 0, None)
+
+    def _chunkHints(self, hintfile):
+        """
+        Returns the chunk list recorded in hintfile, if it was made with the
+        currently configured chunk sizes, else None.
+        """
         try:
-            storedMetadata = await task
+            with open(hintfile) as f:
+                sizes, chunks = fdecode(f.read())
+        except FileNotFoundError:
+            return None
+        except Exception:
+            logger.warning(self.ctx("ignoring unreadable chunk hints in %s",
+                    hintfile))
+            return None
+        if list(sizes) != list(self.config.chunksizes):
+            return None
+        return chunks
+
+    def _storedEntry(self):
+        """
+        Returns the file's manifest entry if it records the file's current
+        contents as stored, else None.
+        """
+        entry = self.config.getFromManifest(self.filename)
+        if not isinstance(entry, (tuple, list)):
+            return None
+        if len(entry) > 2:
+            # packed file, see FilePacker
+            return entry if entry[2].get('eK') == self.eK else None
+        return entry if entry[0] == self.sK else None
+
+    def _packable(self):
+        manifest = os.path.join(self.metadir, self.config.manifest_name)
+        return self.config.packing and not self.chunked \
+                and self.filename != manifest \
+                and os.stat(self.filename).st_size <= self.config.packsizes[0]
+
+    def _packer(self):
+        packer = self.packers.get(self.node)
+        if packer is None:
+            packer = self.packers[self.node] = FilePacker(self.node)
+        return packer
+
+    async def _findStoredMetadata(self, sK):
+        try:
+            storedMetadata = await self.node.client.k_find_value(sK)
         except Exception as exc:
-            self._storeFileErr(exc, "DHT query for metadata failed")
-        return await self._checkForExistingFileMetadata(storedMetadata)
+            logger.info(self.ctx("DHT query for metadata failed: %s",
+                    str(exc)))
+            return None
+        if storedMetadata == None or isinstance(storedMetadata, dict):
+            return None
+        return fdecode(storedMetadata)
 
     # 4b: compare hashlists (locally encrypted vs. DHT -- if available).
     #     for lhash, dhash in zip(segHashesLocal, segHashesDHT):
@@ -349,13 +638,14 @@ class StoreFile:
 
     # 5a -- store all blocks
     async def _storeBlocksAsync(self, storedMetadata):
-        self.blockMetadata = {'k': code_k, 'n': code_n}
+        self.blockMetadata = {'k': self.k, 'n': self.n}
         coros = []
         for i in range(len(self.segHashesLocal)):
             blockhash = self.segHashesLocal[i]
             sfile = self.sfiles[i]
             coros.append(
-                self._storeBlockAsync(i, blockhash, sfile, self.mfiles[i])
+                self._storeBlockAsync(i, blockhash, sfile,
+                    BytesIO(self.mfiles[i]))
             )
         logger.debug(self.ctx("_storeBlocksAll"))
         results = await asyncio.gather(*coros, return_exceptions=True)
@@ -368,7 +658,7 @@ class StoreFile:
     async def _storeBlockAsync(self, i, hash, sfile, mfile, retry=2):
         if not self.nodeChoices:
             self.nodeChoices = self.config.getPreferredNodes(
-                code_k, list(self.usedNodes.keys()))
+                self.k, list(self.usedNodes.keys()))
             logger.warning(self.ctx("asked for more nodes, %d nodes found",
                 len(self.nodeChoices)))
         if not self.nodeChoices:
@@ -382,7 +672,6 @@ class StoreFile:
         location = int(nKu.id(), 16)
         logger.info(self.ctx("STOREing under %s on %s:%d", fencode(hash),
             host, port))
-        logger.debug(self.ctx("mfile is %s", mfile))
         try:
             result = await self.node.client.store(
                 sfile, (self.mkey, mfile), host, port, nKu)
@@ -478,8 +767,7 @@ class StoreFile:
         self.blockMetadata = storedMetadata
         coros = []
         for i, sfile in enumerate(self.sfiles):
-            with open(self.mfiles[i], "rb") as f:
-                mfile = BytesIO(f.read())
+            mfile = BytesIO(self.mfiles[i])
             seg = os.path.basename(sfile)
             segl = fdecode(seg)
             nID = self.blockMetadata[(i, segl)]
@@ -496,7 +784,7 @@ class StoreFile:
 
     async def _verifyBlockChain(self, i, sfile, mfile, seg, segl, nID, noopVerify):
         try:
-            kdata = await self.node.client.k_find_node(nID)
+            kdata = await self.node.client.resolve_node(nID)
         except Exception as exc:
             self.config.modifyReputation(nID, TrustDeltas.VRFY_FAIL)
             self._storeFileErr(exc, "couldn't find node %s... for VERIFY"
@@ -513,6 +801,13 @@ class StoreFile:
         stores where encryption is non-deterministic).
         """
         self.blockMetadata = storedMetadata
+        k, n = storedMetadata['k'], storedMetadata['n']
+        if (k, n) != (self.k, self.n):
+            # the blocks were stored with different coding, so the metadata
+            # shares attached to them need to be too
+            logger.info(self.ctx("recoding metadata as %d/%d to match "
+                    "stored blocks", k, n))
+            self.mfiles = await self._encodeFsMetadata(k, k+n)
         coros = []
         for key in storedMetadata:
             if not isinstance(key, tuple) or len(key) != 2:
@@ -521,20 +816,17 @@ class StoreFile:
             nID = storedMetadata[key]
             if isinstance(nID, list):
                 nID = random.choice(nID)
-            try:
-                with open(self.mfiles[i], "rb") as f:
-                    mfile = BytesIO(f.read())
-            except Exception as exc:
-                logger.warning(self.ctx("failed to read metadata share %s: %s",
-                        i, str(exc)))
+            if i >= len(self.mfiles):
+                logger.warning(self.ctx("no metadata share %s", i))
                 continue
+            mfile = BytesIO(self.mfiles[i])
             coros.append(self._attachMetadataChain(nID, segl, mfile))
         await asyncio.gather(*coros, return_exceptions=True)
         return self._updateMaster(None, storedMetadata)
 
     async def _attachMetadataChain(self, nID, segl, mfile):
         try:
-            kdata = await self.node.client.k_find_node(nID)
+            kdata = await self.node.client.resolve_node(nID)
             return await self._sendMetadataVerifyAsync(kdata, segl, mfile, nID)
         except Exception as exc:
             self._attachMetadataErr(exc, nID, segl)
@@ -561,6 +853,7 @@ class StoreFile:
         logger.warning(self.ctx("couldn't attach metadata to %s: %s",
                 fencode(segl), _failure_message(failure)))
         self.config.modifyReputation(nID, TrustDeltas.VRFY_FAIL)
+        self.node.client.report_failure(nID, failure)
         return failure
 
     # 5c -- verify all blocks, store any that fail verify.
@@ -615,6 +908,7 @@ class StoreFile:
     async def _checkVerifyErrAsync(self, failure, nID, i, seg, sfile, mfile,
             hash):
         self.config.modifyReputation(nID, TrustDeltas.VRFY_FAIL)
+        self.node.client.report_failure(nID, failure)
         logger.debug(self.ctx("Couldn't VERIFY: %s", _failure_message(failure)))
         logger.info(self.ctx("Couldn't VERIFY %s, performing STORE",
             fencode(seg)))
@@ -637,29 +931,11 @@ class StoreFile:
         # clean up locally coded files and encrypted file
         for sfile in self.sfiles:
             os.remove(sfile)
-        for mfile in self.mfiles:
-            os.remove(mfile)
         if self.encodedir: os.rmdir(self.encodedir)
         if self.efilename: os.remove(self.efilename)
 
         key = fencode(self.sK)
-        logger.info(self.ctx("updating local manifest with %s", key))
-
-        # store the filekey locally
-
-        # update entry for file
-        with self.config.manifest_lock:
-            self.config.updateManifest(self.filename, (self.sK, int(time.time())))
-
-            # update entry for parent dirs
-            paths = pathsplit(self.filename)
-            for i in paths:
-                if not self.config.getFromManifest(i):
-                    self.config.updateManifest(i, filemetadata(i))
-
-            # XXX: not too efficient to write this out for every file.  consider
-            # local caching and periodic syncing instead
-            self.config.syncManifest()
+        self._updateManifest()
 
         # cache the metadata locally (optional)
         fname = os.path.join(self.metadir,key)
@@ -670,9 +946,6 @@ class StoreFile:
         m.write(mdata)
         m.close()
 
-        # clean up fs metadata file
-        #os.remove(self.mfilename)
-
         #return fencode(self.sK)
         if self.eK not in self.currentOps:
             logger.warning(self.ctx("no %s in currentOps for StoreFile", self.eK))
@@ -688,6 +961,13 @@ class StoreFile:
             self.currentOps[self.eK] = (d, counter)
         return (key, meta)
         
+    def _updateManifest(self, entry=None):
+        if entry is None:
+            entry = (self.sK, int(time.time()))
+        logger.info(self.ctx("updating local manifest with %s",
+                fencode(entry[0])))
+        _addToManifest(self.config, [(self.filename, entry)])
+
     def _storeFileErr(self, failure, message, raiseException=True, 
             functor=None):
         if functor:
@@ -710,6 +990,182 @@ class StoreFile:
             raise failure
 
 
+class StoreChunk(StoreFile):
+    """
+    Stores one content-defined chunk of a file (length bytes at offset) as a
+    convergent object of its own, exactly as StoreFile would store a file
+    with those contents.  eK is the hash of the chunk.  Chunks don't get
+    manifest entries; a chunk this node has already stored (and whose
+    metadata it therefore has cached) is reused if the DHT still has it.
+    """
+
+    def __init__(self, node, filename, offset, length, eK):
+        StoreFile.__init__(self, node, filename)
+        # chunks may be shared between files, so their metadata is keyed by
+        # the chunk rather than by the filename
+        self.mkey = _crc32_value(eK)
+        self.ctx = Ctx(self.mkey).msg
+        self.offset = offset
+        self.length = length
+        self.chunkeK = eK
+
+    async def _makeKeys(self):
+        self.eK = self.chunkeK
+        self.chunked = False
+        self.sK = int(hashstring(self.eK), 16)
+        return True
+
+    def _size(self):
+        return self.length
+
+    def _fsMetadata(self):
+        return {'chunk': self.length}
+
+    def _storedEntry(self):
+        if os.path.exists(os.path.join(self.metadir, fencode(self.sK))):
+            return (self.sK,)
+        return None
+
+    def _packable(self):
+        return False
+
+    def _updateManifest(self, entry=None):
+        pass
+
+    async def _source(self):
+        return (self.filename, self.offset, self.length)
+
+
+class FilePacker:
+    """
+    Stores small files together in packs.  Files handed to add() within
+    PACKFILE_TO seconds of each other (or until packsize bytes of them have
+    been collected) are concatenated into a temp pack file, which is stored
+    as a single object, exactly as StoreChunk stores a chunk.  This saves
+    each small file from costing its own set of block stores and DHT
+    metadata record.
+
+    Each packed file gets a manifest entry of (pack sK, time, packinfo),
+    where packinfo is a dict of the pack's eK ('pack'), the file's 'offset'
+    and 'length' within the pack, the file's own 'eK', and the rest of its
+    filemetadata().  The manifest entry is all that is needed to get the
+    file back (see RetrievePacked).
+    """
+
+    def __init__(self, node):
+        self.node = node
+        self.config = node.config
+        self.pending = []
+        self.size = 0
+        self.timer = None
+        self.tasks = set()
+
+    async def add(self, filename):
+        """
+        Adds filename to the pack being collected.  Returns (key, meta) of
+        the pack once it has been stored.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((filename, future))
+        self.size += os.stat(filename).st_size
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if self.size >= self.config.packsizes[1]:
+            self._flush()
+        else:
+            self.timer = loop.call_later(PACKFILE_TO, self._flush)
+        return await future
+
+    def _flush(self):
+        self.timer = None
+        batch, self.pending, self.size = self.pending, [], 0
+        if batch:
+            task = asyncio.ensure_future(self._storePack(batch))
+            self.tasks.add(task)
+            task.add_done_callback(lambda t: self._stored(t, batch))
+
+    def _stored(self, task, batch):
+        # collect the task's outcome, so that an error escaping _storePack()
+        # reaches the files' callers instead of going unseen
+        self.tasks.discard(task)
+        if task.cancelled():
+            for filename, future in batch:
+                future.cancel()
+            return
+        exc = task.exception()
+        if exc is not None:
+            logger.error("couldn't store pack of %d files: %s"
+                    % (len(batch), _failure_message(exc)))
+            for filename, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+
+    async def _storePack(self, batch):
+        try:
+            packfile, eK, length, members = await self.node.executor.run(
+                    'hash', self._writePack, [f for f, future in batch])
+            try:
+                if members:
+                    key, meta = await StoreChunk(self.node, packfile, 0,
+                            length, eK).run()
+            finally:
+                os.remove(packfile)
+        except Exception as exc:
+            logger.error("couldn't store pack of %d files: %s"
+                    % (len(batch), _failure_message(exc)))
+            for filename, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+        if members:
+            logger.info("stored %d files in pack %s" % (len(members), key))
+            sK = int(hashstring(eK), 16)
+            now = int(time.time())
+            _addToManifest(self.config, [(filename, (sK, now, packinfo))
+                for filename, packinfo in members.items()])
+        for filename, future in batch:
+            if future.done():
+                continue
+            if filename in members:
+                future.set_result((key, meta))
+            else:
+                future.set_exception(IOError("couldn't pack %s" % filename))
+
+    def _writePack(self, filenames):
+        """
+        Concatenates filenames into a temp pack file.  Returns the pack's
+        filename, eK, and length, and a dict of packinfo for each of
+        filenames that could be read.
+        """
+        packfile = os.path.join(self.config.metadir,
+                fencode(generateRandom(16))+appendPack)
+        members = {}
+        offset = 0
+        with open(packfile, 'wb') as pack:
+            for filename in filenames:
+                if filename in members:
+                    continue
+                try:
+                    packinfo = filemetadata(filename)
+                    with open(filename, 'rb') as f:
+                        data = f.read()
+                except OSError as err:
+                    logger.warning("couldn't pack %s: %s" % (filename, err))
+                    continue
+                del packinfo['path']
+                packinfo.update({'offset': offset, 'length': len(data),
+                    'eK': hashstring(data)})
+                pack.write(data)
+                members[filename] = packinfo
+                offset += len(data)
+        eK = hashfile(packfile)
+        for packinfo in members.values():
+            packinfo['pack'] = eK
+        return packfile, eK, offset, members
+
+
 class RetrieveFile:
     """
     Uses the given storage key to retrieve a file.  The storage key is used
@@ -718,6 +1174,9 @@ class RetrieveFile:
     until the complete file can be regenerated and saved locally.
     """
 
+    # recent block fetch times, across all retrieves (see _hedgeDelay)
+    latencies = collections.deque(maxlen=LATENCYSAMPLES)
+
     def __init__(self, node, key, mkey=True):
         # 1: Query DHT for sK
         # 2: Retrieve entries for sK, decoding until efile can be regenerated
@@ -735,6 +1194,11 @@ class RetrieveFile:
         self.routing = self.config.routing.knownNodes()
         self.metadir = self.config.metadir
         self.parentcodedir = self.config.clientdir
+        # blocks are fetched into a directory of this retrieve's own, so
+        # that concurrent retrieves of the same key (e.g., of a pack or chunk
+        # shared by several files) don't overwrite each other's blocks
+        self.blockdir = None
+        self.k, self.n = code_k, code_n
         self.numBlocksRetrieved = 0
         self.blocks = {}
         self.fsmetas = {}
@@ -746,7 +1210,11 @@ class RetrieveFile:
         self.retry_base_delay = 1
 
     async def run(self):
-        return await self._retrieveFileAsync()
+        self.blockdir = tempfile.mkdtemp(dir=self.parentcodedir)
+        try:
+            return await self._retrieveFileAsync()
+        finally:
+            shutil.rmtree(self.blockdir, ignore_errors=True)
 
     async def _retrieveFileAsync(self):
         logger.debug(self.ctx("querying DHT for %s", self.sK))
@@ -776,17 +1244,17 @@ class RetrieveFile:
             raise LookupError("couldn't recover metadata for %s" % self.sK)
         k = self.meta.pop('k')
         n = self.meta.pop('n')
+        if not (0 < k and 0 <= n and k+n <= 256):
+            raise ValueError("unsupported coding scheme %d/%d" % (k, n))
+        self.k, self.n = k, n
         logger.debug(self.ctx("metadata entries (post k/n): %d", len(self.meta)))
-        if len(self.meta) < code_k:
+        if len(self.meta) < self.k:
             logger.warning(self.ctx(
                 "metadata has %d blocks; need %d, retrying",
-                len(self.meta), code_k))
+                len(self.meta), self.k))
             return await self._schedule_retry_async(
                 "insufficient metadata blocks (%d < %d)"
-                % (len(self.meta), code_k))
-        if k != code_k or n != code_n:
-            # XXX: 
-            raise ValueError("unsupported coding scheme %d/%d" % (k, n))
+                % (len(self.meta), self.k))
         if self.bad_nodes:
             removed = 0
             for key in list(self.meta.keys()):
@@ -819,7 +1287,7 @@ class RetrieveFile:
                     len(keys), preview))
         logger.info(self.ctx("got metadata %s" % self.meta))
         self.decoded = False
-        return await self._getSomeBlocksAsync(code_k)
+        return await self._getSomeBlocksAsync()
 
     def _orderNodes(self, meta):
         def score(k, node):
@@ -853,38 +1321,17 @@ class RetrieveFile:
         r.sort(key=lambda item: item[1], reverse=True)
         return [item[0] for item in r]
 
-    async def _getSomeBlocksAsync(self, reqs=code_k):
-        tries = 0
-        total = len(self.meta)
-        if reqs > len(self.meta):
-            reqs = len(self.meta)
-        logger.info(self.ctx("requesting %d blocks from %d available",
-                reqs, total))
-        coros = []
-        logger.debug(self.ctx("about to order nodes"))
-        keys = self._orderNodes(self.meta)
-        unique_keys = []
-        seen_indices = set()
-        for key in keys:
-            idx = key[0]
-            if idx in self.block_indices or idx in self.requested_indices:
-                continue
-            if idx in seen_indices:
-                continue
-            seen_indices.add(idx)
-            unique_keys.append(key)
-        if len(unique_keys) < reqs:
-            logger.debug(self.ctx(
-                "only %d unique share indices available for request",
-                len(unique_keys)))
-            reqs = len(unique_keys)
-        keys = unique_keys
-        logger.debug(self.ctx("keys are now: %s" % str(keys)))
-        for i in range(reqs):
-            #c = random.choice(self.meta.keys())
-            choice = keys.pop(0)
+    def _nextBlock(self):
+        """
+        Picks the best ranked block whose share index hasn't already been
+        retrieved or requested, and a location to get it from.  Returns
+        (block, id, idx), or None if there are none left to try.
+        """
+        for choice in self.ranked:
             idx = choice[0]
-            logger.info(self.ctx("choice is %s" % str(choice)))
+            if choice not in self.meta or idx in self.block_indices \
+                    or idx in self.requested_indices:
+                continue
             block = fencode(choice[1])
             if block in self.blocks:
                 logger.debug(self.ctx("skipping duplicate block %s", block))
@@ -894,38 +1341,103 @@ class RetrieveFile:
             if isinstance(id, list):
                 logger.info(self.ctx(
                     "multiple location choices, choosing one randomly."))
+                # if the chosen one fails, the others are tried in turn
                 id = random.choice(id)
-                # If the chosen one fails, try each of the others until
-                # it works or exhausts the list (thus the keys.insert bit)
                 self.meta[choice].remove(id)
                 if len(self.meta[choice]) == 0:
-                    #self.meta.pop(choice)
-                    pass
-                else:
-                    keys.insert(0,choice)
+                    self.meta.pop(choice)
             else:
-                #self.meta.pop(choice)
-                pass
-            logger.info(self.ctx("retrieving %s from %s" % (block, id)))
-            # look up nodes by id, then do a retrieve.
+                self.meta.pop(choice)
             self.requested_indices.add(idx)
-            coros.append(self._retrieveBlockChain(block, id, idx))
-            self.meta.pop(choice)
-            tries = tries + 1
-            if tries >= reqs:
-                break;
-        results = await asyncio.gather(*coros, return_exceptions=True)
-        normalized = []
-        for result in results:
-            if isinstance(result, Exception):
-                normalized.append((False, result))
-            else:
-                normalized.append((True, result))
-        return await self._retrievedAll(normalized)
+            return block, id, idx
+        return None
+
+    def _hedgeDelay(self):
+        """
+        Returns how long a block fetch may take before another is started
+        alongside it (the configured percentile of recent block fetch
+        times), or None if fetches aren't to be hedged.
+        """
+        percentile = self.config.hedging[1]
+        if not percentile or len(self.latencies) < MINLATENCYSAMPLES:
+            return None
+        samples = sorted(self.latencies)
+        return samples[min(len(samples)-1, len(samples)*percentile // 100)]
+
+    async def _getSomeBlocksAsync(self, reqs=None):
+        """
+        Fetches blocks until k distinct shares have been retrieved.  reqs
+        fetches (by default, k plus the configured number of extra ones) are
+        started at once, from the best ranked nodes.  Another is started
+        whenever one fails and too few are left outstanding to make up k,
+        and whenever one has been outstanding for longer than most recent
+        fetches took (see _hedgeDelay).  As soon as k shares are in, any
+        fetches still outstanding are cancelled.
+        """
+        if reqs is None:
+            reqs = self.k+self.config.hedging[0]
+        logger.info(self.ctx("requesting %d blocks from %d available",
+                min(reqs, len(self.meta)), len(self.meta)))
+        self.ranked = self._orderNodes(self.meta)
+        loop = asyncio.get_running_loop()
+        pending = {}
+        hedged = set()
+
+        def fetch():
+            choice = self._nextBlock()
+            if choice is None:
+                return False
+            block, id, idx = choice
+            logger.info(self.ctx("retrieving %s from %s" % (block, id)))
+            task = asyncio.ensure_future(
+                    self._retrieveBlockChain(block, id, idx))
+            pending[task] = loop.time()
+            return True
+
+        for i in range(reqs):
+            if not fetch():
+                break
+        try:
+            while pending and self.numBlocksRetrieved < self.k:
+                delay = self._hedgeDelay()
+                timeout = None
+                unhedged = [pending[t] for t in pending if t not in hedged]
+                if delay is not None and unhedged:
+                    timeout = max(0, min(unhedged)+delay-loop.time())
+                done, _ = await asyncio.wait(pending, timeout=timeout,
+                        return_when=asyncio.FIRST_COMPLETED)
+                now = loop.time()
+                for task in done:
+                    started = pending.pop(task)
+                    hedged.discard(task)
+                    if task.exception() is not None:
+                        logger.info(self.ctx("block fetch failed: %s",
+                                _failure_message(task.exception())))
+                    elif task.result():
+                        self.latencies.append(now-started)
+                # replace failed fetches
+                while len(pending) < self.k-self.numBlocksRetrieved:
+                    if not fetch():
+                        break
+                # hedge slow ones
+                if delay is not None and self.numBlocksRetrieved < self.k:
+                    for task in list(pending):
+                        if task not in hedged and now-pending[task] >= delay:
+                            hedged.add(task)
+                            if fetch():
+                                logger.info(self.ctx(
+                                        "hedging block fetch slower than %.2fs",
+                                        delay))
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+        return await self._retrievedAll()
 
     async def _retrieveBlockChain(self, block, id, idx):
         try:
-            kdata = await self.node.client.k_find_node(id)
+            kdata = await self.node.client.resolve_node(id)
         except Exception as exc:
             self._findNodeErr(exc,
                     "couldn't find node %s for block %s" % (fencode(id), block),
@@ -959,7 +1471,7 @@ class RetrieveFile:
         if not self.decoded:
             try:
                 msg = await self.node.client.retrieve(
-                    block, host, port, nKu, self.mkey)
+                    block, host, port, nKu, self.mkey, self.blockdir)
             except Exception as exc:
                 return self._retrieveBlockErr(
                     exc, id, "couldn't get block %s from %s" % (
@@ -991,56 +1503,116 @@ class RetrieveFile:
     def _retrieveBlockErr(self, failure, nID, message, host, port, id, idx):
         logger.info(self.ctx("%s: %s" % (message, _failure_message(failure))))
         self.config.modifyReputation(nID, TrustDeltas.GET_FAIL)
+        self.node.client.report_failure(nID, failure)
         self.requested_indices.discard(idx)
         self.bad_nodes.add(id)
         # don't propogate the error -- one block doesn't cause the file
         # retrieve to fail.
 
-    async def _retrievedAll(self, success):
-        logger.info(self.ctx("tried retreiving %d blocks %s" 
-            % (len(success), success)))
-        logger.info(self.ctx("retrieved %d/%d blocks so far",
-                self.numBlocksRetrieved, code_k))
-        if self.numBlocksRetrieved >= code_k:
+    async def _retrievedAll(self):
+        logger.info(self.ctx("retrieved %d/%d blocks",
+                self.numBlocksRetrieved, self.k))
+        if self.numBlocksRetrieved >= self.k:
             # XXX: need to make this try again with other blocks if decode
             # fails
             return await self._decodeDataAsync()
-        elif len(self.meta) > 0:
-            tries = 3  # XXX: magic number. Should derive from k & m 
-            logger.info(self.ctx("requesting %d more blocks" % tries))
-            return await self._getSomeBlocksAsync(tries) 
-        else:
-            logger.info(self.ctx("couldn't decode file after retreiving"
-                    " all %d available blocks" % self.numBlocksRetrieved))
-            return await self._schedule_retry_async(
-                "couldn't decode file after retreiving all %d available blocks"
-                % self.numBlocksRetrieved)
+        logger.info(self.ctx("couldn't decode file after retreiving"
+                " all %d available blocks" % self.numBlocksRetrieved))
+        return await self._schedule_retry_async(
+            "couldn't decode file after retreiving all %d available blocks"
+            % self.numBlocksRetrieved)
 
     async def _decodeDataAsync(self):
-        self.fname = os.path.join(self.parentcodedir,fencode(self.sK))+".rec1"
-        decoded = await asyncio.to_thread(
-            self.decodeData, self.fname, list(self.blocks.values()),
-            self.config.clientdir
-        )
-        return await self._decodeFsMetadataAsync(decoded, self.blocks)
+        # 3: decode and decrypt the fs metadata to find eK and where the file
+        #    goes, then decode and decrypt the file data, in one streaming
+        #    pass, to a temp file next to its destination.
+        fmeta, eK = await self.node.executor.run('decode',
+                self._decodeFsMetadata)
+        recfile = None
+        try:
+            if fmeta.get('chunked'):
+                recipe = BytesIO()
+                await self.node.executor.run('decode', self._decodeFile, eK,
+                        recipe)
+                recfile = self._recFile(fmeta)
+                await self._retrieveChunks(fdecode(recipe.getvalue()),
+                        recfile)
+            else:
+                recfile = self._recFile(fmeta)
+                await self.node.executor.run('decode', self._decodeToFile,
+                        eK, recfile)
+        except BaseException:
+            if recfile and os.path.exists(recfile):
+                os.remove(recfile)
+            raise
+        return await self.node.executor.run('decrypt',
+                self._restoreFile, fmeta, eK, recfile)
+
+    def _decodeFsMetadata(self):
+        mbuf = BytesIO()
+        self.decodeData(mbuf, list(self.fsmetas.values()), self.blockdir)
+        logger.info(self.ctx("successfully decoded metadata (retrieved %d "
+                "blocks -- all but %d blocks tried)", self.numBlocksRetrieved,
+                len(self.meta)))
+        return self._decryptMeta(mbuf.getvalue())
+
+    def _decodeFile(self, eK, outf):
+        writer = DecryptingWriter(eK, outf)
+        self.decodeData(writer, list(self.blocks.values()), self.blockdir)
+        writer.close()
+
+    def _decodeToFile(self, eK, outfname):
+        with open(outfname, 'wb') as outf:
+            self._decodeFile(eK, outf)
+
+    async def _retrieveChunks(self, chunks, outfname):
+        """
+        The data just recovered for a chunked file is its list of chunks.
+        Retrieves each distinct chunk and reassembles the file contents in
+        outfname.
+        """
+        unique = dict((sK, eK) for sK, eK, length in chunks)
+        logger.info(self.ctx("retrieving %d chunks (%d distinct)",
+                len(chunks), len(unique)))
+        sem = asyncio.Semaphore(MAXCHUNKOPS)
+        async def retrieveChunk(sK, eK):
+            async with sem:
+                return await RetrieveChunk(self.node, sK, eK).run()
+        results = await asyncio.gather(*[retrieveChunk(sK, eK)
+            for sK, eK in unique.items()], return_exceptions=True)
+        chunkfiles = {}
+        for sK, result in zip(unique, results):
+            if isinstance(result, Exception):
+                for fname in chunkfiles.values():
+                    os.remove(fname)
+                raise result
+            chunkfiles[sK] = result
+        await self.node.executor.run('decrypt', self._assembleChunks,
+                outfname, [(chunkfiles[sK], length)
+                    for sK, eK, length in chunks])
 
-    async def _decodeFsMetadataAsync(self, decoded, blockname):
-        self.mfname = os.path.join(self.parentcodedir,fencode(self.sK))+".m"
-        metadecoded = await asyncio.to_thread(
-            self.decodeData, self.mfname, list(self.fsmetas.values()),
-            self.config.clientdir
-        )
-        return self._decodeDone(decoded, metadecoded)
+    def _assembleChunks(self, outfname, chunkfiles):
+        try:
+            with open(outfname, 'wb') as outf:
+                for fname, length in chunkfiles:
+                    with open(fname, 'rb') as f:
+                        shutil.copyfileobj(f, outf)
+        finally:
+            for fname in set(f for f, length in chunkfiles):
+                os.remove(fname)
 
-    def decodeData(self, outfname, datafnames, datadir=None):
-        logger.info(self.ctx("decoding %s to %s" % (datafnames, outfname)))
-        outf = None
+    def decodeData(self, outf, datafnames, datadir=None):
+        """
+        Decodes the share files datafnames (in datadir) and writes the result
+        to the file-like object outf.  The share files are removed once
+        decoded.
+        """
+        logger.info(self.ctx("decoding %s" % datafnames))
         data = []
         seen = set()
         result = None
         is_meta = any(os.path.basename(n).endswith(".meta") for n in datafnames)
         try:
-            outf = open(outfname, 'wb')
             header_info = []
             header_errors = []
             unique_by_shnum = {}
@@ -1100,14 +1672,14 @@ class RetrieveFile:
                 if fname in seen:
                     continue
                 seen.add(fname)
-                if len(data) >= code_m:
+                if len(data) >= self.k+self.n:
                     break
                 data.append(open(fname, 'rb'))
-            with _decode_lock:
-                result = fludfilefec.decode_from_files(outf, data)
+            # each decode gets its own zfec decoder, which releases the GIL
+            # while it works, so decodes run in parallel on the worker pool
+            # (as many at once as the 'decode' stage limit allows)
+            result = fludfilefec.decode_from_files(outf, data)
         finally:
-            if outf is not None:
-                outf.close()
             for f in data:
                 f.close()
         if result: 
@@ -1149,47 +1721,33 @@ class RetrieveFile:
         await asyncio.sleep(delay)
         return await self._retrieveFileAsync()
 
-    def _decodeDone(self, decoded, metadecoded):
-        if not self.decoded and decoded and metadecoded:
-            logger.info(self.ctx("successfully decoded (retrieved %d blocks --"
-                    " all but %d blocks tried)" % (self.numBlocksRetrieved, 
-                        len(self.meta))))
-            return self._decryptMeta() 
-        else:
-            logger.info(self.ctx("decoded=%s, mdecoded=%s" % (decoded, 
-                metadecoded)))
-            raise RuntimeError("decode error after retreiving %d blocks: "
-                    "decoded=%s, mdecoded=%s" % (
-                        self.numBlocksRetrieved, decoded, metadecoded))
-
-    def _decryptMeta(self):
-        # XXX: decrypt the metadatafile with Kr to get all the nmeta stuff (eeK
-        # etc.)
-        #mfile = open(os.path.join(self.parentcodedir, fencode(self.sK)+".m"))
-        mfile = open(self.mfname, 'rb')
-        meta = mfile.read()
-        mfile.close()
-        logger.info(self.ctx("meta is %s" % str(meta)))
+    def _decryptMeta(self, meta):
+        """
+        Returns (fmeta, eK) from the decoded flud file metadata meta: eK
+        from decrypting eeK with Kr, and the fs metadata from decrypting the
+        rest.
+        """
+        logger.debug(self.ctx("meta is %s" % str(meta)))
         try:
             self.nmeta = fdecode(meta)
         except Exception as exc:
-            logger.warning(self.ctx("failed to decode metadata: %s", str(exc)))
-            try:
-                os.remove(self.mfname)
-            except Exception:
-                pass
-            return self._schedule_retry("metadata decode failed")
-        os.remove(self.mfname)
-        return self._decryptFile()
-    
-    def _decryptFile(self):
-        # 3: Retrieve eK from sK by eK=Kr(eeK).  Use eK to decrypt file.  Strip
-        #    off leading pad.
-        skey = fencode(self.sK)
-        rec1 = os.path.join(self.parentcodedir, skey+".rec1")
-        rec2 = os.path.join(self.parentcodedir, skey+".rec2")
-        f1 = open(rec1, "rb")
-        f2 = open(rec2, "wb")
+            raise ValueError("failed to decode metadata: %s" % str(exc))
+        eK = self._recoverEK()
+        efmeta = fdecode(self.nmeta['meta'])
+        if hasattr(self.Kr, "size_in_bytes"):
+            cryptSize = self.Kr.size_in_bytes()
+        else:
+            cryptSize = (self.Kr.size() + 1) // 8
+        fmeta_bytes = b""
+        for i in range(0, len(efmeta), cryptSize):
+            chunk = self.Kr.decrypt(efmeta[i:i+cryptSize])
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            fmeta_bytes += chunk
+        fmeta = fdecode(fmeta_bytes)
+        return fmeta, eK
+
+    def _recoverEK(self):
         #logger.info(self.ctx("decoding nmeta eeK for %s" % dir(self)))
         eeK = fdecode(self.nmeta['eeK'])
         # d_eK business is to ensure that eK is zero-padded to 32 bytes
@@ -1201,76 +1759,38 @@ class RetrieveFile:
         eK = binascii.hexlify(d_eK)
         if isinstance(eK, bytes):
             eK = eK.decode("ascii")
-        iv = f1.read(16)
-        eKey = AES.new(binascii.unhexlify(eK), AES.MODE_CBC, iv)
-        # XXX: bad blocking stuff, move into thread
-        while 1:
-            buf = f1.read(16)
-            if buf == b"":
-                break;
-            f2.write(eKey.decrypt(buf))
-        f1.close()
-        f2.close()
-        f2 = open(rec2, "rb")
-        first_byte = f2.read(1)
-        if not first_byte:
-            padlen = -1
-        else:
-            padlen = first_byte[0] - 1
-        if padlen < 0 or padlen > 15:
-            # Fall back to legacy ECB if we detect invalid padding (old data)
-            f2.close()
-            f2 = open(rec2, "wb")
-            f1 = open(rec1, "rb")
-            legacyKey = AES.new(binascii.unhexlify(eK), AES.MODE_ECB)
-            while 1:
-                buf = f1.read(16)
-                if buf == b"":
-                    break
-                f2.write(legacyKey.decrypt(buf))
-            f1.close()
-            f2.close()
-            f2 = open(rec2, "rb")
-            first_byte = f2.read(1)
-            if not first_byte:
-                padlen = -1
-            else:
-                padlen = first_byte[0] - 1
-        if padlen < 0 or padlen > 15:
-            f2.close()
-            raise RuntimeError("unable to decrypt data: invalid padding length")
-        f3 = open(os.path.join(self.parentcodedir,skey+".rec3"), "wb")
-        #print "%s" % repr(padlen)
-        #print "throwing away %d pad bytes" % padlen
-        pad = f2.read(padlen) # throw away pad.
-        while 1:
-            buf = f2.read(16)
-            if buf == b"":
-                break;
-            f3.write(buf)
-        f2.close()
-        f3.close()
-        os.remove(rec1)
-        os.remove(rec2)
+        return eK
 
+    def _recFile(self, fmeta):
+        """
+        Returns the name of a temp file to recover the file's data to, in
+        the same directory as its destination so that it can be renamed
+        into place.
+        """
+        self._makeParents(fmeta['path'])
+        return os.path.join(os.path.dirname(fmeta['path']),
+                ".%s.rec" % fencode(generateRandom(8)))
+
+    def _makeParents(self, path):
+        # recover parent directories if not present
+        paths = pathsplit(path)
+        for i in paths:
+            if not os.path.exists(i) and i != path:
+                os.mkdir(i) # best effort dir creation, even if missing
+                            # directory metadata
+                # XXX: should be using an accessor method on config for
+                # manifest
+                if i in self.config.manifest:
+                    dirmeta = self.config.getFromManifest(i)
+                    os.chmod(i,dirmeta['mode']) 
+                    os.chown(i,dirmeta['uid'],dirmeta['gid']) # XXX: windows
+                    # XXX: atim, mtim, ctim
+                # XXX: should try to make sure we can write to dir, change
+                # perms if necessary.
+
+    def _restoreFile(self, fmeta, eK, recfile):
         # 4: Move file to its correct path, imbue it with properties from 
         #    metadata.
-        # XXX: should we make sure we can read metadata before downloading all
-        #      the file data?
-        #print "decoding nmeta meta"
-        efmeta = fdecode(self.nmeta['meta'])
-        if hasattr(self.Kr, "size_in_bytes"):
-            cryptSize = self.Kr.size_in_bytes()
-        else:
-            cryptSize = (self.Kr.size() + 1) // 8
-        fmeta_bytes = b""
-        for i in range(0, len(efmeta), cryptSize):
-            chunk = self.Kr.decrypt(efmeta[i:i+cryptSize])
-            if isinstance(chunk, str):
-                chunk = chunk.encode("utf-8")
-            fmeta_bytes += chunk
-        fmeta = fdecode(fmeta_bytes)
-        
         result = [fmeta['path']]
         if os.path.exists(fmeta['path']):
             # file is already there -- compare it.  If different, save as
@@ -1291,7 +1811,7 @@ class RetrieveFile:
                         % fmeta['path']))
                 # XXX: should generate '.recovered' extension more carefully,
                 #      so as not to overwrite coincidentally named files.
-                recovered_src = os.path.join(self.parentcodedir, skey + ".rec3")
+                recovered_src = recfile
                 recovered_dest = fmeta['path'] + ".recovered"
                 if os.path.exists(recovered_dest):
                     stamp = int(time.time())
@@ -1314,26 +1834,11 @@ class RetrieveFile:
                 logger.info(self.ctx('same version of file %s already present'
                         % fmeta['path']))
                 # no need to copy:
-                os.remove(os.path.join(self.parentcodedir,skey+".rec3")) 
+                os.remove(recfile)
         else:
-            # recover parent directories if not present
-            paths = pathsplit(fmeta['path'])
-            for i in paths:
-                if not os.path.exists(i) and i != fmeta['path']:
-                    os.mkdir(i) # best effort dir creation, even if missing
-                                # directory metadata
-                    # XXX: should be using an accessor method on config for
-                    # manifest
-                    if i in self.config.manifest:
-                        dirmeta = self.config.getFromManifest(i)
-                        os.chmod(i,dirmeta['mode']) 
-                        os.chown(i,dirmeta['uid'],dirmeta['gid']) # XXX: windows
-                        # XXX: atim, mtim, ctim
-                    # XXX: should try to make sure we can write to dir, change
-                    # perms if necessary.
+            self._makeParents(fmeta['path'])
             # recover file by renaming to its path 
-            os.rename(os.path.join(self.parentcodedir,skey+".rec3"), 
-                    fmeta['path'])
+            os.rename(recfile, fmeta['path'])
 
         # XXX: chown not supported on Windows
         try:
@@ -1342,10 +1847,77 @@ class RetrieveFile:
             logger.warning(self.ctx("could not chown %s", fmeta['path']))
         os.utime(fmeta['path'], (fmeta['atim'], fmeta['mtim']))
         os.chmod(fmeta['path'], fmeta['mode'])
-        logger.info(self.ctx(f"successfully restored file metadata, {self.fname} complete"))
+        logger.info(self.ctx("successfully restored file metadata, %s complete",
+                fmeta['path']))
         return tuple(result)
 
 
+class RetrieveChunk(RetrieveFile):
+    """
+    Retrieves one chunk of a chunked file, given its storage key and eK (both
+    from the file's list of chunks).  Rather than being restored to a path,
+    the decrypted chunk is left in the client dir, and its name returned.
+    """
+
+    def __init__(self, node, sK, eK):
+        RetrieveFile.__init__(self, node, fencode(sK), _crc32_value(eK))
+        self.chunkeK = eK
+
+    def _recoverEK(self):
+        return self.chunkeK
+
+    def _recFile(self, fmeta):
+        return os.path.join(self.parentcodedir,
+                "%s.%s.rec" % (fencode(self.sK), fencode(generateRandom(8))))
+
+    def _restoreFile(self, fmeta, eK, recfile):
+        if hashfile(recfile) != self.chunkeK:
+            os.remove(recfile)
+            raise ValueError("chunk %s failed to verify" % fencode(self.sK))
+        return recfile
+
+
+class RetrievePacked(RetrieveFile):
+    """
+    Retrieves files that were stored together in a pack (see FilePacker).
+    The pack is retrieved once, given its storage key and eK, and each of
+    members, a list of (filename, packinfo) pairs from the manifest, is
+    extracted from it and restored to its path.  Returns a list of the
+    results of restoring each member.
+    """
+
+    def __init__(self, node, sK, eK, members):
+        RetrieveFile.__init__(self, node, fencode(sK), _crc32_value(eK))
+        self.packeK = eK
+        self.members = members
+
+    async def run(self):
+        packfile = await RetrieveChunk(self.node, self.sK, self.packeK).run()
+        try:
+            return await self.node.executor.run('decrypt',
+                    self._extractMembers, packfile)
+        finally:
+            if os.path.exists(packfile):
+                os.remove(packfile)
+
+    def _extractMembers(self, packfile):
+        results = []
+        with open(packfile, 'rb') as pack:
+            for filename, packinfo in self.members:
+                pack.seek(packinfo['offset'])
+                data = pack.read(packinfo['length'])
+                if hashstring(data) != packinfo['eK']:
+                    raise ValueError("%s failed to verify in pack %s"
+                            % (filename, fencode(self.sK)))
+                fmeta = dict(packinfo, path=filename)
+                recfile = self._recFile(fmeta)
+                with open(recfile, 'wb') as f:
+                    f.write(data)
+                results.append(self._restoreFile(fmeta, packinfo['eK'],
+                    recfile))
+        return results
+
+
 class RetrieveFilename:
     """
     Retrieves a File given its local name.  Only works if the local manifest
@@ -1366,20 +1938,46 @@ class RetrieveFilename:
                         self.filename)
                 # RetrieveFile will restore parent dirs, so we don't need to
                 dlist = []
+                packs = {}
                 dirname = self.filename+os.path.sep
                 # XXX: this should be calling a config.getAllFromMasterMeta()
                 for i in [x for x in list(self.config.manifest.keys()) 
                         if dirname == x[:len(dirname)]]:
-                    filekey = self.config.getFromManifest(i)
+                    entry = self.config.getFromManifest(i)
+                    if isinstance(entry, dict):
+                        continue
+                    if len(entry) > 2:
+                        # packed files are restored a whole pack at a time
+                        packs.setdefault((entry[0], entry[2]['pack']),
+                                []).append((i, entry[2]))
+                        continue
+                    filekey = entry[0]
                     metakey = _crc32_value(i)
                     logger.debug("calling RetrieveFile %s" % filekey)
                     dlist.append(retrieve_file(self.node, fencode(filekey),
                             metakey))
-                return await self._gatherRecoveries(dlist)
+                for (sK, eK), members in packs.items():
+                    logger.debug("calling RetrievePacked %s" % sK)
+                    dlist.append(RetrievePacked(self.node, sK, eK,
+                        members).run())
+                results = await self._gatherRecoveries(dlist)
+                # one result per restored file
+                gathered = []
+                for ok, result in results:
+                    if ok and isinstance(result, list):
+                        gathered.extend((True, r) for r in result)
+                    else:
+                        gathered.append((ok, result))
+                return gathered
             else:
                 logger.debug("%s is a file in the manifest", self.filename)
-                (filekey, backuptime) = self.config.getFromManifest(
-                        self.filename)
+                entry = self.config.getFromManifest(self.filename)
+                filekey, backuptime = entry[:2]
+                if len(entry) > 2:
+                    logger.debug("calling RetrievePacked %s" % filekey)
+                    results = await RetrievePacked(self.node, filekey,
+                            entry[2]['pack'], [(self.filename, entry[2])]).run()
+                    return results[0]
                 metakey = _crc32_value(self.filename)
                 if filekey != None and filekey != "":
                     logger.debug("calling RetrieveFile %s" % filekey)
@@ -0,0 +1,135 @@
+"""
+FludHashCache.py (c) 2003-2006 Alen Peacock.  This program is distributed
+under the terms of the GNU General Public License (the GPL), version 3.
+
+Persistent cache of file content hashes, so that files which haven't changed
+since they were last hashed don't need to be read again.
+"""
+
+import os, logging, threading
+
+from flud.FludCrypto import hashfile
+from flud.fencode import fencode, fdecode
+from flud import FludJournal
+
+logger = logging.getLogger('flud.hashcache')
+
+class HashCache:
+    """
+    Maps files to the sha256 of their contents, keyed by (st_dev, st_ino,
+    st_size, st_mtime_ns).  Only the most recent entry for each (dev, inode)
+    is kept.  Entries live in memory and are appended to a journal file as
+    they are added; the journal is rewritten when it accumulates too many
+    superseded records.
+
+    Several processes may read the same cache file (e.g., the node and the
+    scheduler), picking up new entries with refresh(), but only one should
+    add to it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.records = 0
+        self.offset = 0
+        self.fileid = None
+        self.lock = threading.RLock()
+        self.refresh()
+
+    def _statkey(self, st):
+        return (st.st_dev, st.st_ino), (st.st_size, st.st_mtime_ns)
+
+    def refresh(self):
+        """
+        Reads any records appended to the journal since it was last read.
+        """
+        with self.lock:
+            try:
+                f = open(self.path, 'rb')
+            except FileNotFoundError:
+                return
+            with f:
+                st = os.fstat(f.fileno())
+                fileid = (st.st_dev, st.st_ino)
+                if fileid != self.fileid or st.st_size < self.offset:
+                    # journal was compacted (replaced) or truncated
+                    self.entries = {}
+                    self.records = 0
+                    self.offset = 0
+                    self.fileid = fileid
+                f.seek(self.offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        # partially written record, pick it up next time
+                        break
+                    self.offset += len(line)
+                    try:
+                        dev, ino, size, mtime, digest = fdecode(line.strip())
+                    except Exception:
+                        logger.warning("skipping bad record in %s" % self.path)
+                        continue
+                    self.entries[(dev, ino)] = (size, mtime, digest)
+                    self.records += 1
+
+    def lookup(self, filename, st=None):
+        """
+        Returns the cached hexdigest for filename, or None if it has not been
+        hashed since it last changed.
+        """
+        if st is None:
+            st = os.stat(filename)
+        ident, version = self._statkey(st)
+        with self.lock:
+            entry = self.entries.get(ident)
+        if entry and entry[:2] == version:
+            return entry[2]
+        return None
+
+    def add(self, st, digest):
+        """
+        Records digest as the hash of the file contents described by stat
+        result st.
+        """
+        ident, version = self._statkey(st)
+        entry = version+(digest,)
+        record = (fencode(ident+entry)+"\n").encode("ascii")
+        with self.lock:
+            if self.entries.get(ident) == entry:
+                return
+            self.refresh()
+            with open(self.path, 'ab') as f:
+                if self.fileid is None:
+                    fst = os.fstat(f.fileno())
+                    self.fileid = (fst.st_dev, fst.st_ino)
+                f.write(record)
+                self.offset = f.tell()
+            self.entries[ident] = entry
+            self.records += 1
+            if FludJournal.overgrown(self.records, len(self.entries)):
+                self.compact()
+
+    def compact(self):
+        """
+        Rewrites the journal with only the live entries.
+        """
+        with self.lock:
+            self.fileid, self.offset = FludJournal.rewrite(self.path,
+                    ((fencode(ident+entry)+"\n").encode("ascii")
+                        for ident, entry in self.entries.items()))
+            self.records = len(self.entries)
+
+    def hashfile(self, filename):
+        """
+        Returns the sha256 hexdigest of filename's contents, reading the file
+        only if it isn't in the cache.
+        """
+        st = os.stat(filename)
+        digest = self.lookup(filename, st)
+        if digest is None:
+            digest = hashfile(filename)
+            # only cache the result if the file didn't change while we were
+            # reading it.  XXX: a write within the same mtime tick as the
+            # stat still goes unnoticed.
+            if self._statkey(os.stat(filename)) == self._statkey(st):
+                self.add(st, digest)
+        return digest
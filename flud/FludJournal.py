@@ -0,0 +1,36 @@
+"""
+FludJournal.py (c) 2003-2006 Alen Peacock.  This program is distributed
+under the terms of the GNU General Public License (the GPL), version 3.
+
+Helpers for append-only journal files, which hold one record per change and
+are rewritten with only the live entries once superseded records pile up.
+"""
+
+import os
+
+# a journal is compacted once it holds this many more records than twice
+# the number of live entries
+COMPACTSLACK = 1024
+
+def overgrown(records, live):
+    """
+    Returns True if a journal holding records records, of which live are
+    still current, should be compacted.
+    """
+    return records > 2*live+COMPACTSLACK
+
+def rewrite(path, records, header=b""):
+    """
+    Atomically replaces the journal at path with header followed by records
+    (an iterable of bytes).  Returns ((st_dev, st_ino), length) of the new
+    file.
+    """
+    tmpname = path+".tmp"
+    with open(tmpname, 'wb') as f:
+        f.write(header)
+        for record in records:
+            f.write(record)
+        length = f.tell()
+        fst = os.fstat(f.fileno())
+    os.replace(tmpname, path)
+    return (fst.st_dev, fst.st_ino), length
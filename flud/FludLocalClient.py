@@ -50,6 +50,7 @@ class CmdClient:
             "getm": "retrieve manifest",
             "node": "list known nodes",
             "buck": "print k buckets",
+            "stat": "print server cache and connection pool statistics",
             "stor": "store a block to a given node: 'stor host:port,fname'",
             "rtrv": "retrieve a block from a given node: 'rtrv host:port,fname'",
             "vrfy": "verify a block on a given node: 'vrfy host:port:offset-length,fname'",
@@ -83,6 +84,8 @@ class CmdClient:
                 result = await self.client.sendDIAGNODE()
             elif commandkey == "buck":
                 result = await self.client.sendDIAGBKTS()
+            elif commandkey == "stat":
+                result = await self.client.sendDIAGSTAT()
             elif commandkey == "stor":
                 storcommands = commands[1].split(",")
                 try:
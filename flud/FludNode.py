@@ -17,7 +17,8 @@ import logging
 from flud.FludConfig import FludConfig
 from flud.protocol.AiohttpServer import FludAiohttpServer
 from flud.protocol.FludClient import FludClient
-from flud.async_runtime import AsyncHTTPClient, AsyncRuntime
+from flud.protocol.FludCommUtil import setResolveOptions
+from flud.async_runtime import AsyncHTTPClient, AsyncRuntime, StageExecutor
 
 PINGTIME=60
 SYNCTIME=900
@@ -34,10 +35,14 @@ class FludNode(object):
         self.config = FludConfig()
         self.logger.removeHandler(self.screenhandler)
         self.config.load(serverport=port)
+        setResolveOptions(*self.config.resolve)
         self.client = FludClient(self)
         self.async_runtime = AsyncRuntime()
         self.async_runtime.start()
-        self.async_http = AsyncHTTPClient(self.async_runtime)
+        self.async_http = AsyncHTTPClient(self.async_runtime,
+                *self.config.connections)
+        self.executor = StageExecutor(self.config.workers,
+                self.config.queuelimit, self.config.stagelimits)
         self.DHTtstamp = time.time()+10
         self._use_async_server = True
         self._async_tasks = []
@@ -81,6 +86,8 @@ class FludNode(object):
         self._async_tasks = []
         self.async_http.close()
         self.async_runtime.stop()
+        self.executor.shutdown()
+        self.config.reputations.flush()
 
     def join(self):
         self.webserver.join()
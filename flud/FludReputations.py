@@ -0,0 +1,257 @@
+"""
+FludReputations.py (c) 2003-2006 Alen Peacock.  This program is distributed
+under the terms of the GNU General Public License (the GPL), version 3.
+
+Reputation scores for other nodes, kept ordered so that the best nodes can be
+picked without sorting every score, and the throttle list, with its expiry
+times kept in a heap.  Scores decay toward a baseline as they age, the number
+of nodes tracked is bounded, and both scores and throttles can be kept in a
+journal file that is appended to as they change.
+"""
+
+import os, logging, threading, heapq, struct, time
+from bisect import bisect_left, insort
+from collections import OrderedDict
+
+from flud import FludJournal
+
+logger = logging.getLogger('flud.reputations')
+
+# journal records are fixed-size: a record type, a 256-bit nodeID and two
+# doubles -- (score, time of last change) for SCORE, (throttle end, 0) for
+# THROTTLE, and zeros for FORGET
+MAGIC = b"FLUDREP1"
+RECORD = struct.Struct('!B32sdd')
+SCORE, THROTTLE, FORGET = range(3)
+# records are written out once this many are waiting (or on flush())
+FLUSHRECORDS = 64
+
+class ReputationIndex:
+    """
+    Maps nodeIDs (ints) to reputation scores, and can be used where a dict of
+    them was used before.  A score decays toward baseline with the given
+    halflife (in seconds) from the time it last changed; halflife 0 turns
+    decay off.  At most capacity nodes are tracked; when another is added,
+    the one whose score changed least recently is forgotten.
+
+    Since every score decays at the same rate, the order of the nodes by
+    score only changes when a score does.  Alongside the mapping, a list of
+    (-rank, -nodeID) pairs is kept sorted, where rank is the node's distance
+    from baseline scaled to a fixed point in time, so the best nodes come
+    first (and, among nodes with equal scores, those with higher IDs).
+
+    Throttled nodes are kept in throttled, a dict of nodeID to the time the
+    throttle ends, which callers may read directly but should only change
+    through throttle() and expire().
+
+    If path is given, scores and throttles are loaded from the journal there,
+    and changes to them are appended to it.
+    """
+
+    def __init__(self, scores=None, path=None, capacity=10000, halflife=0,
+            baseline=0):
+        self.path = path
+        self.capacity = capacity
+        self.halflife = halflife
+        self.baseline = baseline
+        self.epoch = time.time()
+        self.scores = OrderedDict()   # nodeID -> (score, time, rank)
+        self.ranked = []
+        self.throttled = {}
+        self.expiries = []   # heap of (throttle end, nodeID)
+        self.pending = []
+        self.records = 0
+        self.lock = threading.RLock()
+        if path and os.path.exists(path):
+            self._load()
+        if scores:
+            for nodeID, score in scores.items():
+                self[nodeID] = score
+
+    def _id(self, nodeID):
+        if isinstance(nodeID, str):
+            return int(nodeID, 16)
+        return nodeID
+
+    def _rank(self, score, when):
+        if not self.halflife:
+            return score-self.baseline
+        return (score-self.baseline) \
+                * 2**((when-self.epoch)/self.halflife)
+
+    def _decayed(self, entry, now):
+        score, when, rank = entry
+        if not self.halflife or now <= when:
+            return score
+        return self.baseline \
+                + (score-self.baseline) * 2**((when-now)/self.halflife)
+
+    def _set(self, nodeID, score, when):
+        old = self.scores.pop(nodeID, None)
+        if old is not None:
+            del self.ranked[bisect_left(self.ranked, (-old[2], -nodeID))]
+        rank = self._rank(score, when)
+        self.scores[nodeID] = (score, when, rank)
+        insort(self.ranked, (-rank, -nodeID))
+        while len(self.scores) > self.capacity:
+            self._forget(next(iter(self.scores)))
+
+    def _forget(self, nodeID):
+        score, when, rank = self.scores.pop(nodeID)
+        del self.ranked[bisect_left(self.ranked, (-rank, -nodeID))]
+        self.throttled.pop(nodeID, None)
+        self._journal(FORGET, nodeID, 0, 0)
+
+    def _journal(self, kind, nodeID, a, b):
+        if self.path:
+            self.pending.append(RECORD.pack(kind,
+                nodeID.to_bytes(32, 'big'), a, b))
+            if len(self.pending) >= FLUSHRECORDS:
+                self.flush()
+
+    def _load(self):
+        with open(self.path, 'rb+') as f:
+            data = f.read()
+            if not data.startswith(MAGIC):
+                logger.warning("ignoring unrecognized reputation file %s"
+                        % self.path)
+                return
+            end = len(data)-(len(data)-len(MAGIC)) % RECORD.size
+            if end != len(data):
+                # partially written record, drop it so appends stay aligned
+                f.truncate(end)
+        for kind, nodeID, a, b in RECORD.iter_unpack(data[len(MAGIC):end]):
+            nodeID = int.from_bytes(nodeID, 'big')
+            if kind == SCORE:
+                self._set(nodeID, a, b)
+            elif kind == THROTTLE:
+                self.throttled[nodeID] = a
+            elif nodeID in self.scores:
+                self._forget(nodeID)
+            self.records += 1
+        # nothing loaded needs writing back
+        self.pending = []
+        self.expiries = [(u, n) for n, u in self.throttled.items()]
+        heapq.heapify(self.expiries)
+        self.expire(time.time())
+
+    def flush(self):
+        """ writes out any changes not yet in the journal """
+        with self.lock:
+            if not self.path or not self.pending:
+                return
+            with open(self.path, 'ab') as f:
+                if f.tell() == 0:
+                    f.write(MAGIC)
+                f.write(b"".join(self.pending))
+            self.records += len(self.pending)
+            self.pending = []
+            if FludJournal.overgrown(self.records,
+                    len(self.scores)+len(self.throttled)):
+                self.compact()
+
+    def compact(self):
+        """ rewrites the journal with only the live entries """
+        with self.lock:
+            records = [RECORD.pack(SCORE, nodeID.to_bytes(32, 'big'),
+                    score, when)
+                    for nodeID, (score, when, rank) in self.scores.items()]
+            records += [RECORD.pack(THROTTLE, nodeID.to_bytes(32, 'big'),
+                    until, 0) for nodeID, until in self.throttled.items()]
+            FludJournal.rewrite(self.path, records, MAGIC)
+            self.records = len(self.scores)+len(self.throttled)
+            self.pending = []
+
+    def __len__(self):
+        return len(self.scores)
+
+    def __contains__(self, nodeID):
+        return self._id(nodeID) in self.scores
+
+    def __getitem__(self, nodeID):
+        return self._decayed(self.scores[self._id(nodeID)], time.time())
+
+    def get(self, nodeID, default=None):
+        entry = self.scores.get(self._id(nodeID))
+        if entry is None:
+            return default
+        return self._decayed(entry, time.time())
+
+    def items(self):
+        now = time.time()
+        with self.lock:
+            return [(n, self._decayed(e, now))
+                    for n, e in self.scores.items()]
+
+    def __iter__(self):
+        return iter(list(self.scores))
+
+    def __setitem__(self, nodeID, score):
+        nodeID = self._id(nodeID)
+        now = time.time()
+        with self.lock:
+            self._set(nodeID, score, now)
+            self._journal(SCORE, nodeID, score, now)
+
+    def adjust(self, nodeID, delta, initial=0):
+        """
+        Adds delta to nodeID's (decayed) score, which starts at initial if
+        nodeID has no score yet.  Returns the new score.
+        """
+        nodeID = self._id(nodeID)
+        with self.lock:
+            score = self.get(nodeID, initial)+delta
+            self[nodeID] = score
+            return score
+
+    def throttle(self, nodeID, until):
+        """ throttles nodeID until the given time """
+        nodeID = self._id(nodeID)
+        with self.lock:
+            self.throttled[nodeID] = until
+            heapq.heappush(self.expiries, (until, nodeID))
+            self._journal(THROTTLE, nodeID, until, 0)
+            if len(self.expiries) > 2*len(self.throttled)+64:
+                # drop entries left behind by nodes throttled again
+                self.expiries = [(u, n) for n, u in self.throttled.items()]
+                heapq.heapify(self.expiries)
+
+    def expire(self, now):
+        """ ends throttles that finished before now """
+        with self.lock:
+            while self.expiries and self.expiries[0][0] < now:
+                until, nodeID = heapq.heappop(self.expiries)
+                # a node throttled again has a later entry in the heap, too
+                if self.throttled.get(nodeID) == until:
+                    del self.throttled[nodeID]
+
+    def best(self, num=None, exclude=None, throttle=False):
+        """
+        Returns nodeIDs, best first.  If num is given, only the first num are
+        returned.  Excluded nodes (and throttled ones, if throttle is set) are
+        skipped, but if that leaves fewer than num nodes and num nodes are
+        known, the best excluded nodes are used to make up the difference.
+        Only the top of the ranking is examined when num is small.
+        """
+        exclude = exclude or ()
+        if not isinstance(exclude, (set, frozenset, dict)):
+            exclude = set(exclude)
+        throttled = self.throttled if throttle else {}
+        with self.lock:
+            result = []
+            skipped = []
+            for negrank, negID in self.ranked:
+                nodeID = -negID
+                if nodeID in throttled:
+                    continue
+                if nodeID in exclude:
+                    if num and len(skipped) < num:
+                        skipped.append((negrank, negID))
+                    continue
+                result.append((negrank, negID))
+                if num and len(result) >= num:
+                    break
+            if num and len(result) < num and len(self.scores) >= num:
+                result += skipped[:num-len(result)]
+                result.sort()
+        return [-negID for negrank, negID in result]
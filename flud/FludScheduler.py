@@ -6,6 +6,8 @@ import stat
 import time
 
 from flud.CheckboxState import CheckboxState
+from flud.FludCrypto import hashstring
+from flud.FludFileOperations import appendChunks
 
 CHECKTIME = 5
 
@@ -54,9 +56,28 @@ class FludScheduler:
             else:
                 return True
             if mtime > fileChangeTime:
-                return True
+                return not self.fileUnchangedContent(file)
         return False
 
+    def fileUnchangedContent(self, file):
+        """
+        Returns True if the hash cache shows that file's current contents are
+        the ones recorded in the master metadata (e.g., it was only touched),
+        without reading the file.
+        """
+        hashcache = getattr(self.config, "hashcache", None)
+        entry = self.mastermetadata.get(file)
+        if hashcache is None or not isinstance(entry, (tuple, list)):
+            return False
+        digest = hashcache.lookup(file)
+        if digest is None:
+            return False
+        if len(entry) > 2:
+            # packed file, which records its own eK
+            return entry[2].get('eK') == digest
+        return entry[0] in (int(hashstring(digest), 16),
+                int(hashstring(digest+appendChunks), 16))
+
     def checkFileConfig(self):
         if not self.fileconfigfile:
             if "FLUDHOME" in os.environ:
@@ -76,15 +97,20 @@ class FludScheduler:
         return False
 
     def checkFilesystem(self):
+        hashcache = getattr(self.config, "hashcache", None)
+        if hashcache is not None:
+            # pick up hashes recorded by the node since the last check
+            hashcache.refresh()
         checkedFiles = set()
         changedFiles = set()
 
         def checkList(entries):
             for entry in entries:
+                # entries already in the master metadata are checked too, so
+                # that files changed since they were stored get stored again
                 if (
                     entry not in checkedFiles
                     and entry not in self.fileconfigExcluded
-                    and entry not in self.mastermetadata
                 ):
                     if os.path.isdir(entry):
                         dirfiles = [os.path.join(entry, i) for i in os.listdir(entry)]
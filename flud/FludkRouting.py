@@ -12,7 +12,8 @@ more information.
 """
 
 from bisect import *
-import logging
+from collections import OrderedDict
+import logging, random, time
 
 #k = 5          # This is the max depth of a kBucket
 k = 12          # This is the max depth of a kBucket.  k is generally used as
@@ -23,49 +24,82 @@ idspace = 256  # using sha-256
 
 logger = logging.getLogger("flud.k")
 
+class CachedNode:
+    """
+    A node held in a NodeCache, with when it was last seen and how many times
+    it has failed to respond since.
+    """
+    __slots__ = ('node', 'lastSeen', 'failures')
+
+    def __init__(self, node):
+        self.node = node
+        self.lastSeen = time.monotonic()
+        self.failures = 0
+
 class NodeCache:
     """
-    An LRU cache for nodes
+    An LRU cache for nodes, kept in the order they were last seen (most
+    recent at the end).  All operations other than freshest() are O(1).
     """
     def __init__(self, size):
         self.size = size
-        self.cache = {}
-        self.cacheOrder = []
+        self.cache = OrderedDict()
 
     def insertNode(self, node):
         """
-        adds a node to the cache.  if this displaces a node, the displaced node
-        is returned
+        adds a node to the cache, or marks it as just seen if it is already
+        there.  if this displaces a node, the displaced node's id is returned
         """
-        if node[2] not in self.cache:
-            self.cache[node[2]] = node
-            self.cacheOrder.append(node[2])
-            if len(self.cacheOrder) > self.size:
-                popped = self.cacheOrder.pop(0)
-                self.cache.pop(popped)
-                return popped
+        entry = self.cache.get(node[2])
+        if entry is not None:
+            entry.node = node
+            entry.lastSeen = time.monotonic()
+            entry.failures = 0
+            self.cache.move_to_end(node[2])
+            return None
+        self.cache[node[2]] = CachedNode(node)
+        if len(self.cache) > self.size:
+            return self.cache.popitem(last=False)[0]
 
     def getNode(self, nodeID):
         """
         returns a node from the cache, or None
         """
-        if nodeID in self.cache:
-            return self.cache[nodeID]
+        entry = self.cache.get(nodeID)
+        if entry is not None:
+            return entry.node
         return None
-    
+
     def removeNode(self, node):
         """
         removes a node from the cache
         """
-        if node[2] in self.cache:
-            self.cache.pop(node[2])
-            try:
-                self.cacheOrder.remove(node[2])
-            except ValueError:
-                pass
+        self.cache.pop(node[2], None)
+
+    def nodeFailed(self, nodeID):
+        """
+        records that nodeID didn't respond.  it won't be offered as a
+        replacement until it is seen again.
+        """
+        entry = self.cache.get(nodeID)
+        if entry is not None:
+            entry.failures += 1
+
+    def freshest(self, begin, end):
+        """
+        returns the most recently seen node with an id in [begin, end] that
+        hasn't failed since, or None
+        """
+        for entry in reversed(self.cache.values()):
+            if entry.failures == 0 and begin <= entry.node[2] <= end:
+                return entry.node
+        return None
 
     def nodes(self):
-        return [self.cache[i] for i in self.cache]
+        return [entry.node for entry in self.cache.values()]
+
+    def __len__(self):
+        return len(self.cache)
 
 def kCompare(a, b, target):
     """
@@ -113,6 +147,7 @@ class kRouting:
     >>> table.insertNode(('11.2.3.4', 34, 773456))
     ('4.2.3.4', 34, 723456)
     >>> table.replaceNode(('4.2.3.4', 34, 723456), ('11.2.3.4', 34, 773456))
+    ('11.2.3.4', 34, 773456)
     >>> table.kBuckets
     [{'0-80000': [('1.2.3.4', 34, 123456), ('2.2.3.4', 34, 23456), ('3.2.3.4', 34, 223456), ('5.2.3.4', 34, 423456), ('6.2.3.4', 34, 323456)]}, {'80001-100000': [('7.2.3.4', 34, 733456), ('8.2.3.4', 34, 743456), ('9.2.3.4', 34, 753456), ('10.2.3.4', 34, 763456), ('11.2.3.4', 34, 773456)]}]
     >>> table.removeNode(('1.2.3.4', 34, 123456))
@@ -122,6 +157,16 @@ class kRouting:
     [('2.2.3.4', 34, 23456), ('3.2.3.4', 34, 223456), ('5.2.3.4', 34, 423456), ('6.2.3.4', 34, 323456), ('7.2.3.4', 34, 733456), ('8.2.3.4', 34, 743456), ('9.2.3.4', 34, 753456), ('10.2.3.4', 34, 763456), ('11.2.3.4', 34, 773456)]
     >>> table.knownExternalNodes()
     [('2.2.3.4', 34, 23456), ('3.2.3.4', 34, 223456), ('5.2.3.4', 34, 423456), ('6.2.3.4', 34, 323456), ('7.2.3.4', 34, 733456), ('8.2.3.4', 34, 743456), ('9.2.3.4', 34, 753456), ('10.2.3.4', 34, 763456), ('11.2.3.4', 34, 773456)]
+    >>> table.insertNode(('12.2.3.4', 34, 783456))
+    ('7.2.3.4', 34, 733456)
+    >>> table.replacementCache.nodes()
+    [('12.2.3.4', 34, 783456)]
+    >>> table.nodeFailed(753456)
+    >>> table.kBuckets[1]
+    {'80001-100000': [('7.2.3.4', 34, 733456), ('8.2.3.4', 34, 743456), ('10.2.3.4', 34, 763456), ('11.2.3.4', 34, 773456), ('12.2.3.4', 34, 783456)]}
+    >>> table.nodeFailed(733456)
+    >>> table.kBuckets[1]
+    {'80001-100000': [('7.2.3.4', 34, 733456), ('8.2.3.4', 34, 743456), ('10.2.3.4', 34, 763456), ('11.2.3.4', 34, 773456), ('12.2.3.4', 34, 783456)]}
     """
     def __init__(self, node, bits=idspace, depth=k):
         """
@@ -130,7 +175,9 @@ class kRouting:
         """
         self.k = depth
         self.replacementCache = NodeCache(300)
-        self.kBuckets = [kBucket(0, 2**bits, depth),]
+        self.kBuckets = [kBucket(0, 2**bits, depth, 0),]
+        # the buckets' end values, so that bisect compares plain ints
+        self.bucketEnds = [2**bits]
         #self.kBuckets = [kBucket(0, 1, depth),]
         #for i in xrange(1,bits):
         #   self.kBuckets.append(kBucket(2**i, 2**(i+1)-1, depth))
@@ -141,9 +188,11 @@ class kRouting:
         """
         Inserts a node into the appropriate kBucket.  If the node already
         exists in the appropriate kBucket, it is moved to the tail of the list.
-        If the bucket is full, this method returns the oldest node, which the
-        caller should then ping.  If the oldest node is alive, the caller
-        does nothing.  Otherwise, the caller should call replaceNode.
+        If the bucket is full, node is kept in the replacement cache instead,
+        and this method returns the oldest node in the bucket, which the
+        caller may ping.  If the oldest node is alive, the caller does
+        nothing.  Otherwise, the caller should call replaceNode (or
+        nodeFailed).
         @param node a (ip, port, id) triple, where id is a long.
         """
         if len(node) < 3:
@@ -165,14 +214,14 @@ class kRouting:
             # XXX: need to also split for some other cases, see sections 2.4 
             # and 4.2.
             else:
-                # bucket is full but we won't split.  Return the oldest node
+                # bucket is full but we won't split.  Remember the node in
+                # case a bucket entry fails, and return the oldest node
                 # so that the caller can determine if it should be expunged.
                 # If the old node is not reachable, caller should call 
                 # replaceNode()
                 logger.debug("didn't add %x" % node[2])
-                return bucket.contents[0]
-            logger.debug("didn't add %x" % node[2])
-            return bucket.contents[0]
+                self.replacementCache.insertNode(node)
+                return bucket.nodeAt(0)
 
     def removeNode(self, node):
         """
@@ -181,14 +230,40 @@ class kRouting:
         bucket = self._findBucket(node[2])
         bucket.delNode(node)
         
-    def replaceNode(self, replacee, replacer):
+    def replaceNode(self, replacee, replacer=None):
         """
-        Expunges replacee from its bucket, making room to add replacer 
+        Expunges replacee from its bucket, making room to add replacer.  If
+        replacer isn't given, the freshest live node in the replacement cache
+        that belongs in replacee's bucket is promoted, if there is one.
+        Returns the node added, or None.
         """
         # XXX: constraint checks: replacee & replacer belong to the same bucket,
         #      bucket is currently full, adding replacer doesn't overfill, etc.
+        if replacer is None:
+            bucket = self._findBucket(replacee[2])
+            replacer = self.replacementCache.freshest(bucket.begin, bucket.end)
         self.removeNode(replacee)
-        self.insertNode(replacer)
+        if replacer is not None:
+            self.insertNode(replacer)
+        return replacer
+
+    def nodeFailed(self, nodeID):
+        """
+        Call when nodeID couldn't be reached.  If it is in a bucket and there
+        is a live replacement for it, it is replaced; otherwise it is kept (so
+        that a network outage doesn't empty the table), but it won't be
+        promoted from the replacement cache until it is seen again.
+        """
+        bucket = self._findBucket(nodeID)
+        node = bucket.findNode(nodeID)
+        if node is None:
+            self.replacementCache.nodeFailed(nodeID)
+        elif nodeID != self.node[2]:
+            replacer = self.replacementCache.freshest(bucket.begin, bucket.end)
+            if replacer is not None:
+                self.replaceNode(node, replacer)
+                logger.debug("replaced unreachable %x with %x"
+                        % (nodeID, replacer[2]))
 
     def findNode(self, nodeID):
         """
@@ -196,25 +271,22 @@ class kRouting:
         additional queries.  If nodeID is found, it will be the first result.
         @param nodeID an int
         """
-        nodes = []
         bucket = self._findBucket(nodeID)
-        #n = bucket.findNode(nodeID)
-        #if n != None: 
-        #   nodes.append(n)
-
-        nodes += bucket.contents
+        nodes = bucket.contents
         if len(nodes) < self.k:
+            # widen outwards from nodeID's bucket until there are enough
+            # candidates; only the buckets visited are ever looked at
             nextbucket = self._nextbucket(bucket)
             prevbucket = self._prevbucket(bucket)
             while len(nodes) < self.k \
-                    and (nextbucket != None or prevbucket != None):
-                if nextbucket != None:
+                    and (nextbucket is not None or prevbucket is not None):
+                if nextbucket is not None:
                     nodes += nextbucket.contents
-                if prevbucket != None: 
+                if prevbucket is not None:
                     nodes += prevbucket.contents
                 nextbucket = self._nextbucket(nextbucket)
                 prevbucket = self._prevbucket(prevbucket)
-            
+
         nodes.sort(key=lambda n, t=nodeID: t ^ n[2])
         return nodes[:self.k]
 
@@ -240,6 +312,40 @@ class kRouting:
         """
         self.insertNode(node)
 
+    def nodeCount(self):
+        """
+        Returns the number of nodes known, not including this node, without
+        building a list of them (i.e., len(knownExternalNodes())).
+        """
+        count = sum(len(b) for b in self.kBuckets)+len(self.replacementCache)
+        if self.getNode(self.node[2]) is not None:
+            count -= 1
+        return count
+
+    def randomNode(self, exclude=()):
+        """
+        Returns a randomly chosen known node other than this one and the
+        nodes in exclude, or None if there isn't one.
+        """
+        excluded = set(n[2] for n in exclude)
+        excluded.add(self.node[2])
+        total = sum(len(b) for b in self.kBuckets)+len(self.replacementCache)
+        if total < 4*len(excluded):
+            # few enough nodes that random draws would often miss
+            choices = [n for n in self.knownNodes() if n[2] not in excluded]
+            return random.choice(choices) if choices else None
+        while True:
+            i = random.randrange(total)
+            for bucket in self.kBuckets:
+                if i < len(bucket):
+                    node = bucket.nodeAt(i)
+                    break
+                i -= len(bucket)
+            else:
+                node = self.replacementCache.nodes()[i]
+            if node[2] not in excluded:
+                return node
+
     def knownExternalNodes(self):
         result = []
         for i in self.kBuckets:
@@ -260,7 +366,7 @@ class kRouting:
     def _nextbucket(self, bucket):
         if bucket is None:
             return bucket
-        i = self.kBuckets.index(bucket)+1
+        i = bucket.index+1
         if i >= len(self.kBuckets):
             return None
         return self.kBuckets[i]
@@ -268,7 +374,7 @@ class kRouting:
     def _prevbucket(self, bucket):
         if bucket is None:
             return bucket
-        i = self.kBuckets.index(bucket)-1
+        i = bucket.index-1
         if i < 0:
             return None
         return self.kBuckets[i]
@@ -278,12 +384,11 @@ class kRouting:
         returns the bucket which would contain i.
         @param i an int
         """
-        #print "kBuckets = %s" % str(self.kBuckets)
-        bl = bisect_left(self.kBuckets, i)
+        bl = bisect_left(self.bucketEnds, i)
         if bl >= len(self.kBuckets):
             raise Exception(
                     "tried to find an ID that is larger than ID space: %s" % i) 
-        return self.kBuckets[bisect_left(self.kBuckets, i)]
+        return self.kBuckets[bl]
     
     def _splitBucket(self, bucket):
         """
@@ -293,11 +398,15 @@ class kRouting:
         """
         # Keep bucket bounds as ints under Python 3 ("/" yields float).
         halfpoint = (bucket.end - bucket.begin) // 2
-        newbucket = kBucket(bucket.end - halfpoint + 1, bucket.end, self.k)
-        self.kBuckets.insert(self.kBuckets.index(bucket.begin) + 1, newbucket)
+        newbucket = kBucket(bucket.end - halfpoint + 1, bucket.end, self.k,
+                bucket.index + 1)
+        self.kBuckets.insert(newbucket.index, newbucket)
+        for b in self.kBuckets[newbucket.index+1:]:
+            b.index += 1
         bucket.end -= halfpoint
+        self.bucketEnds.insert(bucket.index, bucket.end)
 
-        for node in bucket.contents[:]:
+        for node in bucket.contents:
             if node[2] > bucket.end:
                 bucket.delNode(node)
                 newbucket.addNode(node)
@@ -307,7 +416,10 @@ class kBucket:
     """
     A kBucket is a list of <ip, port, id> triples, ordered according to time
     last seen (most recent at tail).  Every kBucket has a begin and end
-    number, indicating the chunk of the id space that it contains.
+    number, indicating the chunk of the id space that it contains, and knows
+    its index in the routing table's list of buckets.  The triples are kept
+    in a dict keyed by id (which preserves the last-seen order), so finding,
+    updating and removing them doesn't need a scan.
     
     >>> b = kBucket(0,100,5)
     >>> b
@@ -385,11 +497,37 @@ class kBucket:
     3
     """
     
-    def __init__(self, begin, end, depth=k):
+    __slots__ = ('k', 'begin', 'end', 'index', 'nodes')
+
+    def __init__(self, begin, end, depth=k, index=0):
         self.k = depth
         self.begin = begin
         self.end = end
-        self.contents = []
+        self.index = index
+        self.nodes = {}
+
+    def __len__(self):
+        return len(self.nodes)
+
+    @property
+    def contents(self):
+        """ the bucket's nodes, least recently seen first, as a new list """
+        return list(self.nodes.values())
+
+    def nodeAt(self, i):
+        """ returns the i'th least recently seen node """
+        if i < len(self.nodes)//2:
+            for node in self.nodes.values():
+                if i == 0:
+                    return node
+                i -= 1
+        else:
+            i = len(self.nodes)-i-1
+            for node in reversed(self.nodes.values()):
+                if i == 0:
+                    return node
+                i -= 1
+        raise IndexError("bucket index out of range")
 
     def __repr__(self):
         return "{'%x-%x': %s}" % (self.begin, self.end, self.contents)
@@ -403,17 +541,12 @@ class kBucket:
         of this bucket, its position is updated to the end of the list.  If the
         bucket is full, raises an exception
         """
-        if node in self.contents:
-            self.contents.remove(node)
-            self.contents.append(node)
-        elif len(self.contents) >= self.k:
+        if node[2] in self.nodes:
+            # replaces the matching node's old contact info, if it changed
+            del self.nodes[node[2]]
+        elif len(self.nodes) >= self.k:
             raise BucketFullException()
-        else:
-            ids = [x[2] for x in self.contents]
-            if node[2] in ids:
-                # remove the matching node's old contact info
-                self.contents.pop(ids.index(node[2]))
-            self.contents.append(node)
+        self.nodes[node[2]] = node
 
     def updateNode(self, node):
         """ Moves the given node to the tail of the list.  If the node isn't
@@ -424,16 +557,11 @@ class kBucket:
 
     def delNode(self, node):
         """ removes the given node, if present, from this bucket """
-        try:
-            self.contents.remove(node)
-        except:
-            pass
-    
+        if self.nodes.get(node[2]) == node:
+            del self.nodes[node[2]]
+
     def findNode(self, nodeID):
-        for i in self.contents:
-            if i[2] == nodeID:
-                return i
-        return None
+        return self.nodes.get(nodeID)
 
     # The following comparators allow us to use list & bisect on the buckets.
     # integers, longs, and buckets all may be compared to a bucket.
@@ -1,6 +1,8 @@
 import asyncio
 import concurrent.futures
+import functools
 import logging
+import multiprocessing
 import os
 import sys
 import threading
@@ -99,11 +101,137 @@ class AsyncRuntime:
         return self._thread_id is not None and threading.get_ident() == self._thread_id
 
 
+class StageExecutor:
+    """
+    Runs blocking, CPU-bound work (hashing, encryption, erasure coding) on a
+    shared pool of worker threads so that it doesn't stall the event loop.
+    Work is submitted under a named stage ('hash', 'encode', 'decode',
+    'decrypt', ...), and each stage may have at most its queue limit of jobs
+    running or waiting for a worker at any one time.  Callers beyond that
+    limit wait on the event loop (without blocking it) for a slot, which keeps
+    one busy stage from monopolizing the pool or piling up unbounded work.
+
+    Threads are used rather than processes because the heavy lifting (zfec,
+    AES, hashlib) happens in C code that releases the GIL, and because the
+    work operates on cipher objects and open files that can't be pickled.
+    Work that is mostly python code (content-defined chunking) is instead
+    run in a pool of worker processes, started when first needed, with
+    run_in_process().
+    """
+
+    def __init__(self, workers=None, queuelimit=None, stagelimits=None,
+            name="flud-worker"):
+        if not workers or workers < 1:
+            workers = os.cpu_count() or 1
+        if not queuelimit or queuelimit < 1:
+            queuelimit = 2*workers
+        self.workers = workers
+        self.queuelimit = queuelimit
+        self.stagelimits = dict(stagelimits or {})
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix=name)
+        self._procpool = None
+        self._semaphores = {}
+        self._pending = {}
+
+    def limit(self, stage):
+        return self.stagelimits.get(stage, self.queuelimit)
+
+    def pending(self, stage=None):
+        """
+        Returns the number of jobs running or queued for stage, or a dict of
+        these counts for all stages if stage is None.
+        """
+        if stage is None:
+            return dict(self._pending)
+        return self._pending.get(stage, 0)
+
+    def _semaphore(self, stage):
+        # semaphores are bound to the loop that first waits on them, so keep
+        # one per (loop, stage), dropping those of loops that have closed
+        # whenever another is needed
+        key = (asyncio.get_running_loop(), stage)
+        sem = self._semaphores.get(key)
+        if sem is None:
+            self._semaphores = {k: v for k, v in self._semaphores.items()
+                    if not k[0].is_closed()}
+            sem = asyncio.Semaphore(self.limit(stage))
+            self._semaphores[key] = sem
+        return sem
+
+    async def run(self, stage, func, *args, **kwargs):
+        """
+        Runs func(*args, **kwargs) in the worker pool as part of stage, and
+        returns its result.
+        """
+        return await self._run(stage, self._pool, func, args, kwargs)
+
+    async def run_in_process(self, stage, func, *args, **kwargs):
+        """
+        Like run(), but runs func in a worker process, so that it doesn't
+        hold the GIL while it works.  func, its arguments and its result must
+        be picklable.
+        """
+        if self._procpool is None:
+            # workers aren't forked from this (threaded) process, as locks
+            # held by its other threads would stay held in the children
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver"
+                    if "forkserver" in methods else "spawn")
+            self._procpool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=context)
+        return await self._run(stage, self._procpool, func, args, kwargs)
+
+    async def _run(self, stage, pool, func, args, kwargs):
+        loop = asyncio.get_running_loop()
+        self._pending[stage] = self._pending.get(stage, 0)+1
+        try:
+            async with self._semaphore(stage):
+                return await loop.run_in_executor(pool,
+                        functools.partial(func, *args, **kwargs))
+        finally:
+            self._pending[stage] -= 1
+
+    def shutdown(self, wait=False):
+        self._pool.shutdown(wait=wait)
+        if self._procpool is not None:
+            self._procpool.shutdown(wait=wait)
+            self._procpool = None
+        self._semaphores = {}
+
+
 class AsyncHTTPClient:
-    def __init__(self, runtime):
+    """
+    Shared aiohttp session for talking to peers.  Connections are kept open
+    for keepalive seconds after a request and reused by later requests to the
+    same peer (keepalive=0 closes each connection after its request).
+    Connections the peer has already closed are discarded when they are next
+    taken from the pool, and an idle connection is closed well before the
+    peer's server would time it out, so a reused connection is rarely stale.
+    """
+
+    def __init__(self, runtime, keepalive=15, limit=80, limitperhost=20):
         self.runtime = runtime
+        self.keepalive = keepalive
+        self.limit = limit
+        self.limitperhost = limitperhost
         self._session = None
         self._session_lock = None
+        self._counts = {"requests": 0, "failures": 0, "connects": 0,
+                "reuses": 0}
+
+    def _trace_config(self):
+        trace = aiohttp.TraceConfig()
+
+        async def on_create(session, context, params):
+            self._counts["connects"] += 1
+
+        async def on_reuse(session, context, params):
+            self._counts["reuses"] += 1
+
+        trace.on_connection_create_end.append(on_create)
+        trace.on_connection_reuseconn.append(on_reuse)
+        return trace
 
     async def _get_session(self):
         if aiohttp is None:
@@ -113,25 +241,31 @@ class AsyncHTTPClient:
         async with self._session_lock:
             if self._session is None or self._session.closed:
                 connector_kwargs = dict(
-                    limit=80,
-                    limit_per_host=20,
+                    limit=self.limit,
+                    limit_per_host=self.limitperhost,
                     ttl_dns_cache=300,
-                    force_close=True,
                 )
+                if self.keepalive:
+                    connector_kwargs["keepalive_timeout"] = self.keepalive
+                else:
+                    connector_kwargs["force_close"] = True
                 if sys.version_info < (3, 14, 3):
                     connector_kwargs["enable_cleanup_closed"] = True
                 connector = aiohttp.TCPConnector(**connector_kwargs)
-                self._session = aiohttp.ClientSession(connector=connector)
+                self._session = aiohttp.ClientSession(connector=connector,
+                        trace_configs=[self._trace_config()])
             return self._session
 
     async def request(self, method, url, **kwargs):
         session = await self._get_session()
         start = time.monotonic()
+        self._counts["requests"] += 1
         if _diag_enabled():
             httplogger.warning("request start %s %s", method, url)
         try:
             response = await session.request(method, url, **kwargs)
         except Exception:
+            self._counts["failures"] += 1
             httplogger.exception("request failed %s %s", method, url)
             raise
         if _diag_enabled():
@@ -139,6 +273,41 @@ class AsyncHTTPClient:
                     method, url, response.status, time.monotonic() - start)
         return response
 
+    def stats(self):
+        """
+        Returns a dict of connection pool counters: requests made and failed,
+        connections opened and reused, the fraction of connections that were
+        reuses, and the connections currently open (idle in the pool or in
+        use).  May be called from any thread; the connection pool is read on
+        the runtime loop, which is the only one that changes it.
+        """
+        stats = dict(self._counts)
+        acquired = stats["connects"] + stats["reuses"]
+        stats["reuserate"] = stats["reuses"] / acquired if acquired else 0.0
+        if self._session is None:
+            idle = inuse = 0
+        elif self.runtime is None or self.runtime.in_runtime_thread():
+            idle, inuse = self._connections()
+        else:
+            async def _read():
+                return self._connections()
+            idle, inuse = self.runtime.submit(_read()).result(timeout=5.0)
+        stats["idleconnections"] = idle
+        stats["openconnections"] = idle + inuse
+        return stats
+
+    def _connections(self):
+        # returns (idle, in use) connection counts; must run on the loop that
+        # owns the session
+        session = self._session
+        if session is None or session.closed:
+            return 0, 0
+        connector = session.connector
+        # XXX: aiohttp has no public accessor for these
+        idle = sum(len(c) for c in getattr(connector, "_conns", {}).values())
+        inuse = len(getattr(connector, "_acquired", ()))
+        return idle, inuse
+
     async def _close(self):
         if self._session is not None and not self._session.closed:
             await self._session.close()
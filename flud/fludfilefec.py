@@ -5,7 +5,8 @@ from zfec.filefec import CorruptedShareFilesError, InsufficientShareFilesError
 from pyutil import fileutil
 from pyutil.mathutil import pad_size, log_ceil
 
-import array, os, re, struct, traceback
+import array, hashlib, os, re, struct, traceback
+from io import BytesIO
 
 FORMAT_FORMAT = "%%s.%%0%dd_%%0%dd%%s"
 RE_FORMAT = "%s.[0-9]+_[0-9]+%s"
@@ -81,6 +82,118 @@ def encode_to_files(inf, fsize, dirname, prefix, k, m, suffix=".fec", overwrite=
         print("Done!")
     return fns
 
+class StreamingEncoder:
+    """
+    Incrementally erasure code a byte stream into m share outputs.  Data is
+    fed in with write() in chunks of any size, and the shares produced are
+    byte-for-byte identical to those from encode_to_files() (segments of
+    k*filefec.CHUNKSIZE bytes, with the final short segment padded the same
+    way easyfec does it), so decode_from_files() can read them back.  A
+    SHA-256 of each complete share (header included) is kept as the data goes
+    by, so callers don't have to re-read the shares to name them.
+
+    @param fsize: the total number of bytes that will be written.  This is
+        needed up front for the share headers.
+    @param outfs: m writable file-like objects, one per share
+    """
+
+    def __init__(self, fsize, k, m, outfs):
+        if len(outfs) != m:
+            raise ValueError("need %d share outputs, got %d" % (m, len(outfs)))
+        self.fsize = fsize
+        self.k = k
+        self.m = m
+        self.outfs = outfs
+        self.segsize = k*filefec.CHUNKSIZE
+        self.enc = zfec.Encoder(k, m)
+        self.hashers = [hashlib.sha256() for i in range(m)]
+        self.buf = bytearray()
+        self.written = 0
+        padbytes = pad_size(fsize, k)
+        for shnum in range(m):
+            self._emit(shnum, filefec._build_header(m, k, padbytes, shnum))
+
+    def _emit(self, shnum, data):
+        self.outfs[shnum].write(data)
+        self.hashers[shnum].update(data)
+
+    def _encodeSegment(self, segment, chunksize):
+        blocks = [segment[i*chunksize:(i+1)*chunksize] for i in range(self.k)]
+        for shnum, block in enumerate(self.enc.encode(blocks)):
+            self._emit(shnum, block)
+
+    def write(self, data):
+        self.written += len(data)
+        if self.written > self.fsize:
+            raise IOError("Wrong file size -- possibly the size of the"
+                    " file changed during encoding.  Original size: %d,"
+                    " observed size at least: %s" % (self.fsize, self.written))
+        self.buf += data
+        nsegs = len(self.buf) // self.segsize
+        if nsegs:
+            view = memoryview(self.buf)
+            for s in range(nsegs):
+                self._encodeSegment(
+                        view[s*self.segsize:(s+1)*self.segsize],
+                        filefec.CHUNKSIZE)
+            view.release()
+            del self.buf[:nsegs*self.segsize]
+
+    def close(self):
+        """
+        Encode whatever is left over and return the hex SHA-256 digests of
+        the m shares, in share order.
+        """
+        if self.written != self.fsize:
+            raise IOError("Wrong file size -- possibly the size of the"
+                    " file changed during encoding.  Original size: %d,"
+                    " observed size: %s" % (self.fsize, self.written))
+        if self.buf:
+            chunksize = (len(self.buf) + self.k - 1) // self.k
+            self.buf += b'\x00' * (chunksize*self.k - len(self.buf))
+            self._encodeSegment(bytes(self.buf), chunksize)
+            self.buf = bytearray()
+        return [h.hexdigest() for h in self.hashers]
+
+def encode_to_buffers(data, k, m):
+    """
+    Erasure code data (bytes) into m shares held in memory.  Returns the
+    contents of the shares, in share order, each identical to the share
+    file encode_to_files() would have written.
+    """
+    outfs = [BytesIO() for i in range(m)]
+    encoder = StreamingEncoder(len(data), k, m, outfs)
+    encoder.write(data)
+    encoder.close()
+    return [f.getvalue() for f in outfs]
+
+def open_share_files(dirname, prefix, m, suffix=".fec", overwrite=False):
+    """
+    Create the m specially named share files that encode_to_files() would
+    create, returning (filenames, fileobjects).
+    """
+    mlen = len(str(m))
+    format = FORMAT_FORMAT % (mlen, mlen,)
+    fns = []
+    fs = []
+    try:
+        for shnum in range(m):
+            fn = os.path.join(dirname, format % (prefix, shnum, m, suffix,))
+            if overwrite:
+                f = open(fn, "wb")
+            else:
+                flags = os.O_WRONLY|os.O_CREAT|os.O_EXCL | (hasattr(os,
+                        'O_BINARY') and os.O_BINARY)
+                f = os.fdopen(os.open(fn, flags), "wb")
+            fs.append(f)
+            fns.append(fn)
+    except EnvironmentError:
+        for f, fn in zip(fs, fns):
+            f.close()
+            fileutil.remove_if_possible(fn)
+        raise
+    return fns, fs
+
 # Note: if you really prefer base-2 and you change this code, then please
 # denote 2^20 as "MiB" instead of "MB" in order to avoid ambiguity.
 # Thanks.
@@ -137,28 +250,29 @@ def decode_from_files(outf, infiles, verbose=False):
 
     dec = easyfec.Decoder(k, m)
 
+    # the pad is only stripped from the last chunk, so read a chunk ahead to
+    # know which one that is (the last one may be a full CHUNKSIZE)
+    chunks = [ inf.read(filefec.CHUNKSIZE) for inf in infs ]
     while True:
-        chunks = [ inf.read(filefec.CHUNKSIZE) for inf in infs ]
         if [ch for ch in chunks if len(ch) != len(chunks[-1])]:
             raise CorruptedShareFilesError("Share files were corrupted --"
                     " all share files are required to be the same length,"
                     " but they weren't.")
 
-        if len(chunks[-1]) == filefec.CHUNKSIZE:
-            # Then this was a full read, so we're still in the sharefiles.
-            resultdata = dec.decode(chunks, shnums, padlen=0)
-            outf.write(resultdata)
-            byteswritten += len(resultdata)
-            if verbose:
-                if ((byteswritten - len(resultdata)) / (10*MILLION_BYTES)) \
-                        != (byteswritten / (10*MILLION_BYTES)):
-                    print(str(byteswritten / MILLION_BYTES) + " MB ...", end=' ')
-        else:
-            # Then this was a short read, so we've reached the end of the
-            # sharefiles.
-            resultdata = dec.decode(chunks, shnums, padlen)
-            outf.write(resultdata)
-            return True
+        last = len(chunks[-1]) != filefec.CHUNKSIZE
+        if not last:
+            nextchunks = [ inf.read(filefec.CHUNKSIZE) for inf in infs ]
+            last = not [ch for ch in nextchunks if ch]
+        resultdata = dec.decode(chunks, shnums, padlen if last else 0)
+        outf.write(resultdata)
+        byteswritten += len(resultdata)
+        if verbose:
+            if ((byteswritten - len(resultdata)) / (10*MILLION_BYTES)) \
+                    != (byteswritten / (10*MILLION_BYTES)):
+                print(str(byteswritten / MILLION_BYTES) + " MB ...", end=' ')
+        if last:
+            break
+        chunks = nextchunks
     if verbose:
         print()
         print("Done!")
@@ -8,26 +8,42 @@ import asyncio
 import base64
 import binascii
 import gzip
+import hashlib
+import hmac
 import logging
 import os
-import random
 import tarfile
 import tempfile
 import threading
-from io import BytesIO
+import time
+from collections import OrderedDict
 
 from aiohttp import web
 
 import flud.TarfileUtils as TarfileUtils
-from flud.FludCrypto import FludRSA, generateRandom, hashfile, hashstring
+from flud.FludCrypto import FludRSA, generateRandom, hashstring
 from flud.fencode import fencode, fdecode
 
 from . import BlockFile
+from .PackStore import PackStore
 from .AsyncLocal import AsyncLocalServer
 from .FludCommUtil import PROTOCOL_VERSION, primitive_to, requireParams, updateNode, getCanonicalIP
+from .FludCommUtil import NODELIST_TYPE, encodeNodeList
 
 logger = logging.getLogger("flud.server.aiohttp")
 
+# read sizes for streamed STORE payloads and non-sendfile RETRIEVE bodies
+STORECHUNK = 65536
+SENDCHUNK = 262144
+# lifetime, in seconds, of the session tokens issued after a successful
+# challenge
+SESSION_TO = 300
+# where a request's newly issued session token waits to be added to the
+# response headers
+SESSIONKEY = web.RequestKey("fludsession", str)
+# blocks smaller than this go into the requester's pack instead of a BlockFile
+PACKSIZE = 8192
+
 
 class _RequestAdapter:
     def __init__(self, request, extra_args=None):
@@ -67,6 +83,10 @@ class FludAiohttpServer(threading.Thread):
         self._stop_event = None
         self._local_server = None
         self._challenges = {}
+        self._session_key = generateRandom(32)
+        self._packs = OrderedDict()
+        self._packopens = {}
+        self._packstats = {"hits": 0, "misses": 0}
         self.daemon = True
 
     def _base_headers(self):
@@ -129,14 +149,45 @@ class FludAiohttpServer(threading.Thread):
         echallenge = fencode(echallenge)
         body = "challenge = %s" % echallenge
         headers = {
-            "Connection": "close",
             "WWW-Authenticate": 'Basic realm="default"',
             "Content-Type": "text/html",
             "Pragma": "claimreserve=5555",
         }
         return self._response(status=401, reason=echallenge, text=body, headers=headers)
 
+    def _session_mac(self, node_id, host, expiry):
+        msg = ("%s:%s:%d" % (node_id, host, expiry)).encode("utf-8")
+        return hmac.new(self._session_key, msg, hashlib.sha256).hexdigest()
+
+    def _issue_session(self, request, node_id, host):
+        # tokens are bound to the requester's ID and address, and carry their
+        # own expiry, so the server needn't remember them
+        expiry = int(time.time()) + SESSION_TO
+        request[SESSIONKEY] = fencode((expiry, self._session_mac(node_id, host, expiry)))
+
+    def _check_session(self, request, node_id, host):
+        token = request.headers.get("Fludsession")
+        if not token:
+            return False
+        try:
+            expiry, mac = fdecode(token)
+        except Exception:
+            return False
+        if not isinstance(expiry, int) or not isinstance(mac, str) or expiry < time.time():
+            return False
+        return hmac.compare_digest(mac, self._session_mac(node_id, host, expiry))
+
+    async def _add_session_headers(self, request, response):
+        token = request.get(SESSIONKEY)
+        if token:
+            response.headers["Fludsession"] = token
+            response.headers["Fludsessionttl"] = str(SESSION_TO)
+
     def _authenticate(self, request, req_ku, host, port):
+        if self._check_session(request, req_ku.id(), host):
+            updateNode(self.node.client, self.node.config, host, port, req_ku, req_ku.id())
+            return None
+
         challenge_response, group_response = self._parse_basic_auth(request)
         if not challenge_response or not group_response:
             return self._send_challenge(req_ku, self.node.config.nodeID)
@@ -146,38 +197,127 @@ class FludAiohttpServer(threading.Thread):
             expected_group = hashstring(str(req_ku.exportPublicKey()) + str(self.node.config.groupIDr))
             if group_response == expected_group:
                 updateNode(self.node.client, self.node.config, host, port, req_ku, req_ku.id())
+                self._issue_session(request, req_ku.id(), host)
                 return None
             return self._response(status=403, text="Group Challenge Failed")
         return self._response(status=403, text="Challenge Failed")
 
-    def _field_bytes(self, form, name):
-        if name not in form:
-            return None
-        value = form[name]
-        if hasattr(value, "file"):
-            data = value.file.read()
-            if isinstance(data, str):
-                data = data.encode("utf-8")
-            return data
-        if isinstance(value, bytes):
-            return value
-        if value is None:
-            return None
-        return str(value).encode("utf-8")
+    async def _pack_store(self, node_id):
+        # pack indexes are read from disk when first needed and then kept
+        # here, updated in place by every write, for the packindexes most
+        # recently used requesters.  Reading one (and importing any legacy
+        # tarballs) is done off the event loop, once even if several
+        # requests want it at the same time.
+        packs = self._packs.get(node_id)
+        if packs is not None:
+            self._packstats["hits"] += 1
+            self._packs.move_to_end(node_id)
+            return packs
+        opening = self._packopens.get(node_id)
+        if opening is None:
+            self._packstats["misses"] += 1
+            opening = asyncio.get_running_loop().run_in_executor(None,
+                    PackStore, os.path.join(self.node.config.storedir, node_id))
+            self._packopens[node_id] = opening
+            try:
+                packs = await opening
+            finally:
+                del self._packopens[node_id]
+            self._packs[node_id] = packs
+            self._evict_pack_stores()
+            return packs
+        return await asyncio.shield(opening)
+
+    def _evict_pack_stores(self):
+        excess = len(self._packs)-self.node.config.packindexes
+        for node_id, packs in list(self._packs.items()):
+            if excess <= 0:
+                break
+            # a store being compacted is still in use; a second one opened
+            # for the same requester meanwhile would see a stale pack
+            if not packs.compacting:
+                del self._packs[node_id]
+                excess -= 1
+
+    def stats(self):
+        """
+        Returns a dict of counters describing the server's caches.
+        """
+        return {
+            "packindexes": len(self._packs),
+            "packindexhits": self._packstats["hits"],
+            "packindexmisses": self._packstats["misses"],
+            "packmembers": sum(len(p) for p in self._packs.values()),
+        }
+
+    def _maybe_compact(self, packs):
+        if not packs.needsCompaction():
+            return
+
+        def compact():
+            try:
+                packs.compact()
+            except Exception:
+                logger.exception("compacting pack store %s failed", packs.base)
+
+        asyncio.get_running_loop().run_in_executor(None, compact)
+
+    def _part_header(self, content_id, length, boundary):
+        return b"".join([
+            ("--%s\r\n" % boundary).encode("utf-8"),
+            b"Content-Type: Application/octet-stream\r\n",
+            ("Content-ID: %s\r\n" % content_id).encode("utf-8"),
+            ("Content-Length: %d\r\n" % length).encode("utf-8"),
+            b"\r\n"])
+
+    def _part_trailer(self, boundary):
+        return ("\r\n--%s--\r\n" % boundary).encode("utf-8")
 
     def _build_multipart(self, parts, boundary):
         chunks = []
         for content_id, payload in parts:
-            chunks.append(("--%s\r\n" % boundary).encode("utf-8"))
-            chunks.append(b"Content-Type: Application/octet-stream\r\n")
-            chunks.append(("Content-ID: %s\r\n" % content_id).encode("utf-8"))
-            chunks.append(("Content-Length: %d\r\n" % len(payload)).encode("utf-8"))
-            chunks.append(b"\r\n")
+            chunks.append(self._part_header(content_id, len(payload), boundary))
             chunks.append(payload)
             chunks.append(b"\r\n")
-        chunks.append(("\r\n--%s--\r\n" % boundary).encode("utf-8"))
+        chunks.append(self._part_trailer(boundary))
         return b"".join(chunks)
 
+    async def _send_region(self, request, headers, fobj, offset, count,
+            prefix=b"", suffix=b""):
+        """
+        Sends prefix, then count bytes of fobj starting at offset, then
+        suffix, as the response body.  The file region goes out with
+        sendfile() where the transport supports it.
+        """
+        hdrs = self._base_headers()
+        hdrs.update(headers)
+        resp = web.StreamResponse(headers=hdrs)
+        resp.content_length = len(prefix) + count + len(suffix)
+        await resp.prepare(request)
+        if prefix:
+            await resp.write(prefix)
+        if count:
+            loop = asyncio.get_running_loop()
+            transport = request.transport
+            if transport is None:
+                raise ConnectionResetError("Connection lost")
+            try:
+                await loop.sendfile(transport, fobj, offset, count)
+            except NotImplementedError:
+                # e.g., TLS transports; fall back to bounded reads
+                fobj.seek(offset)
+                while count > 0:
+                    chunk = await loop.run_in_executor(None, fobj.read,
+                            min(SENDCHUNK, count))
+                    if not chunk:
+                        break
+                    await resp.write(chunk)
+                    count -= len(chunk)
+        if suffix:
+            await resp.write(suffix)
+        await resp.write_eof()
+        return resp
+
     async def _handle_root(self, request):
         return self._response(text="<html>Flud</html>")
 
@@ -188,7 +328,7 @@ class FludAiohttpServer(threading.Thread):
         except Exception as exc:
             return self._response(status=400, text="%s in request received by ID" % exc.args[0])
 
-        req_ku = {"e": int(params["Ku_e"]), "n": int(params["Ku_n"])}
+        req_ku = {"e": params["Ku_e"], "n": params["Ku_n"]}
         req_ku = FludRSA.importPublicKey(req_ku)
         if req_ku.id() != params["nodeID"]:
             return self._response(status=400, text="requesting node's ID and public key do not match")
@@ -197,125 +337,107 @@ class FludAiohttpServer(threading.Thread):
         updateNode(self.node.client, self.node.config, host, int(params["port"]), req_ku, params["nodeID"])
         return self._response(text=str(self.node.config.Ku.exportPublicKey()))
 
+    async def _receive_payload(self, part, suffix=""):
+        """
+        Streams a multipart file part into a temporary file in storedir,
+        hashing it as it arrives.  Returns (tmpfile, size, sha256 hexdigest).
+        """
+        fd, tmpfile = tempfile.mkstemp(suffix=suffix, dir=self.node.config.storedir)
+        sha256 = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(fd, "wb") as f:
+                while True:
+                    chunk = await part.read_chunk(STORECHUNK)
+                    if not chunk:
+                        break
+                    sha256.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            os.remove(tmpfile)
+            raise
+        return tmpfile, size, sha256.hexdigest()
+
     async def _handle_file_post(self, request):
-        form = await request.post()
+        filekey = request.match_info["filekey"]
+        if not request.content_type.startswith("multipart/"):
+            return self._response(status=400, text="Bad request: missing file payload in STORE")
+        reader = await request.multipart()
+
+        # Scalar form fields are sent ahead of the file payloads, so the
+        # request is checked and authenticated before any payload is read.
         form_args = {}
-        for k, v in form.items():
-            # Only scalar form fields belong in args for requireParams;
-            # file payload fields are handled separately below.
-            if hasattr(v, "file"):
-                continue
-            form_args[k] = v
+        part = await reader.next()
+        while part is not None and part.filename is None:
+            form_args[part.name] = await part.text()
+            part = await reader.next()
 
         req = _RequestAdapter(request, extra_args=form_args)
-        filekey = request.match_info["filekey"]
         try:
             params = requireParams(req, ("size", "Ku_e", "Ku_n", "port"))
         except Exception as exc:
             return self._response(status=400, text="%s in request received by STORE" % exc.args[0])
 
         host = getCanonicalIP(req.getClientIP())
-        req_ku = {"e": int(params["Ku_e"]), "n": int(params["Ku_n"])}
+        req_ku = {"e": params["Ku_e"], "n": params["Ku_n"]}
         req_ku = FludRSA.importPublicKey(req_ku)
         auth_resp = self._authenticate(request, req_ku, host, int(params["port"]))
         if auth_resp is not None:
             return auth_resp
 
-        data = self._field_bytes(form, "filename")
-        if data is None:
-            return self._response(status=400, text="Bad request: missing file payload in STORE")
-
-        tmpfile = tempfile.mktemp(dir=self.node.config.storedir)
-        tarball_base = os.path.join(self.node.config.storedir, req_ku.id()) + ".tar"
-        tarball = tarball_base
-
         tmp_tar_mode = None
+        suffix = ""
         if filekey.endswith(".tar"):
-            tmpfile = tmpfile + ".tar"
+            suffix = ".tar"
             tmp_tar_mode = "r"
-            target_tar = tarball
         elif filekey.endswith(".tar.gz"):
-            tmpfile = tmpfile + ".tar.gz"
+            suffix = ".tar.gz"
             tmp_tar_mode = "r:gz"
-            target_tar = tarball + ".gz"
-
-        if os.path.exists(tarball + ".gz"):
-            tarball = (tarball + ".gz", "r:gz")
-        elif os.path.exists(tarball):
-            tarball = (tarball, "r")
-        else:
-            tarball = None
 
-        with open(tmpfile, "wb") as f:
-            f.write(data)
+        tmpfile = None
+        meta = None
+        try:
+            while part is not None:
+                if part.name == "filename" and tmpfile is None:
+                    tmpfile, size, digest = await self._receive_payload(part, suffix)
+                elif part.name == "meta":
+                    meta = bytes(await part.read())
+                elif part.filename is None:
+                    form_args[part.name] = await part.text()
+                part = await reader.next()
+        except BaseException:
+            if tmpfile is not None:
+                os.remove(tmpfile)
+            raise
+        if tmpfile is None:
+            return self._response(status=400, text="Bad request: missing file payload in STORE")
 
         node_id = req_ku.id()
         if tmp_tar_mode:
-            if not data:
+            if not size:
+                os.remove(tmpfile)
                 return self._response(status=400, text="Bad request: empty tar payload in STORE")
             digests = TarfileUtils.verifyHashes(tmpfile, ".meta")
             if not digests:
                 os.remove(tmpfile)
                 return self._response(status=409, text="Attempted to use non-CAS storage key(s) for STORE tarball")
-            gzipped_target = target_tar.endswith(".gz")
-            work_tar = target_tar[:-3] if gzipped_target else target_tar
-            if os.path.exists(target_tar) and gzipped_target:
-                try:
-                    work_tar = TarfileUtils.gunzipTarball(target_tar)
-                except (tarfile.ReadError, EOFError, gzip.BadGzipFile, OSError) as exc:
-                    logger.warning("STORE tar merge: failed to gunzip %s: %s",
-                            target_tar, str(exc))
-                    try:
-                        os.remove(target_tar)
-                    except Exception:
-                        pass
-            mode = "a" if os.path.exists(work_tar) else "w"
             try:
-                dst = tarfile.open(work_tar, mode)
+                packs = await self._pack_store(node_id)
+                packs.importTarball(tmpfile, tmp_tar_mode)
             except (tarfile.ReadError, EOFError, gzip.BadGzipFile, OSError) as exc:
-                logger.warning("STORE tar merge: replacing corrupt tarball %s: %s",
-                        work_tar, str(exc))
-                try:
-                    os.remove(work_tar)
-                except Exception:
-                    pass
-                dst = tarfile.open(work_tar, "w")
-            try:
-                try:
-                    existing = set(dst.getnames())
-                except (tarfile.ReadError, EOFError, gzip.BadGzipFile, OSError):
-                    existing = set()
-                src = tarfile.open(tmpfile, tmp_tar_mode)
-                try:
-                    for member in src.getmembers():
-                        if member.name in existing:
-                            continue
-                        fileobj = src.extractfile(member) if member.isfile() else None
-                        dst.addfile(member, fileobj)
-                        if fileobj:
-                            fileobj.close()
-                finally:
-                    src.close()
+                logger.warning("STORE tar merge: bad tarball from %s: %s", node_id, str(exc))
+                return self._response(status=400, text="Bad request: unreadable tar payload in STORE")
             finally:
-                dst.close()
-            try:
                 os.remove(tmpfile)
-            except Exception:
-                pass
-            if gzipped_target:
-                TarfileUtils.gzipTarball(work_tar)
             return self._response(text="Successful STORE")
 
-        h = hashfile(tmpfile)
-        if fencode(int(h, 16)) != filekey:
+        if fencode(int(digest, 16)) != filekey:
             os.remove(tmpfile)
-            msg = "Attempted to use non-CAS storage key for STORE data (%s != %s)" % (filekey, fencode(int(h, 16)))
+            msg = "Attempted to use non-CAS storage key for STORE data (%s != %s)" % (filekey, fencode(int(digest, 16)))
             return self._response(status=409, text=msg)
 
-        metakey = form.get("metakey")
-        if metakey is not None:
-            metakey = str(metakey)
-        meta = self._field_bytes(form, "meta")
+        metakey = form_args.get("metakey")
 
         fname = os.path.join(self.node.config.storedir, filekey)
         if os.path.exists(fname):
@@ -328,86 +450,21 @@ class FludAiohttpServer(threading.Thread):
             os.remove(tmpfile)
             return self._response(text="Successful STORE")
 
-        tarname = tarball_base
-        tarball_paths = []
-        if os.path.exists(tarname + ".gz"):
-            tarball_paths.append((tarname + ".gz", "r:gz"))
-        if os.path.exists(tarname):
-            tarball_paths.append((tarname, "r"))
+        packs = await self._pack_store(node_id)
+        mfname = "%s.%s.meta" % (filekey, metakey)
+        if filekey in packs:
+            os.remove(tmpfile)
+            if meta and metakey is not None and mfname not in packs:
+                packs.put(mfname, meta)
+            return self._response(text="Successful STORE")
 
-        for tarpath, openmode in tarball_paths:
-            try:
-                tar = tarfile.open(tarpath, openmode)
-            except (tarfile.ReadError, EOFError, gzip.BadGzipFile, OSError) as exc:
-                logger.warning("STORE metadata check: removing corrupt tarball %s: %s",
-                        tarpath, str(exc))
-                try:
-                    os.remove(tarpath)
-                except Exception:
-                    pass
-                continue
-            try:
-                names = tar.getnames()
-                if filekey in names:
-                    if meta and metakey is not None:
-                        mfname = "%s.%s.meta" % (filekey, metakey)
-                        if mfname not in names:
-                            tar.close()
-                            if openmode == "r:gz":
-                                tarpath = TarfileUtils.gunzipTarball(tarpath)
-                            tar = tarfile.open(tarpath, "a")
-                            metaio = BytesIO(meta)
-                            tinfo = tarfile.TarInfo(mfname)
-                            tinfo.size = len(meta)
-                            tar.addfile(tinfo, metaio)
-                            tar.close()
-                            if openmode == "r:gz":
-                                TarfileUtils.gzipTarball(tarpath)
-                    return self._response(text="Successful STORE")
-            except (tarfile.ReadError, EOFError, gzip.BadGzipFile, OSError) as exc:
-                # Corrupt or partially-written tarball; ignore and continue.
-                logger.warning("STORE metadata read: corrupt tarball %s: %s",
-                        tarpath, str(exc))
-                try:
-                    os.remove(tarpath)
-                except Exception:
-                    pass
-                continue
-            finally:
-                try:
-                    tar.close()
-                except Exception:
-                    pass
-
-        if len(data) < 8192 and fname != tarname:
-            gzipped = False
-            if os.path.exists(tarname + ".gz"):
-                tarname = TarfileUtils.gunzipTarball(tarname + ".gz")
-                gzipped = True
-            if not os.path.exists(tarname):
-                tarballf = tarfile.open(tarname, "w")
-            else:
-                try:
-                    tarballf = tarfile.open(tarname, "a")
-                except (tarfile.ReadError, EOFError, gzip.BadGzipFile, OSError) as exc:
-                    logger.warning("STORE aggregation: replacing corrupt tarball %s: %s",
-                            tarname, str(exc))
-                    try:
-                        os.remove(tarname)
-                    except Exception:
-                        pass
-                    tarballf = tarfile.open(tarname, "w")
-            tarballf.add(tmpfile, os.path.basename(fname))
-            if meta:
-                metafilename = "%s.%s.meta" % (os.path.basename(fname), metakey)
-                metaio = BytesIO(meta)
-                tinfo = tarfile.TarInfo(metafilename)
-                tinfo.size = len(meta)
-                tarballf.addfile(tinfo, metaio)
-            tarballf.close()
-            if gzipped:
-                TarfileUtils.gzipTarball(tarname)
+        if size < PACKSIZE:
+            with open(tmpfile, "rb") as f:
+                members = [(filekey, f.read())]
             os.remove(tmpfile)
+            if meta:
+                members.append((mfname, meta))
+            packs.putMany(members)
         else:
             os.rename(tmpfile, fname)
             BlockFile.convert(fname, (int(node_id, 16), {metakey: meta}))
@@ -423,7 +480,7 @@ class FludAiohttpServer(threading.Thread):
             return self._response(status=400, text="%s in request received by RETRIEVE" % exc.args[0])
 
         host = getCanonicalIP(req.getClientIP())
-        req_ku = {"e": int(params["Ku_e"]), "n": int(params["Ku_n"])}
+        req_ku = {"e": params["Ku_e"], "n": params["Ku_n"]}
         req_ku = FludRSA.importPublicKey(req_ku)
         auth_resp = self._authenticate(request, req_ku, host, int(params["port"]))
         if auth_resp is not None:
@@ -438,76 +495,62 @@ class FludAiohttpServer(threading.Thread):
         boundary = binascii.hexlify(generateRandom(13)).decode("ascii")
 
         if not os.path.exists(fname):
-            tarball = os.path.join(self.node.config.storedir, req_ku.id() + ".tar")
-            tarballs = []
-            if os.path.exists(tarball + ".gz"):
-                tarballs.append((tarball + ".gz", "r:gz"))
-            if os.path.exists(tarball):
-                tarballs.append((tarball, "r"))
-            for tarpath, openmode in tarballs:
-                try:
-                    tar = tarfile.open(tarpath, openmode)
-                except (tarfile.ReadError, EOFError, gzip.BadGzipFile, OSError) as exc:
-                    logger.warning("RETRIEVE: ignoring corrupt tarball %s: %s",
-                            tarpath, str(exc))
-                    continue
-                try:
-                    try:
-                        tinfo = tar.getmember(filekey)
-                    except KeyError:
-                        names = tar.getnames()
-                        alt = None
-                        for n in names:
-                            if n == filekey or (n.startswith("./") and n[2:] == filekey) or n.endswith(filekey):
-                                alt = n
-                                break
-                        if not alt:
-                            continue
-                        tinfo = tar.getmember(alt)
-
-                    data = tar.extractfile(tinfo).read()
-                    parts = []
-                    metas = [n for n in tar.getnames() if n.startswith(filekey) and n.endswith("meta")]
-                    if metakey is not None:
-                        metas = [n for n in metas if n == ("%s.%s.meta" % (filekey, metakey))]
-                    for m in metas:
-                        minfo = tar.getmember(m)
-                        mpayload = tar.extractfile(minfo).read()
-                        parts.append((m, mpayload))
-                    if parts:
-                        parts.append((filekey, data))
-                        body = self._build_multipart(parts, boundary)
-                        return self._response(body=body, headers={"Content-type": "Multipart/Related", "boundary": boundary})
-                    return self._response(body=data, headers={"Content-Type": "application/octet-stream"})
-                except (tarfile.ReadError, EOFError, gzip.BadGzipFile, OSError) as exc:
-                    # Ignore corrupt tarballs and continue checking other candidates.
-                    logger.warning("RETRIEVE: corrupt tarball while reading %s: %s",
-                            tarpath, str(exc))
-                    continue
-                finally:
-                    tar.close()
-            return self._response(status=404, text="Not found: %s" % filekey)
-
-        f = BlockFile.open(fname, "rb")
-        req_meta_id = req_ku.id()
-        if req_node_id:
-            req_meta_id = req_node_id
-        meta = f.meta(int(req_meta_id, 16))
-        if metakey is not None and meta:
-            meta = {metakey: meta.get(metakey)} if metakey in meta else None
-        payload = f.read()
-        f.close()
+            packs = await self._pack_store(req_ku.id())
+            region = packs.openRegion(filekey)
+            if region is None:
+                return self._response(status=404, text="Not found: %s" % filekey)
+            fobj, offset, length = region
+            try:
+                metas = [n for n in packs.names(filekey) if n.endswith("meta")]
+                if metakey is not None:
+                    metas = [n for n in metas if n == ("%s.%s.meta" % (filekey, metakey))]
+                prefix = []
+                for m in metas:
+                    mpayload = packs.get(m)
+                    if mpayload is None:
+                        continue
+                    prefix.append(self._part_header(m, len(mpayload), boundary))
+                    prefix.append(mpayload)
+                    prefix.append(b"\r\n")
+                if not prefix:
+                    return await self._send_region(request,
+                            {"Content-Type": "application/octet-stream"},
+                            fobj, offset, length)
+                prefix.append(self._part_header(filekey, length, boundary))
+                return await self._send_region(request,
+                        {"Content-type": "Multipart/Related", "boundary": boundary},
+                        fobj, offset, length,
+                        b"".join(prefix), b"\r\n" + self._part_trailer(boundary))
+            finally:
+                fobj.close()
 
-        parts = []
-        if meta:
+        f = BlockFile.view(fname)
+        try:
+            req_meta_id = req_ku.id()
+            if req_node_id:
+                req_meta_id = req_node_id
+            meta = f.meta(int(req_meta_id, 16))
+            if metakey is not None and meta:
+                meta = {metakey: meta.get(metakey)} if metakey in meta else None
+
+            if not meta:
+                return await self._send_region(request,
+                        {"Content-Type": "application/octet-stream"},
+                        f.fileobj(), f.dataOffset(), f.dataLength())
+
+            prefix = []
             meta = {k: (v if isinstance(v, bytes) else str(v).encode("utf-8")) for k, v in meta.items()}
             for m in meta:
-                parts.append(("%s.%s.meta" % (filekey, m), meta[m]))
-        if parts:
-            parts.append((filekey, payload))
-            body = self._build_multipart(parts, boundary)
-            return self._response(body=body, headers={"Content-type": "Multipart/Related", "boundary": boundary})
-        return self._response(body=payload, headers={"Content-Type": "application/octet-stream"})
+                prefix.append(self._part_header("%s.%s.meta" % (filekey, m), len(meta[m]), boundary))
+                prefix.append(meta[m])
+                prefix.append(b"\r\n")
+            prefix.append(self._part_header(filekey, f.dataLength(), boundary))
+            return await self._send_region(request,
+                    {"Content-type": "Multipart/Related", "boundary": boundary},
+                    f.fileobj(), f.dataOffset(), f.dataLength(),
+                    b"".join(prefix), b"\r\n" + self._part_trailer(boundary))
+        finally:
+            f.close()
 
     async def _handle_hash_get(self, request):
         req = _RequestAdapter(request)
@@ -518,7 +561,7 @@ class FludAiohttpServer(threading.Thread):
             return self._response(status=400, text="%s in request received by VERIFY" % exc.args[0])
 
         host = getCanonicalIP(req.getClientIP())
-        req_ku = {"e": int(params["Ku_e"]), "n": int(params["Ku_n"])}
+        req_ku = {"e": params["Ku_e"], "n": params["Ku_n"]}
         req_ku = FludRSA.importPublicKey(req_ku)
         auth_resp = self._authenticate(request, req_ku, host, int(params["port"]))
         if auth_resp is not None:
@@ -552,69 +595,18 @@ class FludAiohttpServer(threading.Thread):
             f.close()
             return self._response(text=hashstring(data))
 
-        tarballs = []
-        tarballbase = os.path.join(self.node.config.storedir, req_ku.id()) + ".tar"
-        if os.path.exists(tarballbase + ".gz"):
-            tarballs.append((tarballbase + ".gz", "r:gz"))
-        if os.path.exists(tarballbase):
-            tarballs.append((tarballbase, "r"))
-
-        for tarball, openmode in tarballs:
-            try:
-                tar = tarfile.open(tarball, openmode)
-            except (tarfile.ReadError, EOFError, gzip.BadGzipFile, OSError) as exc:
-                logger.warning("VERIFY: ignoring corrupt tarball %s: %s",
-                        tarball, str(exc))
-                continue
-            try:
-                tarf = tar.extractfile(filekey)
-                tari = tar.getmember(filekey)
-                fsize = tari.size
-                if offset > fsize or (offset + length) > fsize:
-                    return self._response(status=400, text="Bad request: bad offset/length in VERIFY")
-                tarf.seek(offset)
-                data = tarf.read(length)
-                tarf.close()
-
-                if meta:
-                    mfname = "%s.%s.meta" % (filekey, meta[0])
-                    if mfname in tar.getnames():
-                        tarmf = tar.extractfile(mfname)
-                        stored_meta = tarmf.read()
-                        tarmf.close()
-                        if meta[1] != stored_meta:
-                            tar.close()
-                            TarfileUtils.delete(tarball, mfname)
-                            if openmode == "r:gz":
-                                tarball = TarfileUtils.gunzipTarball(tarball)
-                            tar = tarfile.open(tarball, "a")
-                            metaio = BytesIO(meta[1])
-                            tinfo = tarfile.TarInfo(mfname)
-                            tinfo.size = len(meta[1])
-                            tar.addfile(tinfo, metaio)
-                            tar.close()
-                            if openmode == "r:gz":
-                                TarfileUtils.gzipTarball(tarball)
-                    else:
-                        tar.close()
-                        if openmode == "r:gz":
-                            tarball = TarfileUtils.gunzipTarball(tarball)
-                        tar = tarfile.open(tarball, "a")
-                        metaio = BytesIO(meta[1])
-                        tinfo = tarfile.TarInfo(mfname)
-                        tinfo.size = len(meta[1])
-                        tar.addfile(tinfo, metaio)
-                        tar.close()
-                        if openmode == "r:gz":
-                            TarfileUtils.gzipTarball(tarball)
-                return self._response(text=hashstring(data))
-            except Exception:
-                pass
-            finally:
-                try:
-                    tar.close()
-                except Exception:
-                    pass
+        packs = await self._pack_store(req_ku.id())
+        fsize = packs.size(filekey)
+        if fsize is not None:
+            if offset > fsize or (offset + length) > fsize:
+                return self._response(status=400, text="Bad request: bad offset/length in VERIFY")
+            data = packs.get(filekey, offset, length)
+            if meta:
+                mfname = "%s.%s.meta" % (filekey, meta[0])
+                if packs.get(mfname) != meta[1]:
+                    packs.put(mfname, meta[1])
+                    self._maybe_compact(packs)
+            return self._response(text=hashstring(data))
 
         return self._response(status=404, text="Not found: not storing %s" % filekey)
 
@@ -627,7 +619,7 @@ class FludAiohttpServer(threading.Thread):
             return self._response(status=400, text="%s in request received by DELETE" % exc.args[0])
 
         host = getCanonicalIP(req.getClientIP())
-        req_ku = {"e": int(params["Ku_e"]), "n": int(params["Ku_n"])}
+        req_ku = {"e": params["Ku_e"], "n": params["Ku_n"]}
         req_ku = FludRSA.importPublicKey(req_ku)
         auth_resp = self._authenticate(request, req_ku, host, int(params["port"]))
         if auth_resp is not None:
@@ -637,28 +629,16 @@ class FludAiohttpServer(threading.Thread):
         req_id = req_ku.id()
         fname = os.path.join(self.node.config.storedir, filekey)
         if not os.path.exists(fname):
-            tarballs = []
-            tarballbase = os.path.join(self.node.config.storedir, req_ku.id()) + ".tar"
-            if os.path.exists(tarballbase + ".gz"):
-                tarballs.append((tarballbase + ".gz", "r:gz"))
-            if os.path.exists(tarballbase):
-                tarballs.append((tarballbase, "r"))
-            for tarball, openmode in tarballs:
-                mfilekey = "%s.%s.meta" % (filekey, metakey)
-                try:
-                    tar = tarfile.open(tarball, openmode)
-                except (tarfile.ReadError, EOFError, gzip.BadGzipFile, OSError) as exc:
-                    logger.warning("DELETE: ignoring corrupt tarball %s: %s",
-                            tarball, str(exc))
-                    continue
-                mnames = [n for n in tar.getnames() if n[:len(filekey)] == filekey]
-                tar.close()
-                if len(mnames) > 2:
-                    TarfileUtils.delete(tarball, mfilekey)
-                else:
-                    TarfileUtils.delete(tarball, [filekey, mfilekey])
-                return self._response(text="")
-            return self._response(status=404, text="Not found: %s" % filekey)
+            packs = await self._pack_store(req_id)
+            if not len(packs):
+                return self._response(status=404, text="Not found: %s" % filekey)
+            mfilekey = "%s.%s.meta" % (filekey, metakey)
+            if len(packs.names(filekey)) > 2:
+                packs.delete([mfilekey])
+            else:
+                packs.delete([filekey, mfilekey])
+            self._maybe_compact(packs)
+            return self._response(text="")
 
         f = BlockFile.open(fname, "rb+")
         n_id = int(req_id, 16)
@@ -671,6 +651,14 @@ class FludAiohttpServer(threading.Thread):
         f.close()
         return self._response(text="")
 
+    def _node_list_response(self, request, nodes):
+        if NODELIST_TYPE in request.headers.get("Accept", ""):
+            body = encodeNodeList(self.node.config.nodeID, nodes)
+            return self._response(body=body, headers={"Content-Type": NODELIST_TYPE})
+        # older clients parse this python-literal form
+        body = "{'id': '%s', 'k': %s}" % (self.node.config.nodeID, nodes)
+        return self._response(body=body.encode("utf-8"), headers={"Content-Type": "application/x-flud-nodes"})
+
     async def _handle_nodes_get(self, request):
         req = _RequestAdapter(request)
         key = request.match_info["key"]
@@ -679,15 +667,16 @@ class FludAiohttpServer(threading.Thread):
         except Exception as exc:
             return self._response(status=400, text="%s in request received by kFINDNODE" % exc.args[0])
 
-        req_ku = {"e": int(params["Ku_e"]), "n": int(params["Ku_n"])}
+        req_ku = {"e": params["Ku_e"], "n": params["Ku_n"]}
         req_ku = FludRSA.importPublicKey(req_ku)
         if req_ku.id() != params["nodeID"]:
             return self._response(status=400, text="requesting node's ID and public key do not match")
 
         kclosest = self.node.config.routing.findNode(fdecode(key))
-        notclose = list(set(self.node.config.routing.knownExternalNodes()) - set(kclosest))
-        if len(notclose) > 0 and len(kclosest) > 1:
-            kclosest.append(random.choice(notclose))
+        if len(kclosest) > 1:
+            notclose = self.node.config.routing.randomNode(kclosest)
+            if notclose is not None:
+                kclosest.append(notclose)
 
         updateNode(
             self.node.client,
@@ -697,7 +686,7 @@ class FludAiohttpServer(threading.Thread):
             req_ku,
             params["nodeID"],
         )
-        return self._response(text="{'id': '%s', 'k': %s}" % (self.node.config.nodeID, kclosest))
+        return self._node_list_response(request, kclosest)
 
     async def _handle_meta_put(self, request):
         req = _RequestAdapter(request)
@@ -708,7 +697,7 @@ class FludAiohttpServer(threading.Thread):
         except Exception as exc:
             return self._response(status=400, text="%s in request received by kSTORE" % exc.args[0])
 
-        req_ku = {"e": int(params["Ku_e"]), "n": int(params["Ku_n"])}
+        req_ku = {"e": params["Ku_e"], "n": params["Ku_n"]}
         req_ku = FludRSA.importPublicKey(req_ku)
         if req_ku.id() != params["nodeID"]:
             return self._response(status=400, text="requesting node's ID and public key do not match")
@@ -735,7 +724,7 @@ class FludAiohttpServer(threading.Thread):
         except Exception as exc:
             return self._response(status=400, text="%s in request received by kFINDVALUE" % exc.args[0])
 
-        req_ku = {"e": int(params["Ku_e"]), "n": int(params["Ku_n"])}
+        req_ku = {"e": params["Ku_e"], "n": params["Ku_n"]}
         req_ku = FludRSA.importPublicKey(req_ku)
         if req_ku.id() != params["nodeID"]:
             return self._response(status=400, text="requesting node's ID and public key do not match")
@@ -761,11 +750,11 @@ class FludAiohttpServer(threading.Thread):
                 resp = d
             return self._response(body=fencode(resp).encode("utf-8"), headers={"nodeID": str(self.node.config.nodeID), "Content-Type": "application/x-flud-data"})
 
-        body = "{'id': '%s', 'k': %s}" % (self.node.config.nodeID, self.node.config.routing.findNode(fdecode(key)))
-        return self._response(body=body.encode("utf-8"), headers={"Content-Type": "application/x-flud-nodes"})
+        return self._node_list_response(request, self.node.config.routing.findNode(fdecode(key)))
 
     def _create_app(self):
         app = web.Application(client_max_size=1024**3)
+        app.on_response_prepare.append(self._add_session_headers)
         app.router.add_get("/", self._handle_root)
         app.router.add_get("/ID", self._handle_id)
 
@@ -137,6 +137,12 @@ class AsyncLocalServer:
             buckets = eval("%s" % self.config.routing.kBuckets)
             await self._write(writer, "DIAG:BKTS%s\r\n" % fencode(buckets))
             return
+        if data == "STAT":
+            stats = self.node.webserver.stats()
+            stats.update(self.node.async_http.stats())
+            stats.update(self.node.client.stats())
+            await self._write(writer, "DIAG:STAT%s\r\n" % fencode(stats))
+            return
         command = data[:4]
         payload = data[5:]
         await self._run_command(command, payload, writer, prepend="DIAG")
@@ -125,6 +125,13 @@ class AsyncLocalClient:
             raise RuntimeError(payload)
         return fdecode(payload[4:])
 
+    async def sendDIAGSTAT(self):
+        async with self._lock:
+            command, status, payload = await self._send_line("DIAG?STAT")
+        if command != "DIAG" or status != ":":
+            raise RuntimeError(payload)
+        return fdecode(payload[4:])
+
     async def sendDIAGSTOR(self, command):
         async with self._lock:
             resp_command, status, payload = await self._send_line("DIAG?STOR %s" % command)
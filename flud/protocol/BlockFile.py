@@ -21,10 +21,17 @@ to be hidden, so that we can change this in the future, by, for example, using
 a proper DB or managing seperate per-node lists as their own files).
 """
 
+# length of the header that precedes the block data
+HEADERSIZE = 8
+
 def open(fname, mode='rb+'):
     """ Return a BlockFile object. """
     return BlockFile(fname, mode)
 
+def view(fname):
+    """ Return a read-only BlockFileView object. """
+    return BlockFileView(fname)
+
 def convert(fname, nodeIDandMeta=None):
     """
     Convert a non-BlockFile to a BlockFile, with an optional nodeID/metadata
@@ -262,6 +269,26 @@ class BlockFile:
     def emptyNodes(self):
         return (len(self._accounting) == 0)
 
+class BlockFileView(BlockFile):
+    """
+    A read-only BlockFile that also exposes where the block data lives in the
+    underlying file, so that callers can hand the data region to sendfile()
+    instead of reading it through the BlockFile.  The accounting information is
+    read once, when the view is opened.
+    """
+
+    def __init__(self, fname):
+        BlockFile.__init__(self, fname, 'rb')
+
+    def fileobj(self):
+        return self._file
+
+    def dataOffset(self):
+        return HEADERSIZE
+
+    def dataLength(self):
+        return self._size
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
@@ -4,7 +4,7 @@ under the terms of the GNU General Public License (the GPL), version 3.
 
 Primitive client DHT protocol
 """
-import time, logging, asyncio, socket
+import time, logging, asyncio, socket, heapq
 from http import HTTPStatus
 import flud.FludkRouting as FludkRouting
 from flud.fencode import fencode
@@ -45,6 +45,13 @@ The active DHT client path is asyncio-native. Single-hop helpers use the
 """
 
 
+def _decode_nodes(body, content_type):
+    if content_type == NODELIST_TYPE:
+        return decodeNodeList(body)
+    # nodes that predate the binary format send a python literal
+    return decodeLegacyNodeList(body.decode("utf-8"))
+
+
 async def send_k_find_node(node, host, port, key, command_name="nodes"):
     return await maybe_await(
             node.async_runtime.submit(
@@ -55,7 +62,8 @@ async def _send_k_find_node(node, host, port, key, command_name="nodes"):
     if aiohttp is None:
         raise RuntimeError("aiohttp not available for async DHT request")
     host = getCanonicalIP(host)
-    headers = {'Fludprotocol': PROTOCOL_VERSION, 'User-Agent': 'FludClient'}
+    headers = {'Fludprotocol': PROTOCOL_VERSION, 'User-Agent': 'FludClient',
+            'Accept': NODELIST_TYPE}
     Ku = node.config.Ku.exportPublicKey()
     url = ('http://%s:%d/%s/%s?nodeID=%s&Ku_e=%s&Ku_n=%s&port=%s') % (
             host, port, command_name, fencode(key), node.config.nodeID,
@@ -70,14 +78,15 @@ async def _send_k_find_node(node, host, port, key, command_name="nodes"):
                     timeout=timeout)
             try:
                 status = resp.status
-                body = await resp.text()
+                body = await resp.read()
+                content_type = resp.headers.get("Content-Type", "")
             finally:
                 resp.release()
             if status != HTTPStatus.OK:
                 raise RuntimeError(
                         "%s FAILED from %s:%d: received status %s, '%s'"
                         % (command_name, host, port, status, body))
-            response = eval(body)
+            response = _decode_nodes(body, content_type)
             nID = int(response['id'], 16)
             updateNode(node.client, node.config, host, port, None, nID)
             updateNodes(node.client, node.config, response['k'])
@@ -98,7 +107,8 @@ async def _send_k_find_value(node, host, port, key):
     if aiohttp is None:
         raise RuntimeError("aiohttp not available for async DHT request")
     host = getCanonicalIP(host)
-    headers = {'Fludprotocol': PROTOCOL_VERSION, 'User-Agent': 'FludClient'}
+    headers = {'Fludprotocol': PROTOCOL_VERSION, 'User-Agent': 'FludClient',
+            'Accept': "%s, application/x-flud-data" % NODELIST_TYPE}
     Ku = node.config.Ku.exportPublicKey()
     url = ('http://%s:%d/meta/%s?nodeID=%s&Ku_e=%s&Ku_n=%s&port=%s') % (
             host, port, fencode(key), node.config.nodeID,
@@ -113,7 +123,7 @@ async def _send_k_find_value(node, host, port, key):
                     timeout=timeout)
             try:
                 status = resp.status
-                body = await resp.text()
+                body = await resp.read()
                 content_type = resp.headers.get("Content-Type", "")
                 node_id = resp.headers.get("nodeID")
             finally:
@@ -124,8 +134,8 @@ async def _send_k_find_value(node, host, port, key):
                         % (host, port, status, body))
             if content_type == "application/x-flud-data":
                 updateNode(node.client, node.config, host, port, None, node_id)
-                return body
-            response = eval(body)
+                return body.decode("utf-8")
+            response = _decode_nodes(body, content_type)
             nID = int(response['id'], 16)
             updateNode(node.client, node.config, host, port, None, nID)
             updateNodes(node.client, node.config, response['k'])
@@ -176,189 +186,180 @@ async def _send_k_store(node, host, port, key, val):
                 raise socket.error(str(exc))
 
 
-async def k_find_node(node, key):
-    node.DHTtstamp = time.time()
-    queried = {}
-    outstanding = set()
-    pending = []
-    kclosest = []
-    abbrvkey = ("%x" % key)[:8] + "..."
-    abbrv = "(%s%s)" % (abbrvkey, str(node.DHTtstamp)[-7:])
-
-    def _update_state(response, host, port):
+class _KLookup:
+    """
+    An iterative kademlia lookup for key.  Keeps FludkRouting.a queries in
+    flight, sending a new one whenever one finishes or has been outstanding
+    for ksoft_to seconds, so that a slow peer never holds up the rest.
+    Candidates wait in a heap ordered by distance from key, and the lookup
+    ends once the k closest nodes that have responded are closer than any
+    candidate left to query; queries to slow peers still outstanding then
+    are cancelled.  If waitslow is set, the lookup instead waits for them
+    to answer or reach their own (hard) timeout.
+
+    Subclasses provide query() and may override handle() to end the lookup
+    early (by setting self.result and returning True).
+    """
+
+    name = "lookup"
+    waitslow = False
+
+    def __init__(self, node, key):
+        self.node = node
+        self.key = key
+        self.pending = []     # heap of (distance, host, port, nID)
+        self.seen = set()     # nIDs queued, queried or failed
+        self.known = {}       # nID -> node tuple, for every node learned of
+        self.failed = set()
+        self.responded = []   # max-heap (by -distance) of the k closest
+        self.queries = 0
+        self.result = None
+        node.DHTtstamp = time.time()
+        abbrvkey = ("%x" % key)[:8] + "..."
+        self.abbrv = "(%s%s)" % (abbrvkey, str(node.DHTtstamp)[-7:])
+
+    def query(self, host, port):
+        raise NotImplementedError
+
+    def handle(self, response, host, port):
+        """
+        Adds the nodes in response to the shortlist.  Returns True if the
+        lookup is finished.
+        """
+        nID = int(response['id'], 16)
+        self.seen.add(nID)
+        distance = self.key ^ nID
+        if len(self.responded) < FludkRouting.k:
+            heapq.heappush(self.responded, -distance)
+        elif distance < -self.responded[0]:
+            heapq.heapreplace(self.responded, -distance)
+        for candidate in response['k']:
+            cID = candidate[2]
+            if cID in self.failed:
+                continue
+            self.known[cID] = candidate
+            if cID not in self.seen:
+                self.seen.add(cID)
+                heapq.heappush(self.pending,
+                        (self.key ^ cID, candidate[0], candidate[1], cID))
+        return False
+
+    def fail(self, host, port, nID, exc):
+        logger.info("%s %s request to %s:%d failed -- %s", self.name,
+                self.abbrv, host, port, str(exc))
+        self.failed.add(nID)
+        self.known.pop(nID, None)
+        if isinstance(exc, OSError):
+            self.node.config.routing.nodeFailed(nID)
+
+    def closest(self):
+        return heapq.nsmallest(FludkRouting.k, self.known.values(),
+                key=lambda n, t=self.key: t ^ n[2])
+
+    def _wantsMore(self):
+        if not self.pending:
+            return False
+        return (len(self.responded) < FludkRouting.k
+                or self.pending[0][0] < -self.responded[0])
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        inflight = {}   # task -> (host, port, nID, soft deadline)
+        slow = set()
+        try:
+            while True:
+                while len(inflight)-len(slow) < FludkRouting.a \
+                        and self._wantsMore():
+                    distance, host, port, nID = heapq.heappop(self.pending)
+                    task = asyncio.ensure_future(self.query(host, port))
+                    inflight[task] = (host, port, nID, loop.time()+ksoft_to)
+                    self.queries += 1
+                if len(inflight) == len(slow) and (not inflight
+                        or not self.waitslow
+                        and len(self.responded) >= FludkRouting.k):
+                    return True
+                deadlines = [v[3] for t, v in inflight.items()
+                        if t not in slow]
+                timeout = None
+                if deadlines:
+                    timeout = max(0, min(deadlines)-loop.time())
+                done, notdone = await asyncio.wait(inflight, timeout=timeout,
+                        return_when=asyncio.FIRST_COMPLETED)
+                now = loop.time()
+                for task in notdone:
+                    if task not in slow and inflight[task][3] <= now:
+                        logger.debug("%s %s moving on from slow %s:%d",
+                                self.name, self.abbrv, *inflight[task][:2])
+                        slow.add(task)
+                for task in done:
+                    host, port, nID, deadline = inflight.pop(task)
+                    slow.discard(task)
+                    try:
+                        response = task.result()
+                    except Exception as exc:
+                        self.fail(host, port, nID, exc)
+                        continue
+                    if self.handle(response, host, port):
+                        return False
+        finally:
+            for task in inflight:
+                task.cancel()
+
+
+class _KFindNode(_KLookup):
+
+    name = "kFindNode"
+
+    def query(self, host, port):
+        return send_k_find_node(self.node, host, port, self.key)
+
+    def handle(self, response, host, port):
+        if len(response['k']) == 1 and response['k'][0][2] == self.key:
+            self.result = response
+            return True
+        return _KLookup.handle(self, response, host, port)
+
+
+class _KFindValue(_KLookup):
+
+    name = "kFindValue"
+    # a slow peer may be the one holding the value
+    waitslow = True
+
+    def query(self, host, port):
+        return send_k_find_value(self.node, host, port, self.key)
+
+    def handle(self, response, host, port):
         if not isinstance(response, dict):
-            return response
-        if len(response['k']) == 1 and response['k'][0][2] == key:
-            if response['k'][0] not in kclosest:
-                kclosest.insert(0, response['k'][0])
-                del kclosest[FludkRouting.k:]
-            return response
-
-        responder_id = int(response['id'], 16)
-        outstanding.discard((host, port, responder_id))
-        queried[responder_id] = (host, port)
+            self.result = response
+            return True
+        return _KLookup.handle(self, response, host, port)
 
-        for candidate in response['k']:
-            node_tuple = (candidate[0], candidate[1], candidate[2])
-            if candidate[2] not in queried and \
-                    node_tuple not in pending and \
-                    node_tuple not in outstanding:
-                pending.append(node_tuple)
-            if candidate not in kclosest:
-                kclosest.append(candidate)
-        kclosest.sort(key=lambda n, t=key: t ^ n[2])
-        del kclosest[FludkRouting.k:]
-
-        pending[:] = list(set(pending) - outstanding)
-        for responder_id, responder_hostport in queried.items():
-            node_tuple = (responder_hostport[0], responder_hostport[1], responder_id)
-            if node_tuple in pending:
-                pending.remove(node_tuple)
-        pending.sort(key=lambda n, t=key: t ^ n[2])
-        return None
 
+async def k_find_node(node, key):
+    lookup = _KFindNode(node, key)
     localhost = getCanonicalIP('localhost')
     local_response = {
         'id': node.config.nodeID,
         'k': node.config.routing.findNode(key),
     }
-    exact = _update_state(local_response, localhost, node.config.port)
-    if exact is not None:
-        return exact
-
-    round_no = 0
-    while pending or outstanding:
-        batch = pending[:FludkRouting.a]
-        pending[:] = pending[len(batch):]
-        if not batch:
-            break
-        logger.debug("FN: %s doing async round %d", abbrv, round_no)
-        round_no += 1
-
-        async def _query_one(host, port, node_id):
-            outstanding.add((host, port, node_id))
-            try:
-                response = await send_k_find_node(node, host, port, key)
-                return response, host, port
-            finally:
-                outstanding.discard((host, port, node_id))
-
-        results = await asyncio.gather(
-            *(_query_one(host, port, node_id) for host, port, node_id in batch),
-            return_exceptions=True,
-        )
-        for item, result in zip(batch, results):
-            host, port, node_id = item
-            if isinstance(result, Exception):
-                logger.info("kFindNode %s request to %s:%d failed -- %s",
-                        abbrv, host, port, str(result))
-                kclosest[:] = [
-                    n for n in kclosest
-                    if (n[0], n[1], n[2]) != (host, port, node_id)
-                ]
-                continue
-            response, host, port = result
-            exact = _update_state(response, host, port)
-            if exact is not None:
-                return exact
-
+    if lookup.handle(local_response, localhost, node.config.port) \
+            or not await lookup.run():
+        return lookup.result
     logger.info("kFindNode %s terminated successfully after %d queries.",
-            abbrv, len(queried))
-    kclosest.sort(key=lambda n, t=key: t ^ n[2])
-    return {'k': kclosest[:FludkRouting.k]}
+            lookup.abbrv, lookup.queries)
+    return {'k': lookup.closest()}
 
 
 async def k_find_value(node, key):
-    node.DHTtstamp = time.time()
-    queried = {}
-    outstanding = set()
-    pending = []
-    kclosest = []
-    done = False
-    values = {}
-    abbrvkey = ("%x" % key)[:8] + "..."
-    abbrv = "(%s%s)" % (abbrvkey, str(node.DHTtstamp)[-7:])
-
-    def _remember_value(response):
-        values[response] = values.get(response, 0) + 1
-
-    def _update_state(response, host, port):
-        nonlocal done
-        if not isinstance(response, dict):
-            if response is not None:
-                _remember_value(response)
-            done = True
-            pending[:] = []
-            outstanding.clear()
-            return response
-
-        responder_id = int(response['id'], 16)
-        queried[responder_id] = (host, port)
-        for candidate in response['k']:
-            node_tuple = (candidate[0], candidate[1], candidate[2])
-            if candidate[2] not in queried and \
-                    node_tuple not in pending and \
-                    node_tuple not in outstanding:
-                pending.append(node_tuple)
-            if candidate not in kclosest:
-                kclosest.append(candidate)
-        kclosest.sort(key=lambda n, t=key: t ^ n[2])
-        del kclosest[FludkRouting.k:]
-
-        pending[:] = list(set(pending) - outstanding)
-        for responder_id, responder_hostport in queried.items():
-            node_tuple = (responder_hostport[0], responder_hostport[1], responder_id)
-            if node_tuple in pending:
-                pending.remove(node_tuple)
-        pending.sort(key=lambda n, t=key: t ^ n[2])
-        return None
-
+    lookup = _KFindValue(node, key)
     localhost = getCanonicalIP('localhost')
     initial = await send_k_find_value(node, localhost, node.config.port, key)
-    exact = _update_state(initial, localhost, node.config.port)
-    if exact is not None and not isinstance(exact, dict):
-        return exact
-
-    round_no = 0
-    while not done and (pending or outstanding):
-        batch = pending[:FludkRouting.a]
-        pending[:] = pending[len(batch):]
-        if not batch:
-            break
-        logger.debug("FV: %s doing async round %d", abbrv, round_no)
-        round_no += 1
-
-        async def _query_one(host, port, node_id):
-            outstanding.add((host, port, node_id))
-            try:
-                response = await send_k_find_value(node, host, port, key)
-                return response, host, port
-            finally:
-                outstanding.discard((host, port, node_id))
-
-        results = await asyncio.gather(
-            *(_query_one(host, port, node_id) for host, port, node_id in batch),
-            return_exceptions=True,
-        )
-        for item, result in zip(batch, results):
-            host, port, node_id = item
-            if isinstance(result, Exception):
-                logger.info("kFindValue %s request to %s:%d failed -- %s",
-                        abbrv, host, port, str(result))
-                kclosest[:] = [
-                    n for n in kclosest
-                    if (n[0], n[1], n[2]) != (host, port, node_id)
-                ]
-                continue
-            response, host, port = result
-            exact = _update_state(response, host, port)
-            if exact is not None and not isinstance(exact, dict):
-                return exact
-
-    if not values:
-        logger.info("couldn't get any results")
-        return None
-    return max(values.items(), key=lambda item: item[1])[0]
+    if lookup.handle(initial, localhost, node.config.port) \
+            or not await lookup.run():
+        return lookup.result
+    logger.info("couldn't get any results")
+    return None
 
 
 async def k_store(node, key, val):
@@ -144,7 +144,7 @@ async def _send_store_request(nKu, node, host, port, datafile, metadata=None):
     while True:
         try:
             auth_retries = 0
-            hdrs = dict(headers)
+            hdrs = _session_headers(node, headers, host, port, nKu)
             while True:
                 if _async_diag_enabled():
                     loggerstor.warning("SENDSTORE async POST %s skip=%s",
@@ -158,6 +158,7 @@ async def _send_store_request(nKu, node, host, port, datafile, metadata=None):
                 try:
                     status = resp.status
                     reason = resp.reason
+                    resp_headers = resp.headers
                     body = await resp.read()
                 finally:
                     resp.release()
@@ -173,6 +174,7 @@ async def _send_store_request(nKu, node, host, port, datafile, metadata=None):
                         challenge = body.decode("utf-8", errors="ignore")
                     if not challenge:
                         challenge = reason
+                    _drop_session(node, hdrs, host, port, nKu)
                     hdrs = answerChallenge(challenge, node.config.Kr,
                             node.config.groupIDu, nKu.id(), hdrs)
                     auth_retries += 1
@@ -183,6 +185,7 @@ async def _send_store_request(nKu, node, host, port, datafile, metadata=None):
                     raise RuntimeError(
                             "received %s in SENDSTORE response: %s"
                             % (status, body))
+                _save_session(node, resp_headers, host, port, nKu)
                 updateNode(node.client, node.config, host, port, nKu)
                 loggerstor.info("received SENDSTORE response from %s:%d: %s",
                         host, port, str(body))
@@ -202,12 +205,16 @@ async def aggregate_store(nKu, node, host, port, datafile, metadata=None):
     return await request.run()
 
 
-async def send_retrieve(nKu, node, host, port, filekey, metakey=True):
+async def send_retrieve(nKu, node, host, port, filekey, metakey=True,
+        targetdir=None):
     return await _run_on_node_runtime(
-            node, _send_retrieve(nKu, node, host, port, filekey, metakey))
+            node, _send_retrieve(nKu, node, host, port, filekey, metakey,
+                targetdir))
 
 
-async def _send_retrieve(nKu, node, host, port, filekey, metakey=True):
+async def _send_retrieve(nKu, node, host, port, filekey, metakey=True,
+        targetdir=None):
+    # the retrieved files are saved to targetdir (by default, the client dir)
     if aiohttp is None:
         raise RuntimeError("aiohttp not available for async RETRIEVE")
     host = getCanonicalIP(host)
@@ -221,7 +228,7 @@ async def _send_retrieve(nKu, node, host, port, filekey, metakey=True):
     while True:
         try:
             auth_retries = 0
-            hdrs = dict(headers)
+            hdrs = _session_headers(node, headers, host, port, nKu)
             while True:
                 timeout = aiohttp.ClientTimeout(total=transfer_to)
                 resp = await node.async_http.request(
@@ -231,6 +238,7 @@ async def _send_retrieve(nKu, node, host, port, filekey, metakey=True):
                 try:
                     status = resp.status
                     reason = resp.reason
+                    resp_headers = resp.headers
                     body = await resp.read()
                     content_type = resp.headers.get("Content-Type", "")
                     boundary = resp.headers.get("boundary", "")
@@ -243,6 +251,7 @@ async def _send_retrieve(nKu, node, host, port, filekey, metakey=True):
                     challenge = body.decode("utf-8", errors="ignore") if body else ""
                     if not challenge:
                         challenge = reason
+                    _drop_session(node, hdrs, host, port, nKu)
                     hdrs = answerChallenge(challenge, node.config.Kr,
                             node.config.groupIDu, nKu.id(), hdrs)
                     auth_retries += 1
@@ -256,7 +265,9 @@ async def _send_retrieve(nKu, node, host, port, filekey, metakey=True):
                             "SENDRETRIEVE FAILED: server sent status %s, '%s'"
                             % (status, body))
                 saved = _save_retrieve_response(
-                        body, content_type, node.config.clientdir, filekey, boundary)
+                        body, content_type,
+                        targetdir or node.config.clientdir, filekey, boundary)
+                _save_session(node, resp_headers, host, port, nKu)
                 updateNode(node.client, node.config, host, port, nKu)
                 return saved
         except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
@@ -284,7 +295,7 @@ async def _send_delete(nKu, node, host, port, filekey, metakey):
     while True:
         try:
             auth_retries = 0
-            hdrs = dict(headers)
+            hdrs = _session_headers(node, headers, host, port, nKu)
             while True:
                 timeout = aiohttp.ClientTimeout(total=primitive_to)
                 resp = await node.async_http.request(
@@ -294,6 +305,7 @@ async def _send_delete(nKu, node, host, port, filekey, metakey):
                 try:
                     status = resp.status
                     reason = resp.reason
+                    resp_headers = resp.headers
                     body = await resp.text()
                 finally:
                     resp.release()
@@ -302,6 +314,7 @@ async def _send_delete(nKu, node, host, port, filekey, metakey):
                         raise RuntimeError(
                                 "SENDDELETE unauthorized (retries exhausted)")
                     challenge = body or reason
+                    _drop_session(node, hdrs, host, port, nKu)
                     hdrs = answerChallenge(challenge, node.config.Kr,
                             node.config.groupIDu, nKu.id(), hdrs)
                     auth_retries += 1
@@ -314,6 +327,7 @@ async def _send_delete(nKu, node, host, port, filekey, metakey):
                     raise RuntimeError(
                             "SENDDELETE FAILED: server sent status %s, '%s'"
                             % (status, body))
+                _save_session(node, resp_headers, host, port, nKu)
                 updateNode(node.client, node.config, host, port, nKu)
                 return body
         except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
@@ -347,7 +361,7 @@ async def _send_verify(nKu, node, host, port, filename, offset, length,
     while True:
         try:
             auth_retries = 0
-            hdrs = dict(headers)
+            hdrs = _session_headers(node, headers, host, port, nKu)
             while True:
                 timeout = aiohttp.ClientTimeout(total=primitive_to)
                 resp = await node.async_http.request(
@@ -357,6 +371,7 @@ async def _send_verify(nKu, node, host, port, filename, offset, length,
                 try:
                     status = resp.status
                     reason = resp.reason
+                    resp_headers = resp.headers
                     body = await resp.text()
                 finally:
                     resp.release()
@@ -365,6 +380,7 @@ async def _send_verify(nKu, node, host, port, filename, offset, length,
                         raise RuntimeError(
                                 "SENDVERIFY unauthorized (retries exhausted)")
                     challenge = body or reason
+                    _drop_session(node, hdrs, host, port, nKu)
                     hdrs = answerChallenge(challenge, node.config.Kr,
                             node.config.groupIDu, nKu.id(), hdrs)
                     auth_retries += 1
@@ -377,6 +393,7 @@ async def _send_verify(nKu, node, host, port, filename, offset, length,
                     raise RuntimeError(
                             "SENDVERIFY FAILED: server sent status %s, '%s'"
                             % (status, body))
+                _save_session(node, resp_headers, host, port, nKu)
                 updateNode(node.client, node.config, host, port, nKu)
                 return body
         except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
@@ -388,6 +405,12 @@ MINSTORSIZE = 512000  # anything smaller than this tries to get aggregated
 TARFILE_TO = 2        # timeout for checking aggregated tar files
 
 MAXAUTHRETRY = 4      # number of times to retry auth
+SESSIONMARGIN = 10    # stop using session tokens this many secs before expiry
+
+# session tokens issued by servers once we have answered their challenge, kept
+# by (our nodeID, host, port, server nodeID) as (token, expiry time).  While a token is
+# valid, requests to that server skip the challenge round trip.
+sessions = {}
 
 # FUTURE: check flud protocol version for backwards compatibility
 # XXX: need to make sure we have appropriate timeouts for all comms.
@@ -701,6 +724,40 @@ class AggregateStore:
         for waiter in waiters:
             _reject_waiter(waiter, failure)
 
+def _session_key(node, host, port, nKu):
+    return (node.config.nodeID, host, port, nKu.id())
+
+def _session_headers(node, headers, host, port, nKu):
+    """
+    Returns a copy of headers, with the session token for the given server
+    added if we hold one that hasn't expired.
+    """
+    hdrs = dict(headers)
+    key = _session_key(node, host, port, nKu)
+    session = sessions.get(key)
+    if session:
+        if session[1] > time.monotonic():
+            hdrs['Fludsession'] = session[0]
+        else:
+            sessions.pop(key, None)
+    return hdrs
+
+def _save_session(node, respheaders, host, port, nKu):
+    token = respheaders.get('Fludsession')
+    if not token:
+        return
+    try:
+        ttl = int(respheaders.get('Fludsessionttl', 0))
+    except ValueError:
+        return
+    if ttl > SESSIONMARGIN:
+        sessions[_session_key(node, host, port, nKu)] = (token,
+                time.monotonic()+ttl-SESSIONMARGIN)
+
+def _drop_session(node, headers, host, port, nKu):
+    headers.pop('Fludsession', None)
+    sessions.pop(_session_key(node, host, port, nKu), None)
+
 def _normalize_challenge(challenge):
     if isinstance(challenge, bytes):
         challenge = challenge.decode("utf-8", errors="replace")
@@ -7,13 +7,21 @@ flud client ops.
 
 import os
 import stat
+import time
+import asyncio
 import logging
+from collections import OrderedDict
 
 from .ClientPrimitives import *
 from .ClientDHTPrimitives import *
 
 logger = logging.getLogger('flud.client')
 
+# how long (in seconds) a node located by resolve_node() or reported
+# unreachable is remembered, and how many of each are remembered
+NODECACHE_TTL = 600
+NODECACHESIZE = 1024
+
 class FludClient(object):
     """
     This class contains methods which create request objects
@@ -21,6 +29,11 @@ class FludClient(object):
     def __init__(self, node):
         self.node = node
         self.current_store_tasks = {}
+        self.resolved = OrderedDict()    # nodeID -> (node, expiry), LRU
+        self.unresolved = OrderedDict()  # unreachable nodeID -> expiry
+        self.resolving = {}        # nodeID -> in-flight k_find_node task
+        self.resolvestats = {"resolverouting": 0, "resolvecached": 0,
+                "resolvecoalesced": 0, "resolvelookups": 0}
     
     """
     Data storage primitives
@@ -72,11 +85,12 @@ class FludClient(object):
             self.current_store_tasks.pop(key, None)
 
     # XXX: need a version that takes a metakey, too
-    async def retrieve(self, filekey, host, port, nKu=None, metakey=True):
+    async def retrieve(self, filekey, host, port, nKu=None, metakey=True,
+            targetdir=None):
         if not nKu:
             nKu = await self.get_id(host, port)
         return await send_retrieve(
-                nKu, self.node, host, port, filekey, metakey)
+                nKu, self.node, host, port, filekey, metakey, targetdir)
     
     async def verify(self, filekey, offset, length, host, port, nKu=None,
             meta=None):
@@ -106,6 +120,85 @@ class FludClient(object):
     async def send_k_find_value(self, host, port, key):
         return await send_k_find_value(self.node, host, port, key)
     
+    async def resolve_node(self, nodeID):
+        """
+        Locates nodeID, returning a kFINDNODE-style response whose first entry
+        is the node if it was found.  Nodes in the routing table or located
+        recently are returned without a lookup, and concurrent lookups of the
+        same node share a single k_find_node.  Callers should pass errors from
+        talking to the node to report_failure(), so that a stale location is
+        looked up again next time.
+        @param nodeID an int
+        """
+        now = time.monotonic()
+        unreachable = self.unresolved.get(nodeID)
+        if unreachable is not None and unreachable <= now:
+            del self.unresolved[nodeID]
+            unreachable = None
+        if unreachable is None:
+            node = self.node.config.routing.getNode(nodeID)
+            if node is not None and len(node) > 3:
+                self.resolvestats["resolverouting"] += 1
+                return {'k': [node]}
+            entry = self.resolved.get(nodeID)
+            if entry is not None:
+                if entry[1] > now:
+                    self.resolved.move_to_end(nodeID)
+                    self.resolvestats["resolvecached"] += 1
+                    return {'k': [entry[0]]}
+                del self.resolved[nodeID]
+        task = self.resolving.get(nodeID)
+        if task is not None and task.get_loop() is asyncio.get_running_loop():
+            self.resolvestats["resolvecoalesced"] += 1
+            return await asyncio.shield(task)
+        self.resolvestats["resolvelookups"] += 1
+        task = asyncio.ensure_future(self._resolve(nodeID))
+        self.resolving[nodeID] = task
+        return await asyncio.shield(task)
+
+    async def _resolve(self, nodeID):
+        try:
+            kdata = await self.k_find_node(nodeID)
+        finally:
+            if self.resolving.get(nodeID) is asyncio.current_task():
+                del self.resolving[nodeID]
+        for node in kdata.get('k', []):
+            if node[2] == nodeID:
+                self.unresolved.pop(nodeID, None)
+                self.resolved[nodeID] = (node,
+                        time.monotonic()+NODECACHE_TTL)
+                self.resolved.move_to_end(nodeID)
+                if len(self.resolved) > NODECACHESIZE:
+                    self.resolved.popitem(last=False)
+                kdata = dict(kdata, k=[node]+[n for n in kdata['k']
+                    if n is not node])
+                break
+        return kdata
+
+    def report_failure(self, nodeID, failure):
+        """
+        Tells resolve_node() that talking to nodeID failed with failure.  If
+        the node couldn't be reached, the next resolve_node() does a fresh
+        lookup instead of trusting the routing table or cache (until the node
+        is found again or NODECACHE_TTL passes), and the routing table is told
+        so that it can swap in a replacement.
+        """
+        if isinstance(failure, OSError):
+            self.resolved.pop(nodeID, None)
+            self.unresolved[nodeID] = time.monotonic()+NODECACHE_TTL
+            self.unresolved.move_to_end(nodeID)
+            if len(self.unresolved) > NODECACHESIZE:
+                self.unresolved.popitem(last=False)
+            self.node.config.routing.nodeFailed(nodeID)
+
+    def stats(self):
+        """
+        Returns counts of how resolve_node() requests were answered: from the
+        routing table, the cache, by joining a lookup already in flight, or by
+        a new lookup.
+        """
+        return dict(self.resolvestats)
+
     """
     DHT recursive primitives (recursive calls to muliple peers)
     """
@@ -4,7 +4,7 @@ the terms of the GNU General Public License (the GPL), version 3.
 
 Communications routines used by both client and server code.
 """
-import logging, socket
+import logging, socket, threading, time, struct, ast
 import inspect
 
 from flud.FludExceptions import FludException
@@ -20,6 +20,9 @@ PROTOCOL_VERSION = '0.2'
 primitive_to = 3800 # default timeout for primitives
 kprimitive_to = primitive_to/2  # default timeout for kademlia primitives
 #kprimitive_to = 10 # default timeout for kademlia primitives
+# a kademlia lookup stops waiting on a query after this long and sends another
+# in its place (the late response is still used if it arrives)
+ksoft_to = 5
 transfer_to = 3600 # 10-hr limit on file transfers
 MAXTIMEOUTS = 5  # number of times to retry after connection timeout failure
 CONNECT_TO = 60
@@ -106,14 +109,15 @@ def updateNode(client, config, host, port, nKu=None, nID=None):
             config.addNode(nID, host, port, nKu)
         # XXX: trust
         # routing
-        node = (host, port, int(nID, 16), nKu.exportPublicKey()['n'])
+        node = (host, port, int(nID, 16), nKu.n)
         replacee = config.routing.updateNode(node)
         #logger.info("knownnodes now: %s" % config.routing.knownNodes())
         #print "knownnodes now: %s" % config.routing.knownNodes()
         if replacee != None:
-            logging.getLogger('flud').info(
-                    "determining if replacement in ktable is needed")
-            replaceNode(None, config.routing, replacee, node)
+            # the bucket is full; node waits in the replacement cache until
+            # one of the bucket's nodes is found to be unreachable
+            logging.getLogger('flud').debug(
+                    "kept %x as a replacement for its full kbucket" % node[2])
     else:
         #print "updateNode nKu=%s, type=%s" % (nKu, type(nKu))
         logging.getLogger('flud').warn( 
@@ -139,10 +143,6 @@ def updateNode(client, config, host, port, nKu=None, nID=None):
             return
         callUpdateNode(remote_nKu, client, config, host, port, nID)
 
-def replaceNode(error, routing, replacee, replacer):
-    routing.replaceNode(replacee, replacer) 
-    print("replaced node in ktable")
-
 def requireParams(request, paramNames):
     # Looks for the named parameters in request.  If found, returns
     # a dict of param/value mappings.  If any named parameter is missing,
@@ -161,16 +161,141 @@ def requireParams(request, paramNames):
             raise Exception("missing parameter '"+i+"'") #XXX: use cust Exc
     return params
 
+# Reverse lookups done by getCanonicalIP are cached as {IP: (name, expiry)}.
+# Names are kept for RESOLVE_TTL seconds, and addresses that don't resolve
+# (getfqdn hands them back unchanged) for RESOLVE_NEGTTL.  An expired entry is
+# still returned while a background thread looks it up again, so only the
+# first lookup of an address waits on the resolver.  With reverseLookups off,
+# addresses are used as they are.
+RESOLVE_TTL = 3600
+RESOLVE_NEGTTL = 300
+reverseLookups = True
+_resolved = {}
+_refreshing = set()
+_resolveLock = threading.Lock()
+
+def setResolveOptions(reverse=True, ttl=RESOLVE_TTL, negttl=RESOLVE_NEGTTL):
+    global reverseLookups, RESOLVE_TTL, RESOLVE_NEGTTL
+    with _resolveLock:
+        reverseLookups = reverse
+        RESOLVE_TTL = ttl
+        RESOLVE_NEGTTL = negttl
+        _resolved.clear()
+
+def _lookup(IP):
+    # IP of None looks up the local host
+    try:
+        name = socket.getfqdn() if IP is None else socket.getfqdn(IP)
+    except Exception:
+        name = IP
+    ttl = RESOLVE_NEGTTL if name == IP else RESOLVE_TTL
+    with _resolveLock:
+        _resolved[IP] = (name, time.monotonic()+ttl)
+        _refreshing.discard(IP)
+    return name
+
+def _resolve(IP):
+    with _resolveLock:
+        entry = _resolved.get(IP)
+        if entry is None or entry[1] > time.monotonic() or IP in _refreshing:
+            refresh = False
+        else:
+            refresh = True
+            _refreshing.add(IP)
+    if entry is None:
+        return _lookup(IP)
+    if refresh:
+        threading.Thread(target=_lookup, args=(IP,), daemon=True).start()
+    return entry[0]
+
 def getCanonicalIP(IP):
     # Preserve loopback targets as loopback. Rewriting localhost to the
     # machine FQDN can point at a non-listening interface (for example Mac.lan).
-    local_fqdn = socket.getfqdn()
-    if isinstance(IP, str) and IP.lower() == local_fqdn.lower():
-        return '127.0.0.1'
     if IP in ('127.0.0.1', 'localhost', '::1'):
         return '127.0.0.1'
-    else:
-        return socket.getfqdn(IP)
+    if not reverseLookups:
+        if isinstance(IP, str) and IP.lower() == socket.gethostname().lower():
+            return '127.0.0.1'
+        return IP
+    if isinstance(IP, str) and IP.lower() == _resolve(None).lower():
+        return '127.0.0.1'
+    return _resolve(IP)
+
+# kFINDNODE/kFINDVALUE node lists are sent in a compact binary format to
+# clients that ask for it in their Accept header; others get the original
+# python-literal text.  The format is a version byte, then the responder's
+# nodeID and a node count, then for each (host, port, id, Ku_n) node tuple
+# the host, port, id and public key modulus, with strings and ints
+# length-prefixed.
+NODELIST_TYPE = "application/x-flud-nodelist"
+NODELIST_VERSION = 1
+
+def _packInt(i):
+    b = i.to_bytes((i.bit_length()+7)//8, 'big')
+    return struct.pack('!H', len(b))+b
+
+def encodeNodeList(nodeID, nodes):
+    """
+    Returns nodeID and nodes, a list of (host, port, id, Ku_n) tuples, in the
+    binary nodelist format.
+    """
+    nodeID = nodeID.encode("ascii")
+    parts = [struct.pack('!BHH', NODELIST_VERSION, len(nodeID), len(nodes)),
+            nodeID]
+    for host, port, nID, n in nodes:
+        host = host.encode("utf-8")
+        parts.append(struct.pack('!BH', len(host), port)+host)
+        parts.append(_packInt(nID))
+        parts.append(_packInt(n))
+    return b"".join(parts)
+
+def decodeNodeList(data):
+    """
+    Decodes a binary nodelist into {'id': nodeID, 'k': [node tuples]}.
+    Raises ValueError if data is malformed.
+    """
+    try:
+        version, idlen, count = struct.unpack_from('!BHH', data)
+        if version != NODELIST_VERSION:
+            raise ValueError("unsupported nodelist version %d" % version)
+        offset = 5
+        nodeID = data[offset:offset+idlen].decode("ascii")
+        offset += idlen
+        nodes = []
+        for i in range(count):
+            hostlen, port = struct.unpack_from('!BH', data, offset)
+            offset += 3
+            host = data[offset:offset+hostlen].decode("utf-8")
+            offset += hostlen
+            ints = []
+            for j in range(2):
+                (length,) = struct.unpack_from('!H', data, offset)
+                offset += 2
+                if offset+length > len(data):
+                    raise ValueError("truncated nodelist")
+                ints.append(int.from_bytes(data[offset:offset+length], 'big'))
+                offset += length
+            nodes.append((host, port, ints[0], ints[1]))
+    except (struct.error, UnicodeDecodeError) as exc:
+        raise ValueError("malformed nodelist: %s" % exc)
+    if offset != len(data):
+        raise ValueError("trailing data in nodelist")
+    return {'id': nodeID, 'k': nodes}
+
+def decodeLegacyNodeList(body):
+    """
+    Decodes a node list sent as python-literal text by nodes that don't
+    speak the binary format.  Raises ValueError if body is malformed.
+    """
+    try:
+        response = ast.literal_eval(body)
+    except (SyntaxError, ValueError, TypeError, MemoryError,
+            RecursionError) as exc:
+        raise ValueError("malformed nodelist: %s" % exc)
+    if not isinstance(response, dict) or not isinstance(response.get('id'),
+            str) or not isinstance(response.get('k'), (list, tuple)):
+        raise ValueError("malformed nodelist")
+    return response
 
 class ImposterException(FludException):
     pass
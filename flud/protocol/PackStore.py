@@ -0,0 +1,279 @@
+"""
+PackStore.py (c) 2003-2006 Alen Peacock.  This program is distributed under the
+terms of the GNU General Public License (the GPL), version 3.
+
+Storage for small blocks.  Blocks too small to be worth a BlockFile of their
+own (and their metadata) are appended to a pack file kept per requesting node,
+and their locations are recorded in an append-only index journal, so that
+finding, reading, adding or deleting a member never requires scanning the
+pack.  Deletes append tombstones to the journal; the pack is rewritten without
+the dead records once they make up enough of it.
+
+Member names follow the convention used for aggregated blocks: a block is
+stored as its storage key, and its metadata as "<key>.<metakey>.meta".
+"""
+
+import os, builtins, logging, tarfile, gzip, threading
+
+from flud.fencode import fencode, fdecode
+
+logger = logging.getLogger('flud.server.packstore')
+
+# a pack is compacted once it holds more dead bytes than live ones, and at
+# least this many
+COMPACTSLACK = 1048576
+
+class PackStore:
+    """
+    Maps member names to (offset, length) regions of a pack file.  The pack
+    file is named <base>.<generation>.pack, and the index journal <base>.idx.
+    The first record in the journal names the pack it describes, so that
+    compaction can write a new pack, then switch over to it by replacing the
+    journal.
+
+    Tarballs (<base>.tar or <base>.tar.gz) left by the older per-requester
+    aggregation scheme are imported the first time the store is opened.
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self.idxpath = base+".idx"
+        self.packpath = None
+        self.generation = -1
+        self.entries = {}
+        self.members = {}
+        self.live = 0
+        self.dead = 0
+        self.compacting = False
+        self.lock = threading.RLock()
+        if os.path.exists(self.idxpath):
+            self._load()
+        else:
+            self._importTarballs()
+
+    def _key(self, name):
+        return name.split('.', 1)[0]
+
+    def _set(self, name, offset, length):
+        if name in self.entries:
+            self._drop(name)
+        self.entries[name] = (offset, length)
+        self.members.setdefault(self._key(name), set()).add(name)
+        self.live += length
+
+    def _drop(self, name):
+        offset, length = self.entries.pop(name)
+        key = self._key(name)
+        self.members[key].discard(name)
+        if not self.members[key]:
+            del self.members[key]
+        self.live -= length
+        self.dead += length
+
+    def _load(self):
+        with builtins.open(self.idxpath, 'rb+') as f:
+            data = f.read()
+            records = data.split(b"\n")
+            if records[-1]:
+                # partially written record, drop it so appends stay parseable
+                f.truncate(len(data)-len(records[-1]))
+            self.generation = fdecode(records[0])
+            self.packpath = "%s.%d.pack" % (self.base, self.generation)
+            for record in records[1:-1]:
+                try:
+                    record = fdecode(record)
+                except Exception:
+                    logger.warning("skipping bad record in %s" % self.idxpath)
+                    continue
+                if len(record) == 1:
+                    if record[0] in self.entries:
+                        self._drop(record[0])
+                else:
+                    self._set(*record)
+
+    def _create(self):
+        self.generation = 0
+        self.packpath = "%s.%d.pack" % (self.base, self.generation)
+        builtins.open(self.packpath, 'wb').close()
+        with builtins.open(self.idxpath, 'wb') as f:
+            f.write((fencode(self.generation)+"\n").encode("ascii"))
+
+    def _journal(self, records):
+        with builtins.open(self.idxpath, 'ab') as f:
+            f.write(b"".join((fencode(r)+"\n").encode("ascii")
+                for r in records))
+
+    def _importTarballs(self):
+        for tarball, mode in ((self.base+".tar.gz", "r:gz"),
+                (self.base+".tar", "r")):
+            if not os.path.exists(tarball):
+                continue
+            try:
+                self.importTarball(tarball, mode)
+            except (tarfile.ReadError, EOFError, gzip.BadGzipFile,
+                    OSError) as exc:
+                logger.warning("skipping corrupt tarball %s: %s"
+                        % (tarball, str(exc)))
+            os.remove(tarball)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def names(self, key):
+        """
+        Returns the names of all members stored under block key: the block
+        itself and any of its metadata.
+        """
+        with self.lock:
+            return sorted(self.members.get(key, ()))
+
+    def size(self, name):
+        with self.lock:
+            entry = self.entries.get(name)
+        return entry[1] if entry else None
+
+    def openRegion(self, name):
+        """
+        Returns (fileobj, offset, length) for the named member, or None if it
+        isn't stored.  The caller must close fileobj.
+        """
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None:
+                return None
+            # once opened, the pack stays readable even if compaction replaces
+            # it, so the region remains valid without holding the lock
+            f = builtins.open(self.packpath, 'rb')
+        return f, entry[0], entry[1]
+
+    def get(self, name, offset=0, length=None):
+        """
+        Returns the named member's data (or length bytes of it, starting at
+        offset), or None if it isn't stored.
+        """
+        region = self.openRegion(name)
+        if region is None:
+            return None
+        f, start, size = region
+        with f:
+            offset = min(offset, size)
+            if length is None or offset+length > size:
+                length = size-offset
+            f.seek(start+offset)
+            return f.read(length)
+
+    def put(self, name, data):
+        """ Stores data under name, replacing any existing member. """
+        self.putMany([(name, data)])
+
+    def putMany(self, members):
+        """ Stores each (name, data) pair in members. """
+        with self.lock:
+            if self.packpath is None:
+                self._create()
+            records = []
+            with builtins.open(self.packpath, 'ab') as f:
+                offset = f.tell()
+                for name, data in members:
+                    f.write(data)
+                    records.append((name, offset, len(data)))
+                    offset += len(data)
+            # the data must be in the pack before the index points at it
+            self._journal(records)
+            for record in records:
+                self._set(*record)
+
+    def delete(self, names):
+        """ Removes the named members.  Returns the number removed. """
+        with self.lock:
+            names = [n for n in names if n in self.entries]
+            if names:
+                self._journal([(n,) for n in names])
+                for name in names:
+                    self._drop(name)
+            return len(names)
+
+    def importTarball(self, tarball, mode="r", skipExisting=True):
+        """
+        Adds the members of tarball to the store.  Returns the names added.
+        """
+        added = []
+        tar = tarfile.open(tarball, mode)
+        try:
+            for member in tar.getmembers():
+                if not member.isfile():
+                    continue
+                if skipExisting and member.name in self.entries:
+                    continue
+                fileobj = tar.extractfile(member)
+                data = fileobj.read()
+                fileobj.close()
+                self.put(member.name, data)
+                added.append(member.name)
+        finally:
+            tar.close()
+        return added
+
+    def needsCompaction(self):
+        return (not self.compacting and self.dead > COMPACTSLACK
+                and self.dead > self.live)
+
+    def compact(self):
+        """
+        Rewrites the pack with only its live members.  Most of the copying is
+        done without holding the lock, so the store stays usable meanwhile;
+        members added while the copy runs are picked up at the end.
+        """
+        with self.lock:
+            if self.compacting or self.packpath is None:
+                return
+            self.compacting = True
+            snapshot = dict(self.entries)
+            oldpack = self.packpath
+            generation = self.generation+1
+        newpack = "%s.%d.pack" % (self.base, generation)
+        try:
+            copied = {}
+            with builtins.open(oldpack, 'rb') as src, \
+                    builtins.open(newpack, 'wb') as dst:
+                for name, (offset, length) in sorted(snapshot.items(),
+                        key=lambda e: e[1][0]):
+                    src.seek(offset)
+                    copied[name] = (dst.tell(), length)
+                    dst.write(src.read(length))
+                with self.lock:
+                    entries = {}
+                    for name, entry in self.entries.items():
+                        if snapshot.get(name) == entry:
+                            entries[name] = copied[name]
+                        else:
+                            src.seek(entry[0])
+                            entries[name] = (dst.tell(), entry[1])
+                            dst.write(src.read(entry[1]))
+                    dst.flush()
+                    tmpname = self.idxpath+".tmp"
+                    with builtins.open(tmpname, 'wb') as f:
+                        f.write((fencode(generation)+"\n").encode("ascii"))
+                        f.write(b"".join(
+                            (fencode((n,)+e)+"\n").encode("ascii")
+                            for n, e in entries.items()))
+                    os.replace(tmpname, self.idxpath)
+                    self.generation = generation
+                    self.packpath = newpack
+                    self.entries = {}
+                    self.members = {}
+                    self.live = 0
+                    self.dead = 0
+                    for name, (offset, length) in entries.items():
+                        self._set(name, offset, length)
+            os.remove(oldpack)
+        except Exception:
+            if self.packpath != newpack and os.path.exists(newpack):
+                os.remove(newpack)
+            raise
+        finally:
+            with self.lock:
+                self.compacting = False
@@ -3,6 +3,7 @@ import os
 import socket
 from contextlib import contextmanager
 from dataclasses import dataclass
+from types import SimpleNamespace
 
 import pytest
 
@@ -57,6 +58,21 @@ def flud_k_stress_concurrency(request):
     return request.config.getoption("--flud-stress-k-concurrency")
 
 
+@pytest.fixture
+def flud_server(tmp_path):
+    """
+    Returns a function making FludAiohttpServers (not started) for a stand-in
+    node that stores to storedir (tmp_path by default).
+    """
+    from flud.protocol.AiohttpServer import FludAiohttpServer
+
+    def make(storedir=tmp_path, packindexes=256):
+        config = SimpleNamespace(storedir=str(storedir), clientport=0,
+                packindexes=packindexes)
+        return FludAiohttpServer(SimpleNamespace(config=config), 0)
+    return make
+
+
 @dataclass
 class FludTarget:
     host: str
@@ -0,0 +1,51 @@
+import asyncio
+import hashlib
+import os
+import random
+
+import pytest
+
+from flud.protocol import AiohttpServer
+
+
+class FakePart:
+    def __init__(self, data, fail=False):
+        self.data = data
+        self.fail = fail
+        self.reads = []
+
+    async def read_chunk(self, size):
+        if self.fail and self.reads:
+            raise ConnectionResetError("client went away")
+        chunk, self.data = self.data[:size], self.data[size:]
+        self.reads.append(len(chunk))
+        return chunk
+
+
+def test_native_receive_payload_streams_and_hashes(tmp_path, monkeypatch,
+        flud_server):
+    monkeypatch.setattr(AiohttpServer, "STORECHUNK", 1000)
+    data = random.Random(0).randbytes(10500)
+    part = FakePart(data)
+
+    tmpfile, size, digest = asyncio.run(
+            flud_server()._receive_payload(part, ".tar"))
+
+    assert size == len(data)
+    assert digest == hashlib.sha256(data).hexdigest()
+    assert tmpfile.endswith(".tar")
+    assert os.path.dirname(tmpfile) == str(tmp_path)
+    with open(tmpfile, "rb") as f:
+        assert f.read() == data
+    assert max(part.reads) <= 1000
+
+
+def test_native_receive_payload_removes_partial_file(tmp_path, monkeypatch,
+        flud_server):
+    monkeypatch.setattr(AiohttpServer, "STORECHUNK", 1000)
+    part = FakePart(b"x" * 5000, fail=True)
+
+    with pytest.raises(ConnectionResetError):
+        asyncio.run(flud_server()._receive_payload(part))
+
+    assert os.listdir(tmp_path) == []
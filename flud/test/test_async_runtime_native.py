@@ -0,0 +1,149 @@
+import asyncio
+import os
+import threading
+
+import pytest
+from aiohttp import web
+
+from flud.async_runtime import AsyncHTTPClient, AsyncRuntime, StageExecutor
+
+
+async def test_native_stage_executor_runs_off_loop():
+    executor = StageExecutor(workers=2)
+    try:
+        loopthread = threading.get_ident()
+        result = await executor.run("hash", lambda a, b=0: (a + b,
+                threading.get_ident()), 1, b=2)
+        assert result[0] == 3
+        assert result[1] != loopthread
+        assert executor.pending("hash") == 0
+    finally:
+        executor.shutdown(wait=True)
+
+
+async def test_native_stage_executor_runs_in_process():
+    executor = StageExecutor(workers=1)
+    try:
+        assert await executor.run_in_process("hash", os.getpid) \
+                != os.getpid()
+        assert await executor.run_in_process("hash", divmod, 7, 2) == (3, 1)
+        assert executor.pending("hash") == 0
+    finally:
+        executor.shutdown(wait=True)
+
+
+async def test_native_stage_executor_enforces_stage_limit():
+    executor = StageExecutor(workers=4, queuelimit=4,
+            stagelimits={"encode": 1})
+    lock = threading.Lock()
+    running = {"encode": 0, "hash": 0}
+    peak = {"encode": 0, "hash": 0}
+    release = threading.Event()
+
+    def work(stage):
+        with lock:
+            running[stage] += 1
+            peak[stage] = max(peak[stage], running[stage])
+        release.wait(5)
+        with lock:
+            running[stage] -= 1
+        return stage
+
+    try:
+        tasks = [asyncio.create_task(executor.run(stage, work, stage))
+                for stage in ["encode"] * 3 + ["hash"] * 3]
+        await asyncio.sleep(0.2)
+        assert executor.pending() == {"encode": 3, "hash": 3}
+        release.set()
+        results = await asyncio.gather(*tasks)
+        assert results == ["encode"] * 3 + ["hash"] * 3
+        assert peak["encode"] == 1
+        assert peak["hash"] == 3
+    finally:
+        release.set()
+        executor.shutdown(wait=True)
+
+
+def test_native_stage_executor_drops_closed_loops():
+    executor = StageExecutor(workers=1)
+    try:
+        for i in range(3):
+            assert asyncio.run(executor.run("hash", abs, -i)) == i
+        # only the semaphore of the last (now closed) loop is left
+        assert len(executor._semaphores) == 1
+    finally:
+        executor.shutdown(wait=True)
+
+
+@pytest.mark.parametrize("keepalive", [15, 0])
+async def test_native_http_client_reuses_connections(keepalive):
+    async def handler(request):
+        return web.Response(text="ok")
+
+    app = web.Application()
+    app.router.add_get("/", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    url = "http://127.0.0.1:%d/" % runner.addresses[0][1]
+    client = AsyncHTTPClient(None, keepalive=keepalive)
+    try:
+        for i in range(3):
+            resp = await client.request("GET", url)
+            assert await resp.text() == "ok"
+            resp.release()
+        stats = client.stats()
+    finally:
+        await client._close()
+        await runner.cleanup()
+
+    assert stats["requests"] == 3
+    if keepalive:
+        assert (stats["connects"], stats["reuses"]) == (1, 2)
+        assert stats["openconnections"] == stats["idleconnections"] == 1
+    else:
+        assert (stats["connects"], stats["reuses"]) == (3, 0)
+        assert stats["openconnections"] == 0
+
+
+def test_native_http_client_stats_read_pool_on_runtime_loop():
+    async def handler(request):
+        return web.Response(text="ok")
+
+    async def serve():
+        app = web.Application()
+        app.router.add_get("/", handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        return runner
+
+    async def fetch(url):
+        resp = await client.request("GET", url)
+        text = await resp.text()
+        resp.release()
+        return text
+
+    runtime = AsyncRuntime()
+    client = AsyncHTTPClient(runtime)
+    runner = runtime.submit(serve()).result(timeout=5)
+    try:
+        url = "http://127.0.0.1:%d/" % runner.addresses[0][1]
+        assert runtime.submit(fetch(url)).result(timeout=5) == "ok"
+        threads = []
+        connections = client._connections
+
+        def recording_connections():
+            threads.append(threading.get_ident())
+            return connections()
+
+        client._connections = recording_connections
+        stats = client.stats()
+        assert stats["openconnections"] == stats["idleconnections"] == 1
+        assert threads and threading.get_ident() not in threads
+    finally:
+        client.close()
+        runtime.submit(runner.cleanup()).result(timeout=5)
+        runtime.stop()
@@ -0,0 +1,69 @@
+import asyncio
+import random
+
+import aiohttp
+from aiohttp import web
+
+from flud.protocol import BlockFile
+
+
+def _blockfile(path, data):
+    path.write_bytes(data)
+    BlockFile.convert(str(path), (7, {"mk": b"metadata"}))
+    return str(path)
+
+
+def test_native_blockfile_view_exposes_data_region(tmp_path):
+    data = random.Random(0).randbytes(20000)
+    fname = _blockfile(tmp_path / "block", data)
+
+    f = BlockFile.view(fname)
+    try:
+        assert f.meta(7) == {"mk": b"metadata"}
+        assert f.dataLength() == len(data)
+        fobj = f.fileobj()
+        fobj.seek(f.dataOffset())
+        assert fobj.read(f.dataLength()) == data
+    finally:
+        f.close()
+
+
+def test_native_send_region_matches_built_multipart(tmp_path, flud_server):
+    data = random.Random(1).randbytes(300000)
+    fname = _blockfile(tmp_path / "block", data)
+    server = flud_server()
+    boundary = "b0und4ry"
+    meta = b"metadata"
+
+    async def handler(request):
+        f = BlockFile.view(fname)
+        try:
+            prefix = (server._part_header("key.mk.meta", len(meta), boundary)
+                    + meta + b"\r\n"
+                    + server._part_header("key", f.dataLength(), boundary))
+            return await server._send_region(request, {}, f.fileobj(),
+                    f.dataOffset(), f.dataLength(), prefix,
+                    b"\r\n" + server._part_trailer(boundary))
+        finally:
+            f.close()
+
+    async def fetch():
+        app = web.Application()
+        app.router.add_get("/", handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get("http://127.0.0.1:%d/" % port) as resp:
+                    return resp.headers, await resp.read()
+        finally:
+            await runner.cleanup()
+
+    headers, body = asyncio.run(fetch())
+
+    assert headers["FludProtocol"]
+    assert body == server._build_multipart(
+            [("key.mk.meta", meta), ("key", data)], boundary)
@@ -0,0 +1,146 @@
+import asyncio
+import hashlib
+import os
+import random
+from types import SimpleNamespace
+
+import pytest
+
+from flud import FludChunker
+from flud import FludFileOperations
+from flud.FludChunker import chunkfile, findBoundary, GEAR, _masks
+
+MIN, AVG, MAX = 2048, 8192, 32768
+
+
+def _data(size, seed=0):
+    return random.Random(seed).randbytes(size)
+
+
+def test_native_chunkfile_covers_file_within_bounds(tmp_path):
+    data = _data(400000)
+    path = tmp_path / "data"
+    path.write_bytes(data)
+
+    chunks = chunkfile(str(path), MIN, AVG, MAX)
+
+    offset = 0
+    for chunkoffset, length, digest in chunks:
+        assert chunkoffset == offset
+        assert length <= MAX
+        chunk = data[offset:offset + length]
+        assert digest == hashlib.sha256(chunk).hexdigest()
+        offset += length
+    assert offset == len(data)
+    assert all(length >= MIN for _, length, _ in chunks[:-1])
+    assert len(chunks) > 400000 // MAX
+
+
+def test_native_chunkfile_localizes_edits(tmp_path):
+    data = _data(400000, seed=1)
+    edited = data[:200000] + b"inserted" + data[200000:]
+    (tmp_path / "a").write_bytes(data)
+    (tmp_path / "b").write_bytes(edited)
+
+    before = {c[2] for c in chunkfile(str(tmp_path / "a"), MIN, AVG, MAX)}
+    after = [c[2] for c in chunkfile(str(tmp_path / "b"), MIN, AVG, MAX)]
+
+    assert len([d for d in after if d not in before]) <= 2
+
+
+@pytest.mark.parametrize("size", [0, 1, MIN, MAX + 1])
+def test_native_chunkfile_small_inputs(tmp_path, size):
+    data = _data(size, seed=2)
+    path = tmp_path / "data"
+    path.write_bytes(data)
+
+    chunks = chunkfile(str(path), MIN, AVG, MAX)
+
+    assert sum(length for _, length, _ in chunks) == size
+    if size <= MIN:
+        assert len(chunks) == (1 if size else 0)
+
+
+def _slowBoundary(buf, minsize, avgsize, maxsize):
+    # the gear hash computed a byte at a time
+    n = min(len(buf), maxsize)
+    if len(buf) <= minsize:
+        return len(buf)
+    normal = min(avgsize, n)
+    maskS, maskL = _masks(avgsize)
+    h = 0
+    for i in range(max(0, minsize-32), n):
+        h = ((h << 1) + GEAR[buf[i]]) & 0xFFFFFFFF
+        if i >= minsize and not h & (maskS if i < normal else maskL):
+            return i+1
+    return n
+
+
+@pytest.mark.parametrize("minsize", [1, 31, 32, 33, 1000])
+def test_native_find_boundary_matches_bytewise_hash(minsize, monkeypatch):
+    monkeypatch.setattr(FludChunker, "SCANSIZE", 1000)
+    rand = random.Random(minsize)
+    for i in range(50):
+        avgsize = max(minsize, 1 << rand.randrange(1, 13))
+        maxsize = avgsize*rand.choice([1, 2, 4])
+        buf = bytearray(rand.randbytes(rand.randrange(3*maxsize)))
+        assert findBoundary(buf, minsize, avgsize, maxsize) \
+                == _slowBoundary(buf, minsize, avgsize, maxsize)
+
+
+def test_native_chunkfile_reuses_previous_chunks(tmp_path, monkeypatch):
+    data = _data(400000, seed=3)
+    edited = data[:200000] + b"inserted" + data[200000:]
+    (tmp_path / "a").write_bytes(data)
+    (tmp_path / "b").write_bytes(edited)
+    previous = chunkfile(str(tmp_path / "a"), MIN, AVG, MAX)
+    expected = chunkfile(str(tmp_path / "b"), MIN, AVG, MAX)
+
+    scanned = []
+    def counting(buf, *sizes):
+        cut = findBoundary(buf, *sizes)
+        scanned.append(cut)
+        return cut
+    monkeypatch.setattr(FludChunker, "findBoundary", counting)
+
+    assert chunkfile(str(tmp_path / "b"), MIN, AVG, MAX, previous) \
+            == expected
+    # only the chunks around the edit (and the last one) were rehashed
+    assert len(scanned) <= 4
+
+
+def test_native_store_chunks_reuses_hints_across_runs(tmp_path, monkeypatch):
+    class FakeStoreChunk:
+        def __init__(self, node, filename, offset, length, eK):
+            pass
+
+        async def run(self):
+            return True
+
+    calls = []
+    async def run_in_process(stage, func, *args):
+        calls.append(args[-1])
+        return func(*args)
+
+    monkeypatch.setattr(FludFileOperations, "StoreChunk", FakeStoreChunk)
+    path = tmp_path / "data"
+    path.write_bytes(_data(100000, seed=4))
+    metadir = tmp_path / "meta"
+    metadir.mkdir()
+    for run in range(2):
+        store = FludFileOperations.StoreFile.__new__(
+                FludFileOperations.StoreFile)
+        store.filename = str(path)
+        store.metadir = str(metadir)
+        store.flatname = "run%d" % run
+        store.config = SimpleNamespace(chunksizes=(MIN, AVG, MAX))
+        store.node = SimpleNamespace(executor=SimpleNamespace(
+                run_in_process=run_in_process))
+        store.ctx = lambda msg, *args: msg % args
+        asyncio.run(store._storeChunks())
+
+    assert calls[0] is None
+    assert [c[2] for c in calls[1]] \
+            == [c[2] for c in chunkfile(str(path), MIN, AVG, MAX)]
+    assert len([f for f in os.listdir(metadir)
+            if f.endswith(".chunkhints")]) == 1
@@ -0,0 +1,24 @@
+import types
+
+from flud.FludConfig import CODINGTIERS, FludConfig
+
+
+def _config(nodes):
+    routing = types.SimpleNamespace(nodeCount=lambda: nodes)
+    return types.SimpleNamespace(codingtiers=CODINGTIERS, routing=routing)
+
+
+def test_native_coding_by_size():
+    config = _config(100)
+    assert FludConfig.getCoding(config, 0) == (4, 4)
+    assert FludConfig.getCoding(config, 65536) == (4, 4)
+    assert FludConfig.getCoding(config, 65537) == (10, 10)
+    assert FludConfig.getCoding(config, 2**30) == (20, 20)
+    assert FludConfig.getCoding(config, 2**40) == (40, 20)
+
+
+def test_native_coding_scales_to_network_size():
+    assert FludConfig.getCoding(_config(0), 10**6) == (10, 10)
+    assert FludConfig.getCoding(_config(12), 10**6) == (6, 6)
+    assert FludConfig.getCoding(_config(12), 2**31) == (8, 4)
+    assert FludConfig.getCoding(_config(1), 0) == (1, 1)
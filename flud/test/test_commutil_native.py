@@ -0,0 +1,85 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from flud.protocol import FludCommUtil
+from flud.protocol.FludCommUtil import getCanonicalIP, setResolveOptions
+from flud.protocol.FludCommUtil import encodeNodeList, decodeNodeList
+from flud.protocol.FludCommUtil import decodeLegacyNodeList
+
+
+@pytest.fixture
+def resolver(monkeypatch):
+    names = {None: "me.example.org", "10.0.0.1": "peer.example.org"}
+    calls = []
+    clock = [1000.0]
+
+    def getfqdn(name=None):
+        calls.append(name)
+        return names.get(name, name)
+
+    monkeypatch.setattr(FludCommUtil.socket, "getfqdn", getfqdn)
+    monkeypatch.setattr(FludCommUtil, "time",
+            SimpleNamespace(monotonic=lambda: clock[0]))
+    setResolveOptions(True, 100, 10)
+    yield names, calls, clock
+    setResolveOptions()
+
+
+def test_native_canonical_ip_caches_lookups(resolver):
+    names, calls, clock = resolver
+
+    assert getCanonicalIP("10.0.0.1") == "peer.example.org"
+    assert getCanonicalIP("10.0.0.1") == "peer.example.org"
+    assert getCanonicalIP("me.example.org") == "127.0.0.1"
+    assert getCanonicalIP("localhost") == "127.0.0.1"
+    assert getCanonicalIP("10.0.0.2") == "10.0.0.2"
+    assert getCanonicalIP("10.0.0.2") == "10.0.0.2"
+    assert sorted(calls, key=str) == ["10.0.0.1", "10.0.0.2", None]
+
+    # the failed lookup expires first; the stale result is returned while
+    # it is looked up again in the background
+    clock[0] += 11
+    names["10.0.0.2"] = "late.example.org"
+    assert getCanonicalIP("10.0.0.2") == "10.0.0.2"
+    for i in range(100):
+        if not FludCommUtil._refreshing:
+            break
+        time.sleep(0.01)
+    assert getCanonicalIP("10.0.0.2") == "late.example.org"
+    assert getCanonicalIP("10.0.0.1") == "peer.example.org"
+    assert calls.count("10.0.0.1") == 1
+
+
+def test_native_canonical_ip_without_reverse_lookups(resolver, monkeypatch):
+    names, calls, clock = resolver
+    monkeypatch.setattr(FludCommUtil.socket, "gethostname", lambda: "me")
+    setResolveOptions(False)
+
+    assert getCanonicalIP("10.0.0.1") == "10.0.0.1"
+    assert getCanonicalIP("me") == "127.0.0.1"
+    assert getCanonicalIP("::1") == "127.0.0.1"
+    assert calls == []
+
+
+def test_native_nodelist_roundtrip_and_rejects_malformed():
+    nodes = [("10.0.0.1", 8080, 2**255+7, 2**2047+3),
+            ("peer.example.org", 65535, 1, 65537), ("h", 1, 0, 0)]
+    data = encodeNodeList("abcd", nodes)
+    assert decodeNodeList(data) == {"id": "abcd", "k": nodes}
+    assert decodeNodeList(encodeNodeList("abcd", [])) == {"id": "abcd", "k": []}
+
+    for bad in (b"", data[:-1], data+b"x", b"\x02"+data[1:]):
+        with pytest.raises(ValueError):
+            decodeNodeList(bad)
+
+
+def test_native_legacy_nodelist_is_parsed_without_eval():
+    nodes = [("10.0.0.1", 8080, 2**255+7, 2**2047+3)]
+    assert decodeLegacyNodeList("{'id': '%s', 'k': %s}" % ("abcd", nodes)) \
+            == {"id": "abcd", "k": nodes}
+    for bad in ("__import__('os').system('true')", "[1, 2]",
+            "{'id': 1, 'k': []}", "{'id': 'abcd'"):
+        with pytest.raises(ValueError):
+            decodeLegacyNodeList(bad)
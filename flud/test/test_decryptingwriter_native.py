@@ -0,0 +1,44 @@
+import os
+from io import BytesIO
+
+import pytest
+from Cryptodome.Cipher import AES
+
+from flud.FludFileOperations import DecryptingWriter
+
+EK = "ab" * 32
+
+
+def _padded(data):
+    fpad = 16 - len(data) % 16
+    return bytes([fpad]) + b"\x00" * (fpad - 1) + data
+
+
+def _cbc(data):
+    iv = os.urandom(16)
+    key = bytes.fromhex(EK)
+    return iv + AES.new(key, AES.MODE_CBC, iv).encrypt(_padded(data))
+
+
+def _ecb(data):
+    return AES.new(bytes.fromhex(EK), AES.MODE_ECB).encrypt(_padded(data))
+
+
+@pytest.mark.parametrize("encrypt", [_cbc, _ecb])
+@pytest.mark.parametrize("size", [0, 1, 15, 16, 17, 100000])
+def test_native_decrypting_writer_roundtrip(encrypt, size):
+    data = os.urandom(size)
+    stream = encrypt(data)
+    out = BytesIO()
+    writer = DecryptingWriter(EK, out)
+    for offset in range(0, len(stream), 7):
+        writer.write(stream[offset:offset + 7])
+    writer.close()
+    assert out.getvalue() == data
+
+
+def test_native_decrypting_writer_rejects_truncated_stream():
+    writer = DecryptingWriter(EK, BytesIO())
+    writer.write(_cbc(b"x" * 100)[:-5])
+    with pytest.raises(RuntimeError):
+        writer.close()
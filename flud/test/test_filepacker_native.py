@@ -0,0 +1,53 @@
+import asyncio
+import os
+import types
+
+import pytest
+
+from flud.FludCrypto import hashfile, hashstring
+from flud.FludFileOperations import FilePacker
+
+
+def test_native_filepacker_writes_pack_members(tmp_path):
+    config = types.SimpleNamespace(metadir=str(tmp_path))
+    packer = FilePacker(types.SimpleNamespace(config=config))
+    contents = [b"", b"a", b"small file" * 100]
+    names = []
+    for i, data in enumerate(contents):
+        path = tmp_path / ("f%d" % i)
+        path.write_bytes(data)
+        names.append(str(path))
+
+    packfile, eK, length, members = packer._writePack(
+            names + [names[1], str(tmp_path / "missing")])
+
+    try:
+        assert sorted(members) == sorted(names)
+        assert eK == hashfile(packfile)
+        assert length == sum(len(data) for data in contents)
+        with open(packfile, "rb") as f:
+            pack = f.read()
+        for name, data in zip(names, contents):
+            packinfo = members[name]
+            assert packinfo["pack"] == eK
+            assert packinfo["eK"] == hashstring(data)
+            offset = packinfo["offset"]
+            assert pack[offset:offset + packinfo["length"]] == data
+            assert "path" not in packinfo and "mode" in packinfo
+    finally:
+        os.remove(packfile)
+
+
+async def test_native_filepacker_reports_failed_pack_store(tmp_path,
+        monkeypatch):
+    config = types.SimpleNamespace(metadir=str(tmp_path), packsizes=(1, 1))
+    packer = FilePacker(types.SimpleNamespace(config=config))
+    async def storePack(batch):
+        raise RuntimeError("no nodes")
+    monkeypatch.setattr(packer, "_storePack", storePack)
+    path = tmp_path / "f"
+    path.write_bytes(b"data")
+
+    with pytest.raises(RuntimeError, match="no nodes"):
+        await asyncio.wait_for(packer.add(str(path)), 5)
+    assert not packer.tasks
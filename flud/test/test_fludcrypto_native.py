@@ -0,0 +1,25 @@
+from Cryptodome.PublicKey import RSA
+
+from flud import FludCrypto
+from flud.FludCrypto import FludRSA, hashstring
+
+
+def test_native_import_public_key_is_cached(monkeypatch):
+    monkeypatch.setattr(FludCrypto, "_pubkeys", FludCrypto.OrderedDict())
+    monkeypatch.setattr(FludCrypto, "PUBKEYCACHESIZE", 2)
+    keys = [RSA.generate(1024) for i in range(3)]
+
+    nKu = FludRSA.importPublicKey({"e": keys[0].e, "n": keys[0].n})
+    assert nKu.id() == hashstring(str(keys[0].n))
+    assert nKu.exportPublicKey() == {"e": keys[0].e, "n": keys[0].n}
+    assert FludRSA.importPublicKey({"e": keys[0].e, "n": keys[0].n}) is nKu
+    # decimal strings from request parameters and hex strings of n
+    fromparams = FludRSA.importPublicKey(
+            {"e": str(keys[0].e), "n": str(keys[0].n)})
+    assert fromparams is nKu
+    assert FludRSA.importPublicKey("%x" % keys[1].n).n == keys[1].n
+
+    # least recently used keys are evicted
+    FludRSA.importPublicKey(keys[2].n)
+    assert len(FludCrypto._pubkeys) == 2
+    assert FludRSA.importPublicKey(keys[0].n) is not nKu
@@ -0,0 +1,84 @@
+import hashlib
+import os
+from io import BytesIO
+
+import pytest
+
+pytest.importorskip("zfec")
+
+from flud import fludfilefec
+
+
+K = 20
+M = 40
+
+
+def _share_bytes(paths):
+    result = []
+    for path in paths:
+        with open(path, "rb") as handle:
+            result.append(handle.read())
+    return result
+
+
+@pytest.mark.parametrize("size", [0, 1, 21, 81920, 81921, 300007])
+def test_native_streaming_encoder_matches_encode_to_files(tmp_path, size):
+    data = os.urandom(size)
+    filedir = tmp_path / "files"
+    streamdir = tmp_path / "stream"
+    filedir.mkdir()
+    streamdir.mkdir()
+
+    expected = fludfilefec.encode_to_files(BytesIO(data), size, str(filedir),
+            "c", K, M)
+
+    names, handles = fludfilefec.open_share_files(str(streamdir), "c", M)
+    encoder = fludfilefec.StreamingEncoder(size, K, M, handles)
+    for offset in range(0, size, 7777):
+        encoder.write(data[offset:offset + 7777])
+    digests = encoder.close()
+    for handle in handles:
+        handle.close()
+
+    assert [os.path.basename(n) for n in names] \
+            == [os.path.basename(n) for n in expected]
+    assert _share_bytes(names) == _share_bytes(expected)
+
+    assert digests == [hashlib.sha256(b).hexdigest()
+            for b in _share_bytes(names)]
+
+
+def test_native_streaming_encoder_rejects_size_change(tmp_path):
+    names, handles = fludfilefec.open_share_files(str(tmp_path), "c", M)
+    encoder = fludfilefec.StreamingEncoder(100, K, M, handles)
+    encoder.write(b"x" * 60)
+    with pytest.raises(IOError):
+        encoder.close()
+    with pytest.raises(IOError):
+        encoder.write(b"x" * 60)
+
+
+# 81915 and 163835 end in a short segment whose chunks are still a full
+# CHUNKSIZE, so only the last chunk's pad must be stripped
+@pytest.mark.parametrize("size", [1, 81915, 81920, 163835, 300007])
+def test_native_decode_from_files_roundtrip(tmp_path, size):
+    data = os.urandom(size)
+    names = fludfilefec.encode_to_files(BytesIO(data), size, str(tmp_path),
+            "c", K, M)
+    handles = [open(name, "rb") for name in names[M - K:]]
+    try:
+        out = BytesIO()
+        assert fludfilefec.decode_from_files(out, handles)
+    finally:
+        for handle in handles:
+            handle.close()
+    assert out.getvalue() == data
+
+
+@pytest.mark.parametrize("size", [0, 700, 81921])
+def test_native_encode_to_buffers_matches_encode_to_files(tmp_path, size):
+    data = os.urandom(size)
+    expected = fludfilefec.encode_to_files(BytesIO(data), size, str(tmp_path),
+            "m", K, M)
+    assert fludfilefec.encode_to_buffers(data, K, M) \
+            == _share_bytes(expected)
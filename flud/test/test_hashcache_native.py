@@ -0,0 +1,56 @@
+import os
+
+from flud import FludHashCache, FludJournal
+from flud.FludCrypto import hashfile
+from flud.FludHashCache import HashCache
+
+
+def test_native_hashcache_skips_rehash_until_file_changes(tmp_path,
+        monkeypatch):
+    target = tmp_path / "data"
+    target.write_bytes(b"a" * 5000)
+    calls = []
+
+    def counting_hashfile(name):
+        calls.append(name)
+        return hashfile(name)
+
+    monkeypatch.setattr(FludHashCache, "hashfile", counting_hashfile)
+    cache = HashCache(str(tmp_path / "hashcache"))
+    assert cache.lookup(str(target)) is None
+    digest = cache.hashfile(str(target))
+    assert digest == hashfile(str(target))
+    assert cache.hashfile(str(target)) == digest
+    assert len(calls) == 1
+
+    # a fresh instance reads the persisted entry
+    reopened = HashCache(str(tmp_path / "hashcache"))
+    assert reopened.lookup(str(target)) == digest
+
+    st = os.stat(target)
+    target.write_bytes(b"b" * 5000)
+    os.utime(target, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+    assert reopened.lookup(str(target)) is None
+    assert reopened.hashfile(str(target)) == hashfile(str(target))
+    assert len(calls) == 2
+
+
+def test_native_hashcache_refresh_and_compact(tmp_path, monkeypatch):
+    monkeypatch.setattr(FludJournal, "COMPACTSLACK", 4)
+    path = str(tmp_path / "hashcache")
+    writer = HashCache(path)
+    reader = HashCache(path)
+    target = tmp_path / "data"
+    target.write_bytes(b"x")
+    st = os.stat(target)
+
+    for i in range(20):
+        os.utime(target, ns=(st.st_atime_ns, st.st_mtime_ns + i))
+        writer.add(os.stat(target), "%064x" % i)
+    assert len(writer.entries) == 1
+    assert writer.records <= 2 * len(writer.entries) + 4
+
+    reader.refresh()
+    assert reader.lookup(str(target)) == "%064x" % 19
+    with open(path, "rb") as f:
+        assert len(f.read().splitlines()) == writer.records
@@ -0,0 +1,90 @@
+import asyncio
+import collections
+import os
+import types
+
+import flud.FludFileOperations as fileops
+from flud.FludFileOperations import RetrieveFile
+
+
+class FakeRetrieve(RetrieveFile):
+    def __init__(self, k, delays, hedging, latencies=()):
+        self.k, self.n = k, len(delays) - k
+        self.config = types.SimpleNamespace(hedging=hedging, reputations={},
+                throttled={})
+        self.ctx = lambda msg, *args: msg % args if args else msg
+        self.meta = {(i, i + 1): 100 + i for i in range(len(delays))}
+        self.delays = delays
+        self.latencies = collections.deque(latencies, maxlen=200)
+        self.blocks = {}
+        self.block_indices = set()
+        self.requested_indices = set()
+        self.numBlocksRetrieved = 0
+        self.fetched = []
+        self.cancelled = []
+
+    def _orderNodes(self, meta):
+        return sorted(meta)
+
+    async def _retrieveBlockChain(self, block, id, idx):
+        self.fetched.append(idx)
+        try:
+            delay = self.delays[idx]
+            if delay is None:
+                self.requested_indices.discard(idx)
+                return None
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self.cancelled.append(idx)
+            raise
+        self.requested_indices.discard(idx)
+        self.blocks[block] = block
+        self.block_indices.add(idx)
+        self.numBlocksRetrieved += 1
+        return True
+
+    async def _retrievedAll(self):
+        return sorted(self.block_indices)
+
+
+async def test_native_hedged_retrieve_cancels_stragglers():
+    retrieve = FakeRetrieve(3, [0.01, 10, 0.01, 0.01, 0.01], (1, 0))
+    got = await asyncio.wait_for(retrieve._getSomeBlocksAsync(), 5)
+    assert len(got) == 3 and 1 not in got
+    assert retrieve.fetched[:4] == [0, 1, 2, 3]
+    assert retrieve.cancelled == [1]
+
+
+async def test_native_hedged_retrieve_replaces_failures():
+    retrieve = FakeRetrieve(2, [None, None, 0.01, 0.01], (0, 0))
+    assert await retrieve._getSomeBlocksAsync() == [2, 3]
+    assert retrieve.fetched == [0, 1, 2, 3]
+
+
+async def test_native_hedged_retrieve_hedges_slow_fetches():
+    retrieve = FakeRetrieve(2, [10, 0.01, 0.01, 10], (0, 90),
+            latencies=[0.05] * fileops.MINLATENCYSAMPLES)
+    got = await asyncio.wait_for(retrieve._getSomeBlocksAsync(), 5)
+    assert got == [1, 2]
+    assert retrieve.cancelled == [0]
+
+
+async def test_native_concurrent_retrieves_use_separate_block_dirs(tmp_path):
+    class BlockRetrieve(RetrieveFile):
+        def __init__(self, data):
+            self.parentcodedir = str(tmp_path)
+            self.data = data
+
+        async def _retrieveFileAsync(self):
+            # both fetch the same block name
+            path = os.path.join(self.blockdir, "block")
+            with open(path, "wb") as f:
+                f.write(self.data)
+            await asyncio.sleep(0.01)
+            with open(path, "rb") as f:
+                return f.read()
+
+    ops = [BlockRetrieve(b"a"), BlockRetrieve(b"b")]
+    assert await asyncio.gather(*(op.run() for op in ops)) == [b"a", b"b"]
+    assert ops[0].blockdir != ops[1].blockdir
+    assert os.listdir(tmp_path) == []
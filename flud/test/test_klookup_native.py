@@ -0,0 +1,97 @@
+import asyncio
+import random
+import time
+from types import SimpleNamespace
+
+from flud import FludkRouting
+from flud.protocol import ClientDHTPrimitives
+from flud.protocol.ClientDHTPrimitives import _KLookup, _KFindValue
+
+
+class FakeLookup(_KLookup):
+    """ A lookup over an in-memory network where every node knows them all. """
+
+    def __init__(self, key, ids, delays, broken):
+        self.unreachable = []
+        routing = SimpleNamespace(nodeFailed=self.unreachable.append)
+        _KLookup.__init__(self, SimpleNamespace(
+                config=SimpleNamespace(routing=routing)), key)
+        self.ids = ids
+        self.delays = delays
+        self.broken = broken
+        self.values = {}
+        self.asked = []
+        self.answered = []
+
+    def _nodes(self, near):
+        closest = sorted(self.ids, key=lambda i: i ^ near)[:FludkRouting.k]
+        return [("h", i, i, 65537) for i in closest]
+
+    async def query(self, host, port):
+        self.asked.append(port)
+        await asyncio.sleep(self.delays.get(port, 0.001))
+        self.answered.append(port)
+        if port in self.broken:
+            raise OSError("connection refused")
+        if port in self.values:
+            return self.values[port]
+        # answer as a node only partway to the key would
+        return {'id': "%064x" % port, 'k': self._nodes(port ^ (self.key >> 4))}
+
+
+def test_native_lookup_moves_on_from_slow_peers(monkeypatch):
+    monkeypatch.setattr(ClientDHTPrimitives, "ksoft_to", 0.05)
+    rand = random.Random(2)
+    ids = [rand.getrandbits(256) for i in range(200)]
+    key = rand.getrandbits(256)
+    best = sorted(ids, key=lambda i: i ^ key)[:FludkRouting.k+2]
+    # two of the closest nodes are broken and one answers very slowly
+    lookup = FakeLookup(key, ids, {best[0]: 30}, {best[1], best[2]})
+    lookup.handle({'id': "%064x" % 1, 'k': [("h", i, i, 65537)
+            for i in rand.sample(ids, FludkRouting.k)]}, "h", 1)
+
+    start = time.monotonic()
+    assert asyncio.run(lookup.run())
+
+    # the lookup went on without the slow peer, and didn't wait for it
+    assert time.monotonic()-start < 5
+    assert best[0] in lookup.asked and best[0] not in lookup.answered
+    assert [n[2] for n in lookup.closest()] == \
+            [best[0]]+best[3:FludkRouting.k+2]
+    assert len(set(lookup.asked)) == len(lookup.asked) < len(ids)
+    assert sorted(lookup.unreachable) == sorted([best[1], best[2]])
+
+
+def test_native_lookup_stops_when_handled():
+    rand = random.Random(3)
+    ids = [rand.getrandbits(256) for i in range(50)]
+    lookup = FakeLookup(ids[0], ids, {}, set())
+    lookup.handle({'id': "%064x" % 1, 'k': [("h", i, i, 65537)
+            for i in ids[1:4]]}, "h", 1)
+
+    def stop(response, host, port):
+        lookup.result = response
+        return True
+    lookup.handle = stop
+
+    assert asyncio.run(lookup.run()) is False
+    assert lookup.result['id'] in ["%064x" % i for i in ids[1:4]]
+
+
+class FakeValueLookup(FakeLookup, _KFindValue):
+    pass
+
+
+def test_native_find_value_waits_for_slow_holder(monkeypatch):
+    monkeypatch.setattr(ClientDHTPrimitives, "ksoft_to", 0.05)
+    rand = random.Random(4)
+    ids = [rand.getrandbits(256) for i in range(100)]
+    key = rand.getrandbits(256)
+    holder = sorted(ids, key=lambda i: i ^ key)[0]
+    lookup = FakeValueLookup(key, ids, {holder: 0.3}, set())
+    lookup.values[holder] = "value"
+    lookup.handle({'id': "%064x" % 1, 'k': [("h", i, i, 65537)
+            for i in rand.sample(ids, FludkRouting.k)]}, "h", 1)
+
+    assert asyncio.run(lookup.run()) is False
+    assert lookup.result == "value"
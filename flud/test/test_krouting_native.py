@@ -0,0 +1,107 @@
+import random
+import time
+
+import pytest
+
+from flud.FludkRouting import NodeCache, kRouting
+
+
+def _table(nodes, depth, seed=0):
+    """
+    Returns a routing table for a random node which has been told of nodes
+    other nodes, spread so that some share each length of prefix with it.
+    """
+    rand = random.Random(seed)
+    me = rand.getrandbits(256)
+    table = kRouting(("me", 1, me, 65537), 256, depth)
+    for i in range(nodes):
+        nID = me ^ (rand.getrandbits(256) >> rand.randrange(256)) or 1
+        table.insertNode(("h%d" % i, i, nID, 65537))
+    return table, rand
+
+
+def test_native_routing_buckets_track_their_positions():
+    table, rand = _table(3000, 12)
+
+    assert len(table.kBuckets) > 100
+    for i, bucket in enumerate(table.kBuckets):
+        assert bucket.index == i
+        if i:
+            assert bucket.begin == table.kBuckets[i-1].end+1
+        assert len(bucket.contents) == len(bucket) <= 12
+    assert table.bucketEnds == [b.end for b in table.kBuckets]
+    assert table.nodeCount() == len(table.knownExternalNodes())
+
+    node = table.kBuckets[-1].contents[0]
+    moved = ("elsewhere", 2) + node[2:]
+    assert table.insertNode(moved) is None
+    assert table.getNode(node[2]) == moved
+    assert table.kBuckets[-1].contents[-1] == moved
+    table.removeNode(node)
+    assert table.getNode(node[2]) == moved
+    table.removeNode(moved)
+    assert table.getNode(node[2]) is None
+
+    closest = table.findNode(rand.getrandbits(256))
+    for i in range(50):
+        extra = table.randomNode(closest)
+        assert extra[2] not in [n[2] for n in closest] + [table.node[2]]
+    assert kRouting(("me", 1, 5), 256, 12).randomNode() is None
+
+
+def test_native_node_cache_lru_and_liveness():
+    cache = NodeCache(3)
+    for i in range(3):
+        assert cache.insertNode(("h", i, i)) is None
+    cache.insertNode(("moved", 0, 0))
+    assert cache.insertNode(("h", 3, 3)) == 1
+    assert cache.nodes() == [("h", 2, 2), ("moved", 0, 0), ("h", 3, 3)]
+
+    assert cache.freshest(0, 2) == ("moved", 0, 0)
+    cache.nodeFailed(0)
+    assert cache.freshest(0, 2) == ("h", 2, 2)
+    cache.removeNode(("h", 2, 2))
+    assert cache.freshest(0, 2) is None
+    cache.insertNode(("h", 0, 0))
+    assert cache.freshest(0, 2) == ("h", 0, 0)
+    assert len(cache) == 2
+
+
+def test_native_routing_promotes_replacements_for_failed_nodes():
+    table = kRouting(("me", 1, 0), 8, 2)
+    for nID in (200, 210, 220, 230):
+        table.insertNode(("h", nID, nID))
+    bucket = table.kBuckets[-1]
+    assert bucket.contents == [("h", 200, 200), ("h", 210, 210)]
+    assert table.replacementCache.nodes() == [("h", 220, 220),
+            ("h", 230, 230)]
+
+    table.nodeFailed(230)
+    table.nodeFailed(200)
+    assert bucket.contents == [("h", 210, 210), ("h", 220, 220)]
+    table.nodeFailed(210)
+    assert bucket.contents == [("h", 210, 210), ("h", 220, 220)]
+    # seeing a node again makes it eligible once more
+    table.insertNode(("h", 230, 230))
+    table.nodeFailed(210)
+    assert bucket.contents == [("h", 220, 220), ("h", 230, 230)]
+
+
+@pytest.mark.slow
+def test_native_routing_find_node_benchmark():
+    table, rand = _table(40000, 48, 1)
+    known = table.nodeCount()
+    assert known >= 10000
+    targets = [rand.getrandbits(256) for i in range(2000)]
+    targets += [n[2] for n in rand.sample(table.knownNodes(), 2000)]
+
+    start = time.perf_counter()
+    for target in targets:
+        table.findNode(target)
+    elapsed = time.perf_counter()-start
+
+    print("\nfindNode with %d known nodes in %d buckets: %.1fus/call"
+            % (known, len(table.kBuckets), elapsed/len(targets)*1e6))
+    assert table.findNode(targets[-1])[0][2] == targets[-1]
+    # a scan of the whole table would take milliseconds per call
+    assert elapsed/len(targets) < 0.001
@@ -0,0 +1,110 @@
+import asyncio
+import io
+import os
+import tarfile
+
+from flud.protocol import PackStore as PackStoreModule
+from flud.protocol.PackStore import PackStore
+
+
+def _tarball(path, members, mode="w"):
+    with tarfile.open(path, mode) as tar:
+        for name, data in members:
+            tinfo = tarfile.TarInfo(name)
+            tinfo.size = len(data)
+            tar.addfile(tinfo, io.BytesIO(data))
+
+
+def test_native_packstore_put_get_delete_persist(tmp_path):
+    base = str(tmp_path / "requester")
+    packs = PackStore(base)
+    assert len(packs) == 0
+    assert not os.path.exists(base + ".idx")
+
+    packs.putMany([("key", b"block data"), ("key.12.meta", b"meta")])
+    packs.put("other", b"x" * 100)
+    assert packs.get("key") == b"block data"
+    assert packs.get("key", 6, 100) == b"data"
+    assert packs.names("key") == ["key", "key.12.meta"]
+    assert packs.delete(["key.12.meta", "missing"]) == 1
+    packs.put("other", b"y" * 50)
+
+    reopened = PackStore(base)
+    assert reopened.names("key") == ["key"]
+    assert reopened.get("other") == b"y" * 50
+    assert reopened.get("key.12.meta") is None
+    assert reopened.dead == packs.dead == 104
+
+
+def test_native_packstore_ignores_partial_index_record(tmp_path):
+    base = str(tmp_path / "requester")
+    PackStore(base).put("key", b"data")
+    with open(base + ".idx", "ab") as f:
+        f.write(b"partial")
+
+    packs = PackStore(base)
+    packs.put("key2", b"more")
+
+    assert PackStore(base).get("key") == b"data"
+    assert PackStore(base).get("key2") == b"more"
+
+
+def test_native_packstore_compaction(tmp_path, monkeypatch):
+    monkeypatch.setattr(PackStoreModule, "COMPACTSLACK", 10)
+    base = str(tmp_path / "requester")
+    packs = PackStore(base)
+    packs.putMany([("k%d" % i, bytes([i]) * 20) for i in range(10)])
+    region = packs.openRegion("k9")
+    packs.delete(["k%d" % i for i in range(8)])
+    assert packs.needsCompaction()
+
+    packs.compact()
+
+    assert not packs.needsCompaction()
+    assert packs.dead == 0
+    assert os.path.getsize(packs.packpath) == 40
+    assert not os.path.exists(base + ".0.pack")
+    assert PackStore(base).get("k8") == bytes([8]) * 20
+    # regions opened before compaction stay readable
+    fobj, offset, length = region
+    with fobj:
+        fobj.seek(offset)
+        assert fobj.read(length) == bytes([9]) * 20
+
+
+def test_native_packstore_imports_legacy_tarballs(tmp_path):
+    base = str(tmp_path / "requester")
+    _tarball(base + ".tar", [("a", b"aaa"), ("a.1.meta", b"m")])
+    _tarball(base + ".tar.gz", [("b", b"bbb")], "w:gz")
+
+    packs = PackStore(base)
+
+    assert packs.get("a") == b"aaa"
+    assert packs.get("a.1.meta") == b"m"
+    assert packs.get("b") == b"bbb"
+    assert not os.path.exists(base + ".tar")
+    assert not os.path.exists(base + ".tar.gz")
+
+    upload = str(tmp_path / "upload.tar")
+    _tarball(upload, [("a", b"zzz"), ("c", b"ccc")])
+    assert packs.importTarball(upload) == ["c"]
+    assert packs.get("a") == b"aaa"
+
+
+async def test_native_server_caches_pack_indexes(flud_server):
+    server = flud_server(packindexes=2)
+    (await server._pack_store("aa")).put("key", b"data")
+    assert (await server._pack_store("aa")).get("key") == b"data"
+    # concurrent first uses open the index once
+    bb = await asyncio.gather(*[server._pack_store("bb") for i in range(3)])
+    assert bb[0] is bb[1] is bb[2]
+
+    assert server.stats() == {"packindexes": 2, "packindexhits": 1,
+            "packindexmisses": 2, "packmembers": 1}
+
+    # the least recently used index is dropped, and read again when needed
+    await server._pack_store("aa")
+    await server._pack_store("cc")
+    assert list(server._packs) == ["aa", "cc"]
+    assert (await server._pack_store("aa")).get("key") == b"data"
+    assert server.stats()["packindexmisses"] == 3
@@ -0,0 +1,155 @@
+import configparser
+import os
+import random
+import types
+
+from flud import FludJournal, FludReputations
+from flud.FludConfig import FludConfig, TrustDeltas
+from flud.FludReputations import ReputationIndex
+
+
+def _sorted(scores):
+    return [k for v, k in sorted(((v, k) for k, v in scores.items()),
+            reverse=True)]
+
+
+def test_native_reputation_index_stays_ranked():
+    rand = random.Random(0)
+    scores = {}
+    index = ReputationIndex()
+    for i in range(2000):
+        nodeID = rand.randrange(300)
+        delta = rand.randrange(-10, 11)
+        scores[nodeID] = scores.get(nodeID, 1)+delta
+        assert index.adjust(nodeID, delta, 1) == scores[nodeID]
+
+    assert index.best() == _sorted(scores)
+    assert index.best(10) == _sorted(scores)[:10]
+    top = _sorted(scores)
+    assert index.best(5, top[1:3]) == top[:1]+top[3:7]
+    assert ReputationIndex({"ff": 3, 17: 3}).best() == [255, 17]
+
+
+def test_native_reputation_index_exclusions_and_throttles():
+    index = ReputationIndex({1: 10, 2: 20, 3: 30, 4: 40})
+
+    # excluded nodes make up the numbers only when there are enough nodes
+    assert index.best(3, [4, 2]) == [4, 3, 1]
+    assert index.best(5, [4, 2]) == [3, 1]
+
+    index.throttle(3, 100)
+    index.throttle(4, 50)
+    index.throttle(4, 200)
+    assert index.best(2, throttle=True) == [2, 1]
+    assert index.best(2) == [4, 3]
+    index.expire(150)
+    assert index.throttled == {4: 200}
+    assert index.best(2, throttle=True) == [3, 2]
+
+    for i in range(1000):
+        index.throttle(1, 300+i)
+    assert len(index.expiries) < 100
+
+
+def test_native_preferred_nodes_from_config():
+    config = FludConfig.__new__(FludConfig)
+    config.reputations = ReputationIndex()
+    config.throttled = config.reputations.throttled
+    config.routing = types.SimpleNamespace(getNode=lambda n: ("h", 1, n))
+    for nodeID in range(1, 6):
+        config.reputations[nodeID] = TrustDeltas.INITIAL_SCORE
+    config.modifyReputation(3, TrustDeltas.GET_SUCCEED)
+    config.modifyReputation("5", TrustDeltas.PUT_FAIL)
+
+    assert config.reputations[3] == 5
+    assert 5 in config.throttled
+    assert config.getPreferredNodes(2) == [("h", 1, 3), ("h", 1, 4)]
+    assert [n[2] for n in config.getPreferredNodes(throttle=True)] \
+            == [3, 4, 2, 1]
+
+
+def test_native_reputation_index_decays_and_is_bounded(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(FludReputations, "time",
+            types.SimpleNamespace(time=lambda: clock[0]))
+    index = ReputationIndex(capacity=3, halflife=100, baseline=1)
+    index[1] = 41
+    clock[0] += 100
+    index[2] = 21
+    index[3] = -19
+
+    assert index[1] == 21 and index[2] == 21
+    assert index.adjust(1, 1) == 22
+    clock[0] += 100
+    assert index[2] == 11 and index[3] == -9
+    assert index.best() == [1, 2, 3]
+
+    # the node whose score changed least recently is forgotten first
+    index.throttle(2, 5000)
+    index[4] = 1
+    assert 2 not in index and 2 not in index.throttled
+    assert sorted(index) == [1, 3, 4]
+
+
+def test_native_reputation_index_persists(tmp_path, monkeypatch):
+    monkeypatch.setattr(FludJournal, "COMPACTSLACK", 10)
+    path = str(tmp_path / "reputations")
+    index = ReputationIndex(path=path, capacity=4)
+    for nodeID in range(6):
+        index.adjust(nodeID, nodeID)
+    index.throttle(5, 2**40)
+    index.throttle(4, 1)
+    index.flush()
+    with open(path, "ab") as f:
+        f.write(b"partial")
+
+    reopened = ReputationIndex(path=path, capacity=4)
+    assert dict(reopened.items()) == {2: 2, 3: 3, 4: 4, 5: 5}
+    assert reopened.throttled == {5: 2**40}
+    reopened[6] = 6
+    reopened.flush()
+    assert dict(ReputationIndex(path=path).items()) \
+            == {3: 3, 4: 4, 5: 5, 6: 6}
+
+    for i in range(20):
+        reopened.adjust(6, 1)
+    reopened.flush()
+    assert os.path.getsize(path) == len(FludReputations.MAGIC) \
+            + 5*FludReputations.RECORD.size
+    assert ReputationIndex(path=path)[6] == 26
+
+
+def test_native_reputations_imported_from_config(tmp_path):
+    config = FludConfig.__new__(FludConfig)
+    config.configParser = configparser.ConfigParser()
+    config.configParser.add_section("reputations")
+    config.configParser.set("reputations", "ff", "12")
+    config.configParser.set("reputations", "10", "__import__('os')")
+    config.reputations = ReputationIndex(path=str(tmp_path / "reputations"))
+
+    config._importReputations()
+
+    assert not config.configParser.has_section("reputations")
+    assert dict(ReputationIndex(path=config.reputations.path).items()) \
+            == {255: 12}
+
+
+def test_native_add_node_keeps_journaled_score(tmp_path):
+    path = str(tmp_path / "reputations")
+    index = ReputationIndex(path=path)
+    index[0xab] = 42
+    index.flush()
+
+    config = FludConfig.__new__(FludConfig)
+    config.groupIDu = "g"
+    config.nodes = {}
+    config.reputations = ReputationIndex(path=path)
+    config.routing = types.SimpleNamespace(insertNode=lambda node: None)
+    Ku = types.SimpleNamespace(n=65537, exportPublicKey=lambda: "Ku")
+    config.addNode("ab", "h", 1, Ku)
+    config.addNode("cd", "h", 2, Ku)
+
+    assert config.reputations[0xab] == 42
+    assert config.reputations[0xcd] == TrustDeltas.INITIAL_SCORE
+    config.reputations.flush()
+    assert ReputationIndex(path=path)[0xab] == 42
@@ -0,0 +1,98 @@
+import asyncio
+from types import SimpleNamespace
+
+from flud.protocol import FludClient as FludClientModule
+from flud.protocol.FludClient import FludClient
+
+
+class FakeRouting:
+    def __init__(self):
+        self.nodes = {}
+        self.failed = []
+
+    def getNode(self, nodeID):
+        return self.nodes.get(nodeID)
+
+    def nodeFailed(self, nodeID):
+        self.failed.append(nodeID)
+
+
+def _client(monkeypatch):
+    routing = FakeRouting()
+    client = FludClient(SimpleNamespace(
+            config=SimpleNamespace(routing=routing)))
+    lookups = []
+
+    async def k_find_node(key):
+        lookups.append(key)
+        await asyncio.sleep(0.01)
+        return {'k': [("h", 2, key+1, 65537), ("h", 1, key, 65537)]}
+
+    monkeypatch.setattr(client, "k_find_node", k_find_node)
+    return client, routing, lookups
+
+
+def test_native_resolve_node_coalesces_and_caches(monkeypatch):
+    client, routing, lookups = _client(monkeypatch)
+
+    async def resolve():
+        return await asyncio.gather(*(client.resolve_node(10)
+            for i in range(5)))
+
+    results = asyncio.run(resolve())
+    assert lookups == [10]
+    assert all(r['k'][0] == ("h", 1, 10, 65537) for r in results)
+    assert asyncio.run(client.resolve_node(10)) == {'k': [("h", 1, 10, 65537)]}
+    assert lookups == [10]
+
+    routing.nodes[20] = ("r", 3, 20, 65537)
+    assert asyncio.run(client.resolve_node(20)) == {'k': [("r", 3, 20, 65537)]}
+    assert client.stats() == {"resolverouting": 1, "resolvecached": 1,
+            "resolvecoalesced": 4, "resolvelookups": 1}
+    assert client.resolving == {}
+
+
+def test_native_resolve_node_forgets_unreachable_nodes(monkeypatch):
+    client, routing, lookups = _client(monkeypatch)
+    routing.nodes[20] = ("r", 3, 20, 65537)
+    asyncio.run(client.resolve_node(10))
+
+    # errors from the peer itself don't invalidate its location
+    client.report_failure(10, RuntimeError("received status 404"))
+    asyncio.run(client.resolve_node(10))
+    assert lookups == [10]
+
+    client.report_failure(10, OSError("connection refused"))
+    client.report_failure(20, OSError("connection refused"))
+    asyncio.run(client.resolve_node(10))
+    assert asyncio.run(client.resolve_node(20))['k'][0] == ("h", 1, 20, 65537)
+    assert lookups == [10, 10, 20]
+    assert routing.failed == [10, 20]
+
+    monkeypatch.setattr(FludClientModule, "NODECACHE_TTL", -1)
+    client.report_failure(10, OSError("connection refused"))
+    asyncio.run(client.resolve_node(10))
+    asyncio.run(client.resolve_node(10))
+    assert lookups == [10, 10, 20, 10, 10]
+
+
+def test_native_resolve_node_caches_are_bounded(monkeypatch):
+    client, routing, lookups = _client(monkeypatch)
+    monkeypatch.setattr(FludClientModule, "NODECACHESIZE", 2)
+    asyncio.run(client.resolve_node(10))
+    asyncio.run(client.resolve_node(20))
+    # a hit makes 10 the most recently used, so 20 is evicted instead
+    asyncio.run(client.resolve_node(10))
+    asyncio.run(client.resolve_node(30))
+    assert list(client.resolved) == [10, 30]
+    assert lookups == [10, 20, 30]
+
+    for nodeID in (40, 50, 60):
+        client.report_failure(nodeID, OSError("connection refused"))
+    assert list(client.unresolved) == [50, 60]
+
+    # unreachable reports expire, after which the routing table is trusted
+    routing.nodes[50] = ("r", 3, 50, 65537)
+    client.unresolved[50] = 0
+    assert asyncio.run(client.resolve_node(50))['k'][0] == ("r", 3, 50, 65537)
+    assert 50 not in client.unresolved
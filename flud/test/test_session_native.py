@@ -0,0 +1,62 @@
+from types import SimpleNamespace
+
+from flud.fencode import fencode, fdecode
+from flud.protocol import AiohttpServer
+from flud.protocol import ClientPrimitives
+from flud.protocol.AiohttpServer import SESSIONKEY
+
+
+class FakeRequest(dict):
+    def __init__(self, headers=None):
+        super().__init__()
+        self.headers = headers or {}
+
+
+def test_native_session_tokens_bind_requester_and_expire(flud_server,
+        monkeypatch):
+    server = flud_server()
+    issued = FakeRequest()
+    server._issue_session(issued, "aa", "10.0.0.1")
+    token = issued[SESSIONKEY]
+
+    assert server._check_session(FakeRequest({"Fludsession": token}), "aa", "10.0.0.1")
+    assert not server._check_session(FakeRequest({"Fludsession": token}), "bb", "10.0.0.1")
+    assert not server._check_session(FakeRequest({"Fludsession": token}), "aa", "10.0.0.2")
+    assert not server._check_session(FakeRequest({"Fludsession": "junk"}), "aa", "10.0.0.1")
+    assert not server._check_session(FakeRequest(), "aa", "10.0.0.1")
+    # another server instance (e.g., after a restart) rejects the token
+    assert not flud_server()._check_session(
+            FakeRequest({"Fludsession": token}), "aa", "10.0.0.1")
+
+    expiry, mac = fdecode(token)
+    forged = fencode((expiry + 1000, mac))
+    assert not server._check_session(FakeRequest({"Fludsession": forged}), "aa", "10.0.0.1")
+
+    monkeypatch.setattr(AiohttpServer.time, "time", lambda: expiry + 1)
+    assert not server._check_session(FakeRequest({"Fludsession": token}), "aa", "10.0.0.1")
+
+
+def test_native_client_caches_session_per_peer(monkeypatch):
+    monkeypatch.setattr(ClientPrimitives, "sessions", {})
+    node = SimpleNamespace(config=SimpleNamespace(nodeID="cc"))
+    other = SimpleNamespace(config=SimpleNamespace(nodeID="dd"))
+    nKu = SimpleNamespace(id=lambda: "aa")
+    base = {"User-Agent": "FludClient"}
+
+    assert "Fludsession" not in ClientPrimitives._session_headers(node, base, "h", 1, nKu)
+    ClientPrimitives._save_session(node,
+            {"Fludsession": "tok", "Fludsessionttl": "300"}, "h", 1, nKu)
+    hdrs = ClientPrimitives._session_headers(node, base, "h", 1, nKu)
+    assert hdrs["Fludsession"] == "tok"
+    assert "Fludsession" not in base
+    assert "Fludsession" not in ClientPrimitives._session_headers(node, base, "h", 2, nKu)
+    assert "Fludsession" not in ClientPrimitives._session_headers(other, base, "h", 1, nKu)
+
+    ClientPrimitives._drop_session(node, hdrs, "h", 1, nKu)
+    assert "Fludsession" not in hdrs
+    assert "Fludsession" not in ClientPrimitives._session_headers(node, base, "h", 1, nKu)
+
+    # tokens too close to expiry aren't used
+    ClientPrimitives._save_session(node,
+            {"Fludsession": "tok", "Fludsessionttl": "5"}, "h", 1, nKu)
+    assert "Fludsession" not in ClientPrimitives._session_headers(node, base, "h", 1, nKu)